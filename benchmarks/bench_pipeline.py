@@ -0,0 +1,142 @@
+"""
+This is a script for benchmarking (time and peak memory) of Perseus pipeline stages on simulated data
+
+Usage
+-----
+python -m benchmarks.bench_pipeline --sizes 1000 10000 --out bench.json
+python -m benchmarks.bench_pipeline --baseline bench.json --tolerance 0.2   # exit code 1 for regressions
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import scipy
+
+from perseuspy import PerseusPipeline, PerseusPlots
+from perseuspy.per_simul import simulate_lfq
+from perseuspy.per_test import _correct_p_val
+
+# Settings
+LIST_SIZES = [1000, 10000, 100000, 1000000]
+MAX_SIZE_KNN = 10000    # kNN imputation is quadratic in number of proteins
+COL_RATIO = "log2 ratio (A/B)"
+COL_PVAL = "-log10 p value (A/B)"
+
+
+# I Helper Functions
+def _bench(func=None, setup=None, repeat=3):
+    """Get best and median wall time (s) of func(setup()) and peak memory (MB) of one traced run"""
+    times = []
+    for _ in range(repeat):
+        args = setup()
+        t0 = time.perf_counter()
+        func(args)
+        times.append(time.perf_counter() - t0)
+    args = setup()
+    tracemalloc.start()
+    func(args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return dict(time_best=min(times), time_median=float(np.median(times)), peak_mem_mb=peak / 1024 ** 2)
+
+
+def _get_stages(pp=None):
+    """Get dict with (func, setup) for each stage, where setup returns input of stage (not timed)"""
+    df_lfq = pp.get_df_lfq()
+    df_lfq_mean = pp.get_df_lfq_mean(df_lfq=df_lfq)
+    p_vals = pp.ttest(df_lfq=df_lfq, log10_out=False).to_numpy()
+    df_ratio_pval = pp.run()
+
+    # Clear caches of pipeline to time computation and not lookup
+    def setup_lfq():
+        pp._views.clear()
+
+    def setup_ttest():
+        pp._stats_cache = None
+        return df_lfq
+
+    dict_stages = {"get_df_lfq": (lambda x: pp._get_df_lfq(log2_in=False), setup_lfq),
+                   "get_df_lfq_mean": (lambda x: pp.get_df_lfq_mean(df_lfq=x), lambda: df_lfq),
+                   "get_df_ratio": (lambda x: pp.get_df_ratio(df_lfq_mean=x), lambda: df_lfq_mean),
+                   "ttest": (lambda x: pp.ttest(df_lfq=x), setup_ttest),
+                   "correction": (lambda x: _correct_p_val(p_vals=x, method="fdr_bh"), lambda: p_vals),
+                   "impute_normal": (lambda x: pp.impute_normal(df_lfq=x, seed=0), lambda: df_lfq),
+                   "impute_knn": (lambda x: pp.impute_knn(df_lfq=x), lambda: df_lfq),
+                   "volcano_classes": (lambda x: PerseusPlots.volcano_classes(df_ratio_pval=x, col_ratio=COL_RATIO,
+                                                                               col_pval=COL_PVAL),
+                                       lambda: df_ratio_pval)}
+    return dict_stages
+
+
+def _meta():
+    """Environment of benchmark run"""
+    return dict(date=time.strftime("%Y-%m-%d %H:%M:%S"), python=platform.python_version(),
+                platform=platform.platform(), numpy=np.__version__, pandas=pd.__version__, scipy=scipy.__version__)
+
+
+# II Main Functions
+def run_benchmarks(sizes=None, stages=None, n_samples=3, repeat=3, seed=0):
+    """Benchmark pipeline stages for simulated data of given sizes (number of proteins)
+
+    Returns
+    -------
+    results: list with dict (stage, n_proteins, time_best, time_median, peak_mem_mb) for each stage and size
+    """
+    sizes = LIST_SIZES if sizes is None else sizes
+    results = []
+    for n_proteins in sizes:
+        df, dict_col_group = simulate_lfq(n_proteins=n_proteins, n_samples=n_samples, seed=seed)
+        pp = PerseusPipeline(df=df, dict_col_group=dict_col_group, groups=["A", "B"])
+        for stage, (func, setup) in _get_stages(pp=pp).items():
+            if (stages is not None and stage not in stages) or (stage == "impute_knn" and n_proteins > MAX_SIZE_KNN):
+                continue
+            result = dict(stage=stage, n_proteins=n_proteins, **_bench(func=func, setup=setup, repeat=repeat))
+            results.append(result)
+            print("{stage:>16} {n_proteins:>8}: {time_best:.4f} s, {peak_mem_mb:.1f} MB".format(**result))
+    return results
+
+
+def check_regressions(results=None, baseline=None, tolerance=0.2, min_diff=0.001):
+    """Get list of regressions (best time exceeding baseline by more than tolerance and more than min_diff
+    seconds to ignore timer noise of fast stages) for stages in baseline"""
+    dict_baseline = {(r["stage"], r["n_proteins"]): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        base = dict_baseline.get((result["stage"], result["n_proteins"]))
+        diff = result["time_best"] - base["time_best"] if base is not None else 0
+        if base is not None and diff > base["time_best"] * tolerance and diff > min_diff:
+            regressions.append("{} ({}): {:.4f} s (baseline {:.4f} s)".format(
+                result["stage"], result["n_proteins"], result["time_best"], base["time_best"]))
+    return regressions
+
+
+def main(argv=None):
+    """"""
+    parser = argparse.ArgumentParser(description="Benchmark Perseus pipeline stages on simulated data")
+    parser.add_argument("--sizes", type=int, nargs="+", default=LIST_SIZES, help="Numbers of proteins")
+    parser.add_argument("--stages", nargs="+", default=None, help="Stages to benchmark (default all)")
+    parser.add_argument("--n_samples", type=int, default=3, help="Number of samples per group")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of timed runs")
+    parser.add_argument("--out", default=None, help="JSON file for results")
+    parser.add_argument("--baseline", default=None, help="JSON file with results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative slowdown")
+    args = parser.parse_args(argv)
+    results = run_benchmarks(sizes=args.sizes, stages=args.stages, n_samples=args.n_samples, repeat=args.repeat)
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(dict(meta=_meta(), results=results), f, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = check_regressions(results=results, baseline=json.load(f), tolerance=args.tolerance)
+        for regression in regressions:
+            print("Regression: {}".format(regression))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
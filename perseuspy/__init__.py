@@ -1,5 +1,11 @@
 from perseuspy.per_base import get_dict_groups
+from perseuspy.per_batch import run_batch
+from perseuspy.per_chunk import run_chunked
+from perseuspy.per_incr import PerseusIncremental
+from perseuspy.per_io import read_lfq
 from perseuspy.per_plots import PerseusPlots
+from perseuspy.per_simul import simulate_lfq
 from perseuspy.perseus_pipe import PerseusPipeline
 
-__all__ = ["PerseusPipeline", "get_dict_groups", "PerseusPlots"]
+__all__ = ["PerseusPipeline", "get_dict_groups", "PerseusPlots", "PerseusIncremental", "read_lfq", "run_batch",
+           "run_chunked", "simulate_lfq"]
@@ -1,17 +1,31 @@
 """
 This is a script for basic processing in Perseus pipeline
 """
+import hashlib
+import itertools
 import numpy as np
+import pandas as pd
 import warnings
 
 import perseuspy._utils as ut
 
 
 # I Helper Functions
-def _check_lfq_str(df=None, lfq_str=None, groups=None):
+def _freeze(obj=None):
+    """Convert (nested) dicts, lists, and arrays (by content hash) into hashable tuples for cache keys"""
+    if isinstance(obj, dict):
+        return tuple(sorted((key, _freeze(val)) for key, val in obj.items()))
+    if isinstance(obj, (list, tuple)):
+        return tuple(_freeze(val) for val in obj)
+    if isinstance(obj, np.ndarray):
+        return obj.shape, obj.dtype.str, hashlib.sha1(np.ascontiguousarray(obj).tobytes()).hexdigest()
+    return obj
+
+
+def _check_lfq_str(cols=None, lfq_str=None, groups=None):
     """"""
     cols_lfq = []
-    for col in list(df):
+    for col in cols:
         if lfq_str in col:
             for group in groups:
                 if group in col:
@@ -41,12 +55,109 @@ def _pre_filter(df=None, list_filter_col=None):
     return df
 
 
+def _col_log2(col=None):
+    """Name of intensity column in log2 scale"""
+    return "log2 {}".format(col)
+
+
+def _col_linear(col=None):
+    """Name of intensity column in normal scale"""
+    return col.replace("log2 ", "")
+
+
+def _group_pairs(groups=None):
+    """Get list of unordered group pairs (a, b) in order of given groups"""
+    return list(itertools.combinations(groups, 2))
+
+
+def _check_contrast_groups(contrasts=None, groups=None):
+    """Check if groups of contrasts are given"""
+    for contrast in contrasts:
+        if len(contrast) != 2 or contrast[0] == contrast[1]:
+            raise ValueError("Contrast ({}) should be pair of two different groups".format(contrast))
+        for group in contrast:
+            if group not in groups:
+                raise ValueError("Group of contrast ({}) should be one of following: {}".format(group, groups))
+
+
+def _contrast_matrix_pairs(contrasts=None, groups=None):
+    """Get group pairs (a, b) from contrast matrix (contrasts x groups) with 1 for a and -1 for b"""
+    if isinstance(contrasts, pd.DataFrame):
+        groups = list(contrasts)
+    values = np.asarray(contrasts)
+    if values.ndim != 2 or values.shape[1] != len(groups):
+        raise ValueError("Contrast matrix should have shape (n_contrasts, {})".format(len(groups)))
+    pairs = []
+    for row in values:
+        if sorted(row[row != 0]) != [-1, 1]:
+            raise ValueError("Each row of contrast matrix should contain one 1 and one -1 ({})".format(row))
+        pairs.append((groups[list(row).index(1)], groups[list(row).index(-1)]))
+    return pairs
+
+
+def _group_stats(values=None, list_group_idx=None):
+    """NaN aware sufficient statistics for each group (computed once per group)
+    In: a) values: array (proteins x samples) with lfq values
+        b) list_group_idx: list with array of sample (column) indices for each group
+    Out:a) n: array (proteins x groups) with number of valid values
+        b) mean: array (proteins x groups) with mean of valid values
+        c) var: array (proteins x groups) with variance (ddof=1) of valid values"""
+    shape = (len(values), len(list_group_idx))
+    n, mean, var = np.zeros(shape), np.full(shape, np.nan), np.full(shape, np.nan)
+    for i, group_idx in enumerate(list_group_idx):
+        group_values = values[:, group_idx].astype(np.float64, copy=False)
+        valid = ~np.isnan(group_values)
+        n[:, i] = valid.sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean[:, i] = np.where(valid, group_values, 0).sum(axis=1) / n[:, i]
+            ss = np.where(valid, (group_values - mean[:, [i]]) ** 2, 0).sum(axis=1)
+            var[:, i] = ss / (n[:, i] - 1)
+    var[n < 2] = np.nan
+    return n, mean, var
+
+
+def _merge_moments(n_a=None, mean_a=None, m2_a=None, n_b=None, mean_b=None, m2_b=None):
+    """Merge count, mean, and sum of squared deviations of two partitions (Chan et al., 1979)"""
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.where(n > 0, mean_a + delta * n_b / n, 0)
+        m2 = m2_a + m2_b + np.where(n > 0, delta ** 2 * n_a * n_b / n, 0)
+    return n, mean, m2
+
+
+def _check_valid_mode(mode=None):
+    """Check mode of valid value filtering"""
+    modes = ["each", "any", "total"]
+    if mode not in modes:
+        raise ValueError("'mode' ({}) should be one of following: {}".format(mode, modes))
+
+
+def _valid_counts(values=None, list_group_idx=None):
+    """Number of valid values (proteins x groups) for each group from one boolean mask of valid values"""
+    valid = ~np.isnan(values)
+    counts = np.empty((len(values), len(list_group_idx)), dtype=int)
+    for i, group_idx in enumerate(list_group_idx):
+        counts[:, i] = valid[:, group_idx].sum(axis=1)
+    return counts
+
+
+def _min_counts(min_valid=None, n_samples=None):
+    """Minimum number of valid values given as fraction (< 1) or absolute number for each number of samples"""
+    n_samples = np.asarray(n_samples)
+    if min_valid < 1:
+        return np.ceil(min_valid * n_samples - 1e-9).astype(int)
+    return np.full(n_samples.shape, int(min_valid))
+
+
 # II Main Functions
-def get_dict_groups(df=None, lfq_str=ut.STR_LOG2_INTENSITY, groups=None):
-    """Get dict with groups from df based on lfq_str and given groups"""
-    _check_lfq_str(df=df, lfq_str=lfq_str, groups=groups)
+def get_dict_groups(df=None, lfq_str=ut.STR_LOG2_INTENSITY, groups=None, cols=None):
+    """Get dict with groups from df (or list of column names 'cols') based on lfq_str and given groups"""
+    if cols is None:
+        cols = list(df)
+    _check_lfq_str(cols=cols, lfq_str=lfq_str, groups=groups)
     dict_col_group = {}
-    for col in list(df):
+    for col in cols:
         if lfq_str in col:
             for group in groups:
                 if group in col:
@@ -55,10 +166,14 @@ def get_dict_groups(df=None, lfq_str=ut.STR_LOG2_INTENSITY, groups=None):
 
 
 class PerseusBase:
-    """Base class for Perseus Pipeline"""
+    """Base class for Perseus Pipeline
+
+    Data is kept as immutable core: a contiguous (proteins x samples) matrix with intensities in input scale,
+    group indices of samples, and a separate annotation table (ACC, Gene_Name). Log2 or linear views of the
+    matrix are computed lazily and cached (read-only). DataFrames are just created as output."""
 
     def __init__(self, df=None, dict_col_group=None, col_acc="Protein ID", col_genes="Gene Names",
-                 pre_filtered=False, groups=None):
+                 pre_filtered=False, groups=None, dtype=np.float64):
         _check_df(df=df, col_acc=col_acc, col_genes=col_genes)
         dict_group_cols = {dict_col_group[key]: [] for key in dict_col_group}
         for key in dict_col_group:
@@ -72,39 +187,133 @@ class PerseusBase:
             self.list_groups = groups
         # list cols
         self.list_col_lfq = list(self.dict_col_group.keys())
-        list_col = [col_acc, col_genes] + self.list_col_lfq
         # Pre filter df
         if pre_filtered:
             df = _pre_filter(df=df)
-        df_modified = df[list_col].copy()
-        df_modified.rename({col_acc: "ACC", col_genes: "Gene_Name"}, axis=1, inplace=True)
-        self._df = df_modified
+        # Core: intensity matrix, group index for each sample, and annotation
+        self._values = np.ascontiguousarray(df[self.list_col_lfq].to_numpy(dtype=dtype))
+        self._values.flags.writeable = False
+        dict_group_i = {group: i for i, group in enumerate(self.list_groups)}
+        self._group_idx = np.array([dict_group_i.get(dict_col_group[col], -1) for col in self.list_col_lfq],
+                                   dtype=int)
+        self._annotation = df[[col_acc, col_genes]].rename({col_acc: "ACC", col_genes: "Gene_Name"}, axis=1)
+        self._index = df.index
+        # Column position for all names of intensity columns (log2 and normal scale)
+        self._dict_col_pos = {}
+        for i, col in enumerate(self.list_col_lfq):
+            for name in [col, _col_log2(col), _col_linear(col)]:
+                self._dict_col_pos.setdefault(name, i)
+        self._views = {}
+        self._stats_cache = None
 
-    def get_df_lfq(self, log2_in=True, log2_out=True):
-        """Get df with just LFQ values in log2 or normal scale"""
-        df_lfq = self._df[self.list_col_lfq]
-        adjust = False
-        if log2_out:
-            if not log2_in:
-                f = lambda x: "log2 {}".format(x)
-                df_lfq = np.log2(df_lfq.replace(0, np.nan))
-                adjust = True
-        else:
-            if log2_in:
-                f = lambda x: x.replace("log2 ", "")
-                df_lfq = 2 ** df_lfq
-                adjust = True
-        if adjust:
-            self.list_col_lfq = [f(x) for x in self.list_col_lfq]
-            self.dict_col_group = {col: f(self.dict_col_group[col]) for col in self.dict_col_group}
-            self.dict_group_cols = {group: [f(x) for x in self.dict_group_cols[group]]
-                                    for group in self.dict_group_cols}
-        df_lfq.columns = self.list_col_lfq
+    def get_values(self, log2_in=True, log2_out=True):
+        """Get (read-only) core matrix (proteins x samples) in log2 or normal scale (computed once and cached)"""
+        if log2_in == log2_out:
+            return self._values
+        key = (log2_in, log2_out)
+        if key not in self._views:
+            if log2_out:
+                with np.errstate(divide="ignore"):
+                    values = np.log2(np.where(self._values == 0, np.nan, self._values))
+            else:
+                values = np.power(2, self._values)
+            values.flags.writeable = False
+            self._views[key] = values
+        return self._views[key]
+
+    def _get_df_lfq(self, log2_in=True, log2_out=True):
+        """Get df with just LFQ values in log2 or normal scale as read-only view of core matrix (internal use)"""
+        values = self.get_values(log2_in=log2_in, log2_out=log2_out)
+        f = lambda x: x
+        if log2_out and not log2_in:
+            f = _col_log2
+        elif log2_in and not log2_out:
+            f = _col_linear
+        df_lfq = pd.DataFrame(values, columns=[f(x) for x in self.list_col_lfq], index=self._index, copy=False)
         return df_lfq
 
+    def get_df_lfq(self, log2_in=True, log2_out=True):
+        """Get df with just LFQ values in log2 or normal scale (writeable copy of core matrix)"""
+        return self._get_df_lfq(log2_in=log2_in, log2_out=log2_out).copy()
+
     def add_acc_gene(self, df=None):
         """Add UniProt accession number and gene name to df based on index"""
-        df_acc_gene = self._df[["ACC", "Gene_Name"]]
-        df_out = df_acc_gene.join(df, how="right")
+        df_out = self._annotation.join(df, how="right")
         return df_out
 
+    def get_contrasts(self, contrasts=None):
+        """Get list of group pairs (a, b) to compare (a/b)
+        In: a) contrasts: Group comparisons given by one of following:
+                None: all unordered pairs of list_groups
+                str: reference group (e.g., control) compared with each other group (group/reference)
+                list: pairs of groups [(a, b), ...]
+                pd.DataFrame or array: contrast matrix (contrasts x groups) with 1 for a and -1 for b
+        Out:a) pairs: list of group pairs (a, b)"""
+        if contrasts is None:
+            return _group_pairs(self.list_groups)
+        if isinstance(contrasts, str):
+            if contrasts not in self.list_groups:
+                raise ValueError("Reference group ({}) should be one of following: {}".format(contrasts,
+                                                                                            self.list_groups))
+            return [(group, contrasts) for group in self.list_groups if group != contrasts]
+        if isinstance(contrasts, (pd.DataFrame, np.ndarray)):
+            pairs = _contrast_matrix_pairs(contrasts=contrasts, groups=self.list_groups)
+        else:
+            pairs = [tuple(contrast) for contrast in contrasts]
+        _check_contrast_groups(contrasts=pairs, groups=self.list_groups)
+        return pairs
+
+    def get_list_group_idx(self, cols=None):
+        """Get list with array of column indices (positions in cols) for each group in list_groups.
+        Intensity columns can be given in log2 or normal scale names (see get_df_lfq)"""
+        if cols is None:
+            pos = np.arange(len(self.list_col_lfq))
+        else:
+            dict_pos_i = {self._dict_col_pos[col]: i for i, col in enumerate(cols) if col in self._dict_col_pos}
+            pos = np.array([dict_pos_i.get(j, -1) for j in range(len(self.list_col_lfq))], dtype=int)
+        list_group_idx = [pos[(self._group_idx == i) & (pos >= 0)] for i in range(len(self.list_groups))]
+        return list_group_idx
+
+    def get_lfq_values(self, df_lfq=None):
+        """Get values, list of group column indices, and index of df_lfq (core matrix in log2 scale if None)"""
+        if df_lfq is None:
+            return self.get_values(), self.get_list_group_idx(), self._index
+        return df_lfq.to_numpy(dtype=np.float64), self.get_list_group_idx(cols=list(df_lfq)), df_lfq.index
+
+    def get_group_stats(self, df_lfq=None):
+        """Get NaN aware valid count, mean, and variance (each proteins x groups) for groups in list_groups.
+        If df_lfq is None, statistics are computed from core matrix in log2 scale (assuming log2 input).
+        Just statistics of the (read-only) core matrix are cached, since given df_lfq can be modified in place"""
+        if df_lfq is None and self._stats_cache is not None:
+            return self._stats_cache
+        values, list_group_idx, _ = self.get_lfq_values(df_lfq=df_lfq)
+        stats = _group_stats(values=values, list_group_idx=list_group_idx)
+        if df_lfq is None:
+            self._stats_cache = stats
+        return stats
+
+    def get_valid_rows(self, df_lfq=None, min_valid=0.7, mode="any"):
+        """Get positions of rows (proteins) with sufficient number of valid values (index map to input rows)
+        In: a) df_lfq: df with lfq values (core matrix if None)
+            b) min_valid: minimum number of valid values given as fraction of samples (< 1) or absolute number
+            c) mode: {'each', 'any', 'total'} minimum valid values in each group, in any group, or in total
+        Out:a) rows: array with positions of rows fulfilling filter criteria"""
+        _check_valid_mode(mode=mode)
+        values, list_group_idx, _ = self.get_lfq_values(df_lfq=df_lfq)
+        counts = _valid_counts(values=values, list_group_idx=list_group_idx)
+        n_samples = np.array([len(group_idx) for group_idx in list_group_idx])
+        if mode == "total":
+            mask = counts.sum(axis=1) >= _min_counts(min_valid=min_valid, n_samples=n_samples.sum())
+        elif mode == "each":
+            mask = (counts >= _min_counts(min_valid=min_valid, n_samples=n_samples)).all(axis=1)
+        else:
+            mask = (counts >= _min_counts(min_valid=min_valid, n_samples=n_samples)).any(axis=1)
+        return np.flatnonzero(mask)
+
+    def filter_valid_values(self, df_lfq=None, min_valid=0.7, mode="any"):
+        """Filter rows based on valid values as in Perseus (see get_valid_rows). Index labels of df_lfq are kept
+        to map filtered rows back to original table (e.g., by add_acc_gene)"""
+        if df_lfq is None:
+            df_lfq = self._get_df_lfq()
+        rows = self.get_valid_rows(df_lfq=df_lfq, min_valid=min_valid, mode=mode)
+        return df_lfq.iloc[rows]
@@ -0,0 +1,137 @@
+"""
+This is a script for running the Perseus pipeline for many datasets (e.g., PRIDE projects) in a process pool
+"""
+import os
+import time
+import traceback
+import pandas as pd
+from functools import partial
+from multiprocessing import Pool
+
+from perseuspy.per_io import read_lfq
+from perseuspy.perseus_pipe import PerseusPipeline
+
+
+# Settings
+FILE_TIMINGS = "timings.tsv"
+LIST_COL_TIMINGS = ["name", "status", "n_proteins", "time_read", "time_run", "time_write", "time_total", "error",
+                     "traceback"]
+
+
+# I Helper Functions
+def _check_specs(list_specs=None):
+    """Check if each dataset specification has file and groups and if dataset names are unique"""
+    names = []
+    for spec in list_specs:
+        for key in ["file", "groups"]:
+            if key not in spec:
+                raise ValueError("Each dataset specification should contain '{}' ({})".format(key, spec))
+        names.append(_dataset_name(spec=spec))
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError("Dataset names should be unique (duplicates: {}). Set 'name' in specification"
+                         .format(duplicates))
+
+
+def _dataset_name(spec=None):
+    """Name of dataset (by default name of input file without extension)"""
+    return spec.get("name", os.path.splitext(os.path.basename(spec["file"]))[0])
+
+
+def _file_out(out_dir=None, name=None):
+    """Result file of dataset"""
+    return os.path.join(out_dir, "{}.tsv".format(name))
+
+
+def _run_dataset(spec=None, out_dir=None, kwargs_read=None, kwargs_run=None):
+    """Run pipeline (reading -> filtering -> imputation -> tests) for one dataset and write result file.
+    Result is first written to temporary file and then renamed, so that just finished results exist"""
+    name = _dataset_name(spec=spec)
+    kwargs_read = {**(kwargs_read or {}), **spec.get("kwargs_read", {})}
+    kwargs_run = {**(kwargs_run or {}), **spec.get("kwargs_run", {})}
+    dict_timing = dict(name=name, status="done", n_proteins=None, error=None, traceback=None)
+    t0 = time.perf_counter()
+    try:
+        df, dict_col_group = read_lfq(file=spec["file"], groups=spec["groups"], log2=True, **kwargs_read)
+        t1 = time.perf_counter()
+        pp = PerseusPipeline(df=df, dict_col_group=dict_col_group, col_acc=list(df)[0], col_genes=list(df)[1],
+                             groups=spec["groups"])
+        df_ratio_pval = pp.run(log2_in=True, **kwargs_run)
+        t2 = time.perf_counter()
+        file_out = _file_out(out_dir=out_dir, name=name)
+        df_ratio_pval.to_csv(file_out + ".tmp", sep="\t", index=False)
+        os.replace(file_out + ".tmp", file_out)
+        t3 = time.perf_counter()
+        dict_timing.update(dict(n_proteins=len(df_ratio_pval), time_read=t1 - t0, time_run=t2 - t1,
+                                time_write=t3 - t2))
+    except Exception as e:
+        dict_timing.update(dict(status="failed", error="{}: {}".format(type(e).__name__, e),
+                                traceback=traceback.format_exc()))
+    dict_timing["time_total"] = time.perf_counter() - t0
+    return dict_timing
+
+
+def _append_timing(out_dir=None, dict_timing=None):
+    """Append timing of dataset to timing report (written after each finished dataset)"""
+    file = os.path.join(out_dir, FILE_TIMINGS)
+    df = pd.DataFrame([dict_timing], columns=LIST_COL_TIMINGS)
+    df.to_csv(file, sep="\t", index=False, mode="a", header=not os.path.isfile(file))
+
+
+# II Main Functions
+def run_batch(list_specs=None, out_dir=None, n_jobs=1, max_tasks_per_child=1, resume=True, kwargs_read=None,
+              kwargs_run=None, verbose=True):
+    """Run Perseus pipeline for many datasets in a process pool
+
+    Parameters
+    ----------
+    list_specs: {list} list with dict for each dataset containing 'file' and 'groups' and optionally 'name'
+        (default: file name), 'kwargs_read' and 'kwargs_run' (dataset specific arguments)
+    out_dir: {str} output folder. Result of each dataset is written as '{name}.tsv' directly when finished
+        and timings are appended to 'timings.tsv'
+    n_jobs: {int} default 1. Number of processes (datasets run in parallel)
+    max_tasks_per_child: {int} default 1. Number of datasets processed by a worker process before it is
+        replaced, which bounds memory of workers (None to keep workers)
+    resume: {bool} default True. Whether datasets with existing result file are skipped
+    kwargs_read: {dict} default None. Arguments for read_lfq (e.g., fmt, pre_filtered, cache_dir)
+    kwargs_run: {dict} default None. Arguments for PerseusPipeline.run (e.g., min_valid, method, impute)
+    verbose: {bool} default True. Whether progress should be printed
+
+    Returns
+    -------
+    df_timings: pd.DataFrame with status, number of proteins, timings (seconds), and error with traceback
+        of run datasets
+
+    Notes
+    -----
+    Intensities are log2 transformed while reading. Failing datasets are reported in df_timings (status
+    'failed') without stopping the batch. Their tracebacks are printed only if verbose.
+    """
+    _check_specs(list_specs=list_specs)
+    os.makedirs(out_dir, exist_ok=True)
+    if resume:
+        list_specs = [spec for spec in list_specs
+                      if not os.path.isfile(_file_out(out_dir=out_dir, name=_dataset_name(spec=spec)))]
+    list_timings = []
+    args = dict(out_dir=out_dir, kwargs_read=kwargs_read, kwargs_run=kwargs_run)
+    if n_jobs == 1:
+        results = (_run_dataset(spec=spec, **args) for spec in list_specs)
+    else:
+        # multiprocessing.Pool replaces workers after maxtasksperchild tasks (for all Python versions)
+        pool = Pool(processes=n_jobs, maxtasksperchild=max_tasks_per_child)
+        results = pool.imap_unordered(partial(_run_dataset, **args), list_specs)
+    try:
+        for dict_timing in results:
+            _append_timing(out_dir=out_dir, dict_timing=dict_timing)
+            list_timings.append(dict_timing)
+            if verbose:
+                print("{} ({}): {:.2f} s".format(dict_timing["name"], dict_timing["status"],
+                                                dict_timing["time_total"]))
+                if dict_timing["traceback"] is not None:
+                    print(dict_timing["traceback"])
+    finally:
+        if n_jobs != 1:
+            pool.terminate()
+            pool.join()
+    df_timings = pd.DataFrame(list_timings, columns=LIST_COL_TIMINGS)
+    return df_timings
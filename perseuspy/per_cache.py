@@ -0,0 +1,141 @@
+"""
+This is a script for an on-disk cache of parsed LFQ matrices (keyed by file content and reading parameters)
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+
+
+# Settings
+FILE_HASH_INDEX = "hash_index.json"
+FILE_META = "meta.json"
+
+
+# I Helper Functions
+def _file_hash(file=None, block_size=2 ** 20):
+    """Get SHA-256 hash of file content"""
+    hasher = hashlib.sha256()
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def _folder_size(folder=None):
+    """Get size of all files in folder in bytes"""
+    size = 0
+    for root, _, files in os.walk(folder):
+        size += sum(os.path.getsize(os.path.join(root, file)) for file in files)
+    return size
+
+
+def _read_json(file=None):
+    """Read dict from json file (empty dict if file is missing or unreadable, e.g., written concurrently)"""
+    try:
+        with open(file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_json(file=None, data=None):
+    """Write json file atomically (temporary file in same folder renamed to file)"""
+    fd, file_tmp = tempfile.mkstemp(dir=os.path.dirname(file), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(file_tmp, file)
+    except BaseException:
+        os.remove(file_tmp)
+        raise
+
+
+# II Main Functions
+class LFQCache:
+    """Cache for cleaned, group annotated LFQ matrices stored as memory-mappable .npy files with metadata"""
+    def __init__(self, folder=None, max_size=2 * 1024 ** 3):
+        """
+        Parameters
+        ----------
+        folder: {str} folder of cache (created if not existing)
+        max_size: {int} default 2 GB. Maximum size of cache in bytes. Least recently used entries are evicted
+        """
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.max_size = max_size
+
+    def get_content_hash(self, file=None):
+        """Get content hash of file, reused from index if path, size and modification time are unchanged"""
+        file_index = os.path.join(self.folder, FILE_HASH_INDEX)
+        stat = os.stat(file)
+        file_id = "{}|{}|{}".format(os.path.abspath(file), stat.st_size, stat.st_mtime_ns)
+        dict_hash = _read_json(file=file_index)
+        if file_id not in dict_hash:
+            content_hash = _file_hash(file=file)
+            # Re-read index to keep entries added concurrently (e.g., by workers of run_batch)
+            dict_hash = _read_json(file=file_index)
+            dict_hash[file_id] = content_hash
+            _write_json(file=file_index, data=dict_hash)
+        return dict_hash[file_id]
+
+    def get_key(self, file=None, **params):
+        """Get cache key from content hash of file and parameters (e.g., groups, dict_col_group, filters)"""
+        content = self.get_content_hash(file=file) + json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def load(self, key=None):
+        """Load df (intensities memory-mapped without copy) and dict_col_group for key (None if not cached)"""
+        folder_key = os.path.join(self.folder, key)
+        file_meta = os.path.join(folder_key, FILE_META)
+        if not os.path.isfile(file_meta):
+            return None
+        with open(file_meta) as f:
+            meta = json.load(f)
+        values = np.load(os.path.join(folder_key, "values.npy"), mmap_mode="r")
+        acc = np.load(os.path.join(folder_key, "acc.npy"))
+        genes = pd.Categorical.from_codes(np.load(os.path.join(folder_key, "gene_codes.npy")),
+                                          categories=np.load(os.path.join(folder_key, "gene_categories.npy")))
+        df = pd.DataFrame(values, columns=meta["cols"], copy=False)
+        df.insert(0, meta["col_genes"], genes)
+        df.insert(0, meta["col_acc"], acc.astype(object))
+        os.utime(file_meta)     # Mark as recently used
+        return df, meta["dict_col_group"]
+
+    def save(self, key=None, df=None, dict_col_group=None, col_acc=None, col_genes=None):
+        """Save df with col_acc, col_genes and intensity columns of dict_col_group for key"""
+        cols = list(dict_col_group)
+        genes = pd.Categorical(df[col_genes])
+        folder_tmp = tempfile.mkdtemp(dir=self.folder)
+        np.save(os.path.join(folder_tmp, "values.npy"), np.ascontiguousarray(df[cols].to_numpy()))
+        np.save(os.path.join(folder_tmp, "acc.npy"), df[col_acc].to_numpy().astype(str))
+        np.save(os.path.join(folder_tmp, "gene_codes.npy"), genes.codes)
+        np.save(os.path.join(folder_tmp, "gene_categories.npy"), np.asarray(genes.categories).astype(str))
+        meta = dict(cols=cols, dict_col_group=dict_col_group, col_acc=col_acc, col_genes=col_genes,
+                    created=time.time())
+        with open(os.path.join(folder_tmp, FILE_META), "w") as f:
+            json.dump(meta, f)
+        folder_key = os.path.join(self.folder, key)
+        try:
+            os.replace(folder_tmp, folder_key)
+        except OSError:
+            # Entry already saved (e.g., concurrently by another process)
+            shutil.rmtree(folder_tmp)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until cache size is below max_size"""
+        list_keys = [key for key in os.listdir(self.folder)
+                     if os.path.isfile(os.path.join(self.folder, key, FILE_META))]
+        dict_size = {key: _folder_size(os.path.join(self.folder, key)) for key in list_keys}
+        list_keys.sort(key=lambda key: os.path.getmtime(os.path.join(self.folder, key, FILE_META)))
+        total_size = sum(dict_size.values())
+        for key in list_keys:
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(os.path.join(self.folder, key))
+            total_size -= dict_size[key]
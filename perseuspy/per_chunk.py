@@ -0,0 +1,162 @@
+"""
+This is a script for out-of-core (chunked) execution of Perseus pipeline for large (e.g., precursor level) tables
+
+Row wise stages (log2 transformation, filtering, group means, ratios, t tests) are performed for streamed row
+chunks and appended to an output file. Just global stages require further passes over the data:
+    1. Parameters of normal distribution imputation (column mean and standard deviation of valid values)
+    2. Multiple testing correction of p values
+"""
+import os
+import numpy as np
+import pandas as pd
+
+from perseuspy.per_base import _merge_moments
+from perseuspy.per_io import iter_lfq_chunks
+from perseuspy.per_imput import _impute_normal
+from perseuspy.per_test import _check_p_correction, _correct_p_val
+from perseuspy.perseus_pipe import PerseusPipeline, check_log2_scale_of_lfq
+
+
+# I Helper Functions
+def _check_chunk_impute(impute=None):
+    """Check imputation method for chunked execution (kNN imputation requires whole table)"""
+    if impute not in [None, "normal"]:
+        raise ValueError("'impute' ({}) should be None or 'normal' for chunked execution".format(impute))
+
+
+def _column_moments(values=None):
+    """NaN aware count, mean, and sum of squared deviations for each column"""
+    valid = ~np.isnan(values)
+    n = valid.sum(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.where(n > 0, np.where(valid, values, 0).sum(axis=0) / n, 0)
+    m2 = np.where(valid, (values - mean) ** 2, 0).sum(axis=0)
+    return n, mean, m2
+
+
+def _chunk_pipeline(df_chunk=None, dict_col_group=None, groups=None, log2_max=100, min_valid=None,
+                    valid_mode="any"):
+    """Get pipeline and (filtered) df_lfq in log2 scale for chunk"""
+    col_acc, col_genes = list(df_chunk)[0:2]
+    if len(df_chunk) == 0:
+        return None, df_chunk[list(dict_col_group)]
+    # Rows are already filtered while reading (iter_lfq_chunks), so filtering of pipeline is skipped
+    # (PerseusBase filters rows just for pre_filtered=True)
+    dtype = np.result_type(*df_chunk[list(dict_col_group)].dtypes)
+    pp = PerseusPipeline(df=df_chunk, dict_col_group=dict_col_group, col_acc=col_acc, col_genes=col_genes,
+                         pre_filtered=False, groups=groups, dtype=dtype)
+    df_lfq = pp._get_df_lfq(log2_in=True)
+    check_log2_scale_of_lfq(df_lfq=df_lfq, th_max_log2=log2_max)
+    if min_valid is not None:
+        df_lfq = pp.filter_valid_values(df_lfq=df_lfq, min_valid=min_valid, mode=valid_mode)
+    return pp, df_lfq
+
+
+def _impute_params(chunks=None, kwargs_chunk=None, mode="column"):
+    """First pass: global mean and standard deviation of valid values for normal distribution imputation"""
+    if mode not in ["column", "total"]:
+        raise ValueError("'mode' ({}) should be one of following: ['column', 'total']".format(mode))
+    n = mean = m2 = 0
+    for df_chunk in chunks:
+        _, df_lfq = _chunk_pipeline(df_chunk=df_chunk, **kwargs_chunk)
+        n, mean, m2 = _merge_moments(n, mean, m2, *_column_moments(values=df_lfq.to_numpy(dtype=np.float64)))
+    if mode == "total":
+        # Merge moments of all columns
+        n_total = n.sum()
+        mean_total = np.sum(n * mean) / n_total
+        m2_total = m2.sum() + np.sum(n * (mean - mean_total) ** 2)
+        return np.full(len(n), mean_total), np.full(len(n), np.sqrt(m2_total / n_total))
+    return mean, np.sqrt(m2 / n)
+
+
+# II Main Functions
+def run_chunked(file=None, groups=None, file_out=None, fmt="maxquant", log2_in=False, log2_max=100, contrasts=None,
+                method=None, impute=None, kwargs_impute=None, min_valid=None, valid_mode="any", chunksize=500000,
+                kwargs_read=None):
+    """Run Perseus pipeline (PerseusPipeline.run) out-of-core for streamed row chunks of export file
+
+    Parameters
+    ----------
+    file: {str} path to export file (see read_lfq)
+    groups: {list} list with group names {strings} contained in names of intensity columns
+    file_out: {str} path of output file (tab separated) with ACC, Gene_Name, log2 ratio and -log10 p value
+        columns (as PerseusPipeline.run)
+    fmt: {str} default "maxquant". Format of export {"maxquant", "diann", "spectronaut"} (see read_lfq)
+    log2_in: {bool} default False. Whether intensities in file are log2 transformed
+    log2_max: {int} default 100. Maximum value to decide if values are log scaled or normal scaled
+    contrasts: Group comparisons (see PerseusBase.get_contrasts). By default, all pairs of groups are compared.
+    method: {str} default None. Correction method for p values applied globally over all chunks
+        {None, "bonferroni", "sidak", "holm", "hommel", "fdr_bh", "fdr_by"}
+    impute: {str} default None. Imputation method {None, "normal"}, where distribution parameters are computed
+        globally over all chunks
+    kwargs_impute: {dict} default None. Arguments for normal distribution imputation (width, shift, mode, seed)
+    min_valid: {float, int} default None. Minimum number of valid values (see PerseusBase.get_valid_rows)
+    valid_mode: {str} default "any". Mode of valid value filtering {"each", "any", "total"}
+    chunksize: {int} default 500000. Number of rows of each chunk
+    kwargs_read: {dict} default None. Further arguments for reading (see iter_lfq_chunks)
+
+    Returns
+    -------
+    n_rows: number of rows written to file_out
+
+    Notes
+    -----
+    Memory is bounded by chunk size and raw p values of all rows (needed for correction). Random draws of
+    imputation depend on chunk size (one random stream per chunk spawned from seed).
+    """
+    _check_chunk_impute(impute=impute)
+    _check_p_correction(method=method)
+    kwargs_impute = dict(kwargs_impute or {})
+    seed = kwargs_impute.pop("seed", None)
+    kwargs_reader = dict(file=file, groups=groups, fmt=fmt, log2=not log2_in, chunksize=chunksize,
+                         **(kwargs_read or {}))
+    chunks, dict_col_group = iter_lfq_chunks(**kwargs_reader)
+    kwargs_chunk = dict(dict_col_group=dict_col_group, groups=groups, log2_max=log2_max, min_valid=min_valid,
+                        valid_mode=valid_mode)
+    if impute is not None:
+        mean, std = _impute_params(chunks=chunks, kwargs_chunk=kwargs_chunk,
+                                   mode=kwargs_impute.get("mode", "column"))
+        chunks, _ = iter_lfq_chunks(**kwargs_reader)
+    # Pass over chunks for row wise stages (raw p values written first)
+    file_raw = file_out + ".raw"
+    if os.path.isfile(file_raw):
+        os.remove(file_raw)
+    seed_seq = np.random.SeedSequence(seed)
+    list_p_vals = []
+    cols_pval = None
+    for df_chunk in chunks:
+        pp, df_lfq = _chunk_pipeline(df_chunk=df_chunk, **kwargs_chunk)
+        if len(df_lfq) == 0:
+            continue
+        if impute is not None:
+            rng = np.random.default_rng(seed_seq.spawn(1)[0])
+            values = _impute_normal(values=df_lfq.to_numpy(copy=True), rng=rng, mean=mean, std=std, **kwargs_impute)
+            df_lfq = pd.DataFrame(values, columns=df_lfq.columns, index=df_lfq.index)
+        df_lfq_mean = pp.get_df_lfq_mean(df_lfq=df_lfq, remove_nan=False)
+        df_ratio = pp.get_df_ratio(df_lfq_mean=df_lfq_mean, contrasts=contrasts)
+        df_pval = pp.ttest(df_lfq=df_lfq, contrasts=contrasts, log10_out=False)
+        list_p_vals.append(df_pval.to_numpy())
+        df_pval = -np.log10(df_pval)
+        df_pval.columns = cols_pval = ["-log10 {}".format(col) for col in df_pval.columns]
+        df_ratio_pval = pp.add_acc_gene(df_ratio.join(df_pval))
+        df_ratio_pval.to_csv(file_raw, sep="\t", index=False, mode="a", header=not os.path.isfile(file_raw))
+    if not list_p_vals:
+        raise ValueError("No rows of '{}' left after filtering".format(file))
+    n_rows = sum(len(p_vals) for p_vals in list_p_vals)
+    if method is None:
+        os.replace(file_raw, file_out)
+        return n_rows
+    # Global correction and second pass to replace p values
+    p_vals = _correct_p_val(p_vals=np.concatenate(list_p_vals), method=method)
+    del list_p_vals
+    if os.path.isfile(file_out):
+        os.remove(file_out)
+    start = 0
+    # Raw file is read as text, so that all columns besides replaced p values are written unchanged
+    # (e.g., gene names like 'NA' or numeric looking protein ids)
+    for df_chunk in pd.read_csv(file_raw, sep="\t", chunksize=chunksize, dtype=str, keep_default_na=False):
+        df_chunk[cols_pval] = -np.log10(p_vals[start:start + len(df_chunk)])
+        start += len(df_chunk)
+        df_chunk.to_csv(file_out, sep="\t", index=False, mode="a", header=not os.path.isfile(file_out))
+    os.remove(file_raw)
+    return n_rows
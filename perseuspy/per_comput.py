@@ -14,13 +14,13 @@ from perseuspy.per_base import PerseusBase
 def _inverse_log(values=None, base=2):
     """Inverse logarithmize values for given base"""
     # 2^y=x, log2(x) = y, where x is ratio and y the log2 ratio
-    de_log_val = [base ** val for val in values]
+    de_log_val = np.power(base, values)
     return de_log_val
 
 
 def _log(values=None, base=2):
     """Calculate log values"""
-    log_val = [math.log(val, base) for val in values]
+    log_val = np.log(values) / math.log(base)
     return log_val
 
 
@@ -57,11 +57,10 @@ class PerseusComputations(PerseusBase):
             lfq_str = ut.STR_LOG2_INTENSITY
         else:
             lfq_str = ut.STR_INTENSITY
+        values, list_group_idx, index = self.get_lfq_values(df_lfq=df_lfq)
         dict_avg = {}
-        for group in self.dict_group_cols:
-            group_col = self.dict_group_cols[group]
-            print(self.dict_group_cols)
-            df_group = df_lfq[group_col]
+        for group, group_idx in zip(self.list_groups, list_group_idx):
+            df_group = pd.DataFrame(values[:, group_idx], index=index)
             # TODO invert log2 values
             # Calculate mean without 0
             group_mean = df_group.replace(0, np.nan).mean(axis=1, skipna=True).replace(np.nan, 0)
@@ -72,28 +71,23 @@ class PerseusComputations(PerseusBase):
             df_lfq_mean = df_lfq_mean[~df_lfq_mean.isna().any(axis=1)]
         return df_lfq_mean
 
-    def get_df_ratio(self, df_lfq_mean=None, log2_in=True, log2_out=True):
+    def get_df_ratio(self, df_lfq_mean=None, log2_in=True, log2_out=True, contrasts=None):
         """Get df with ratios for group comparison of mean lfq values
         In: a) df_lfq_mean: df with mean lfq values for each group
             b) log2_in: boolean to indicate if df_lfq_mean in log2 scale
             c) log2_out: boolean to indicate if return df in log2 scale
+            d) contrasts: group comparisons (see PerseusBase.get_contrasts), by default all pairs
         Out:a) df_ratio: df with ratios for individual group comparison"""
         if log2_out:
             ratio_str = ut.STR_LOG2_RATIO
         else:
             ratio_str = ut.STR_RATIO
-        dict_group_col = dict(zip(self.list_groups, list(df_lfq_mean)))
-        dict_ratio = {}
-        ratio_pairs = []
-        for a in self.list_groups:
-            for b in self.list_groups:
-                if a != b and {a, b} not in ratio_pairs:
-                    df_group_a = df_lfq_mean[dict_group_col[a]]
-                    df_group_b = df_lfq_mean[dict_group_col[b]]
-                    ratio = _ratio(df_group_a, df_group_b,
-                                   log2_in=log2_in,
-                                   log2_out=log2_out)
-                    ratio_pairs.append({a, b})
-                    dict_ratio[ratio_str + " ({}/{})".format(a, b)] = ratio
-        df_ratio = pd.DataFrame(dict_ratio, index=df_lfq_mean.index)     # Set index of data frame
+        dict_group_i = dict(zip(self.list_groups, range(len(self.list_groups))))
+        pairs = self.get_contrasts(contrasts=contrasts)
+        idx_a = [dict_group_i[a] for a, b in pairs]
+        idx_b = [dict_group_i[b] for a, b in pairs]
+        values = df_lfq_mean.to_numpy()
+        ratio = _ratio(values[:, idx_a], values[:, idx_b], log2_in=log2_in, log2_out=log2_out)
+        cols = [ratio_str + " ({}/{})".format(a, b) for a, b in pairs]
+        df_ratio = pd.DataFrame(ratio, columns=cols, index=df_lfq_mean.index)     # Set index of data frame
         return df_ratio
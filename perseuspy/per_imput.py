@@ -23,13 +23,103 @@ Notes
     PXD006401
     PXD009933
 """
+import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 
 import perseuspy._utils as ut
 from perseuspy.per_base import PerseusBase
 
 
 # I Helper Functions
+def _check_impute_method(method=None):
+    """Check imputation method"""
+    impute_methods = ["normal", "knn"]
+    if method not in impute_methods:
+        raise ValueError("'method' ({}) should be one of following: {}".format(method, impute_methods))
+
+
+def _get_writeable_values(df=None, dtype=None, inplace=False):
+    """Get values of df as array, shared with df if inplace and possible"""
+    values = df.to_numpy(dtype=dtype, copy=not inplace)
+    if not values.flags.writeable:
+        values = values.copy()
+    return values
+
+
+def _impute_normal(values=None, width=0.3, shift=1.8, mode="column", rng=None, mean=None, std=None):
+    """Replace missing values in place by random draws from down-shifted normal distribution
+    In: a) values: array (proteins x samples) with log2 lfq values
+        b) width: width of distribution relative to standard deviation of valid values
+        c) shift: down-shift of distribution relative to standard deviation of valid values
+        d) mode: {'column', 'total'} compute distribution for each column or for whole matrix
+        e) rng: np.random.Generator for draws
+        f) mean, std: arrays with given mean and standard deviation of valid values for each column
+            (e.g., global parameters for chunks), computed from values (depending on mode) if None
+    Out:a) values: array with imputed values"""
+    mask_nan = np.isnan(values)
+    if mean is not None and std is not None:
+        mean, std = np.asarray(mean), np.asarray(std)
+    elif mode == "column":
+        mean = np.nanmean(values, axis=0)
+        std = np.nanstd(values, axis=0)
+    elif mode == "total":
+        mean = np.full(values.shape[1], np.nanmean(values))
+        std = np.full(values.shape[1], np.nanstd(values))
+    else:
+        raise ValueError("'mode' ({}) should be one of following: ['column', 'total']".format(mode))
+    # Single vectorized draw for all missing values (row major order as boolean indexing)
+    col_idx = np.nonzero(mask_nan)[1]
+    draws = rng.standard_normal(len(col_idx), dtype=values.dtype)
+    values[mask_nan] = draws * (std * width)[col_idx] + (mean - std * shift)[col_idx]
+    return values
+
+
+def _knn_block(values=None, valid=None, rows=None, n_neighbors=10):
+    """Get nearest neighbours for given rows by NaN aware euclidean distance to all rows
+    In: a) values: array (proteins x samples) with lfq values (NaN set to 0)
+        b) valid: array (proteins x samples) with 1 for valid values and 0 for NaN
+        c) rows: array with row indices of block
+        d) n_neighbors: number of neighbours kept for each row
+    Out:a) neighbors: array (rows x n_neighbors) with row indices of neighbours sorted by distance
+        b) distances: array (rows x n_neighbors) with distances (inf if no common valid value)"""
+    values_b, valid_b = values[rows], valid[rows]
+    # Sum of squared differences over commonly valid samples: sum((x - y)^2) = x^2 + y^2 - 2xy
+    sq_diff = (values_b ** 2) @ valid.T + valid_b @ (values ** 2).T - 2 * values_b @ values.T
+    n_common = valid_b @ valid.T
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dist = np.sqrt(np.maximum(sq_diff, 0) / n_common * values.shape[1])
+    dist[n_common == 0] = np.inf
+    dist[np.arange(len(rows)), rows] = np.inf
+    n_neighbors = min(n_neighbors, values.shape[0] - 1)
+    neighbors = np.argpartition(dist, n_neighbors - 1, axis=1)[:, :n_neighbors]
+    distances = np.take_along_axis(dist, neighbors, axis=1)
+    order = np.argsort(distances, axis=1, kind="stable")
+    return np.take_along_axis(neighbors, order, axis=1), np.take_along_axis(distances, order, axis=1)
+
+
+def _impute_knn(values=None, knn_index=None, k=5):
+    """Replace missing values in place by mean of k nearest neighbours with valid value in same column
+    (column mean if no neighbour has valid value)"""
+    mask_nan = np.isnan(values)
+    col_mean = np.nanmean(values, axis=0)
+    rows_nan, cols_nan = np.nonzero(mask_nan)
+    # Rows of index are sorted (rows with missing values in ascending order)
+    pos = np.searchsorted(knn_index["rows"], rows_nan)
+    imputed = np.empty(len(rows_nan), dtype=values.dtype)
+    # Impute in chunks of missing values to bound memory (missing values x neighbours)
+    chunk_size = 100000
+    for i in range(0, len(rows_nan), chunk_size):
+        p, c = pos[i:i + chunk_size], cols_nan[i:i + chunk_size]
+        neighbors = knn_index["neighbors"][p]
+        candidates = ~mask_nan[neighbors, c[:, np.newaxis]] & np.isfinite(knn_index["distances"][p])
+        use = candidates & (np.cumsum(candidates, axis=1) <= k)
+        n_use = use.sum(axis=1)
+        sum_use = np.where(use, values[neighbors, c[:, np.newaxis]], 0).sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            imputed[i:i + chunk_size] = np.where(n_use > 0, sum_use / n_use, col_mean[c])
+    values[rows_nan, cols_nan] = imputed
+    return values
 
 
 # II Main Functions
@@ -38,5 +128,113 @@ class PerseusImputation(PerseusBase):
     def __init__(self, **kwargs):
         PerseusBase.__init__(self, **kwargs)
 
-    # TODO implement imputation methods
+    def impute(self, df_lfq=None, method="normal", **kwargs):
+        """Impute missing values in df_lfq with given method {'normal', 'knn'}"""
+        _check_impute_method(method=method)
+        if method == "normal":
+            return self.impute_normal(df_lfq=df_lfq, **kwargs)
+        return self.impute_knn(df_lfq=df_lfq, **kwargs)
+
+    @staticmethod
+    def impute_normal(df_lfq=None, width=0.3, shift=1.8, mode="column", seed=None, dtype=None, inplace=False):
+        """Replace missing values from normal distribution as performed in Perseus
+
+        Parameters
+        ----------
+        df_lfq: pd.DataFrame with lfq values (in log2 scale with values for each sample)
+        width: {float} default 0.3. Width of normal distribution relative to standard deviation of valid values
+        shift: {float} default 1.8. Down-shift of normal distribution relative to standard deviation of valid values
+        mode: {str} default "column". Compute distribution for each sample column ("column") or for whole
+            matrix ("total")
+        seed: {int} default None. Seed for random generator
+        dtype: {np.dtype} default None. Data type of values (e.g., np.float32), by default dtype of df_lfq
+        inplace: {bool} default False. Whether df_lfq should be modified in place (if possible without copy)
+
+        Returns
+        -------
+        df_lfq: pd.DataFrame with imputed lfq values
+        """
+        rng = np.random.default_rng(seed)
+        if dtype is None:
+            dtype = np.result_type(*df_lfq.dtypes)
+        values = _get_writeable_values(df=df_lfq, dtype=dtype, inplace=inplace)
+        values = _impute_normal(values=values, width=width, shift=shift, mode=mode, rng=rng)
+        if inplace:
+            if not np.shares_memory(values, df_lfq.to_numpy(copy=False)):
+                df_lfq[list(df_lfq)] = values
+            return df_lfq
+        df_imputed = pd.DataFrame(values, columns=df_lfq.columns, index=df_lfq.index)
+        return df_imputed
+
+    @staticmethod
+    def get_knn_index(df_lfq=None, n_neighbors=15, block_size=500, n_jobs=1):
+        """Get index of nearest neighbours (NaN aware euclidean distance) for proteins with missing values.
+        Distances are computed in blocks of rows, which can be computed in a thread pool.
+
+        Parameters
+        ----------
+        df_lfq: pd.DataFrame with lfq values (in log2 scale with values for each sample)
+        n_neighbors: {int} default 15. Number of neighbours kept for each protein (should exceed k of
+            impute_knn to find neighbours with valid values for each column)
+        block_size: {int} default 500. Number of proteins for which distances are computed at once
+        n_jobs: {int} default 1. Number of threads for computation of blocks
+
+        Returns
+        -------
+        knn_index: dict with 'rows' (positions of proteins with missing values), 'neighbors' (positions of
+            neighbours, rows x n_neighbors), and 'distances' (rows x n_neighbors)
+
+        Notes
+        -----
+        For n proteins and s samples, the peak memory is about 5 * block_size * n * 8 bytes per thread
+        (e.g., 200 MB for n=10,000 and block_size=500) and the index needs 16 * n_neighbors bytes per protein
+        with missing values (e.g., 2.4 MB for 10,000 proteins). Run time scales with n_missing * n * s
+        (quadratic in number of proteins).
+        """
+        values = df_lfq.to_numpy(dtype=np.float64)
+        valid = ~np.isnan(values)
+        values = np.where(valid, values, 0)
+        valid = valid.astype(np.float64)
+        rows = np.flatnonzero(valid.min(axis=1) == 0)
+        blocks = [rows[i:i + block_size] for i in range(0, len(rows), block_size)]
+        kwargs = dict(values=values, valid=valid, n_neighbors=n_neighbors)
+        if n_jobs == 1:
+            results = [_knn_block(rows=block, **kwargs) for block in blocks]
+        else:
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                results = list(executor.map(lambda block: _knn_block(rows=block, **kwargs), blocks))
+        n_neighbors = min(n_neighbors, len(values) - 1)
+        knn_index = dict(rows=rows,
+                         neighbors=np.concatenate([r[0] for r in results]) if results else
+                         np.empty((0, n_neighbors), dtype=int),
+                         distances=np.concatenate([r[1] for r in results]) if results else
+                         np.empty((0, n_neighbors)))
+        return knn_index
+
+    @staticmethod
+    def impute_knn(df_lfq=None, k=5, knn_index=None, n_neighbors=15, block_size=500, n_jobs=1, inplace=False):
+        """Replace missing values by mean of k nearest neighbour proteins with valid value in same sample
+
+        Parameters
+        ----------
+        df_lfq: pd.DataFrame with lfq values (in log2 scale with values for each sample)
+        k: {int} default 5. Number of neighbours used for imputation
+        knn_index: {dict} default None. Index from PerseusImputation.get_knn_index (computed if None)
+        n_neighbors, block_size, n_jobs: Arguments of PerseusImputation.get_knn_index
+        inplace: {bool} default False. Whether df_lfq should be modified in place (if possible without copy)
 
+        Returns
+        -------
+        df_lfq: pd.DataFrame with imputed lfq values
+        """
+        if knn_index is None:
+            knn_index = PerseusImputation.get_knn_index(df_lfq=df_lfq, n_neighbors=n_neighbors,
+                                                        block_size=block_size, n_jobs=n_jobs)
+        values = _get_writeable_values(df=df_lfq, dtype=np.result_type(*df_lfq.dtypes), inplace=inplace)
+        values = _impute_knn(values=values, knn_index=knn_index, k=k)
+        if inplace:
+            if not np.shares_memory(values, df_lfq.to_numpy(copy=False)):
+                df_lfq[list(df_lfq)] = values
+            return df_lfq
+        df_imputed = pd.DataFrame(values, columns=df_lfq.columns, index=df_lfq.index)
+        return df_imputed
@@ -0,0 +1,143 @@
+"""
+This is a script for incremental update of Perseus analysis when new samples are added to an experiment
+(e.g., longitudinal studies), based on running sufficient statistics of groups
+"""
+import numpy as np
+import pandas as pd
+
+import perseuspy._utils as ut
+from perseuspy.per_base import _col_linear, _col_log2, _group_stats, _merge_moments
+from perseuspy.per_comput import PerseusComputations
+from perseuspy.per_test import PerseusTests
+from perseuspy.perseus_pipe import _check_test
+
+
+# I Helper Functions
+def _moments(values=None, list_group_idx=None):
+    """NaN aware count, mean (0 if no valid value), and sum of squared deviations (proteins x groups)"""
+    n, mean, var = _group_stats(values=values, list_group_idx=list_group_idx)
+    m2 = np.where(n > 1, (n - 1) * var, 0)
+    return n, np.where(n > 0, mean, 0), m2
+
+
+# II Main Functions
+class PerseusIncremental(PerseusComputations, PerseusTests):
+    """Class for incremental Perseus analysis
+
+    Per group running statistics (count, mean, and sum of squared deviations of log2 values for each protein) are
+    kept instead of sample values. Adding samples updates them by merging (Chan et al.) in
+    O(proteins x new samples), from which group means, ratios, and t tests (ttest, moderated_ttest) are derived.
+    Just p value correction is recomputed globally.
+
+    Sample values are not kept. Methods requiring them (e.g., get_df_lfq, fdr_permutation, get_valid_rows)
+    raise ValueError unless df_lfq is given.
+    """
+    def __init__(self, df=None, dict_col_group=None, col_acc=ut.COL_ACC, col_genes=ut.COL_GENE,
+                 pre_filtered=False, groups=None, log2_in=True):
+        """
+        Parameters
+        ----------
+        df, dict_col_group, col_acc, col_genes, pre_filtered, groups: see PerseusPipeline
+        log2_in: {bool} default True. Specify whether intensity values in df are log2 transformed or not.
+        """
+        PerseusComputations.__init__(self, df=df, dict_col_group=dict_col_group, col_acc=col_acc,
+                                     col_genes=col_genes, pre_filtered=pre_filtered, groups=groups)
+        self.dict_col_group = dict(self.dict_col_group)
+        values = PerseusComputations.get_values(self, log2_in=log2_in)
+        self._n, self._mean, self._m2 = _moments(values=values, list_group_idx=self.get_list_group_idx())
+        # Release sample values (and their views), just group statistics are kept
+        self._values, self._views = None, {}
+
+    def add_samples(self, df=None, dict_col_group=None, log2_in=True):
+        """Add samples to (new or existing) groups and update group statistics
+
+        Parameters
+        ----------
+        df: pd.DataFrame with intensity columns of new samples, rows matched by index with initial df
+            (proteins missing in df are considered as missing values, further proteins are ignored)
+        dict_col_group: dict with intensity column of new samples to group names
+        log2_in: {bool} default True. Specify whether intensity values in df are log2 transformed or not.
+        """
+        cols = list(dict_col_group)
+        for col in cols:
+            if col not in list(df):
+                raise ValueError("'{}' from 'dict_col_group' not in given data".format(col))
+            if col in self.dict_col_group:
+                raise ValueError("Sample '{}' was already added".format(col))
+        values = df[cols].reindex(self._index).to_numpy(dtype=np.float64)
+        if not log2_in:
+            with np.errstate(divide="ignore"):
+                values = np.log2(np.where(values == 0, np.nan, values))
+        for group in dict.fromkeys(dict_col_group.values()):
+            if group not in self.list_groups:
+                self.list_groups = self.list_groups + [group]
+                self.dict_group_cols[group] = []
+                self._n, self._mean, self._m2 = [np.hstack([x, np.zeros((len(x), 1))])
+                                                 for x in (self._n, self._mean, self._m2)]
+            i = self.list_groups.index(group)
+            group_cols = [col for col in cols if dict_col_group[col] == group]
+            n, mean, m2 = _moments(values=values, list_group_idx=[np.array([cols.index(c) for c in group_cols])])
+            n, mean, m2 = _merge_moments(self._n[:, i], self._mean[:, i], self._m2[:, i], n[:, 0], mean[:, 0],
+                                         m2[:, 0])
+            self._n[:, i], self._mean[:, i], self._m2[:, i] = n, mean, m2
+            self.dict_group_cols[group].extend(group_cols)
+        self.dict_col_group.update(dict_col_group)
+        self.list_col_lfq = list(self.dict_col_group)
+
+    def get_values(self, log2_in=True, log2_out=True):
+        """Sample values are not available (just running group statistics are kept)"""
+        raise ValueError("Sample values are not kept by PerseusIncremental (just group statistics). "
+                         "Give 'df_lfq' with all samples instead")
+
+    def get_list_group_idx(self, cols=None):
+        """Get list with array of column indices (positions in cols) for each group in list_groups based on all
+        added samples (by default, positions in order of dict_col_group)"""
+        if cols is None:
+            cols = list(self.dict_col_group)
+        dict_name_group = {}
+        for col, group in self.dict_col_group.items():
+            for name in [col, _col_log2(col), _col_linear(col)]:
+                dict_name_group.setdefault(name, group)
+        groups = [dict_name_group.get(col) for col in cols]
+        list_group_idx = [np.array([i for i, g in enumerate(groups) if g == group], dtype=int)
+                          for group in self.list_groups]
+        return list_group_idx
+
+    def get_group_stats(self, df_lfq=None):
+        """Get valid count, mean, and variance (each proteins x groups) from running statistics of all added
+        samples (or from df_lfq if given, see PerseusBase.get_group_stats)"""
+        if df_lfq is not None:
+            return PerseusComputations.get_group_stats(self, df_lfq=df_lfq)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = np.where(self._n > 0, self._mean, np.nan)
+            var = np.where(self._n > 1, self._m2 / (self._n - 1), np.nan)
+        return self._n.copy(), mean, var
+
+    def get_df_lfq_mean(self, df_lfq=None, log2_in=True, remove_nan=False):
+        """Get df with mean lfq values (log2) for each group from running statistics (see
+        PerseusComputations.get_df_lfq_mean for df_lfq)"""
+        if df_lfq is not None:
+            return PerseusComputations.get_df_lfq_mean(self, df_lfq=df_lfq, log2_in=log2_in, remove_nan=remove_nan)
+        _, mean, _ = self.get_group_stats()
+        cols = ["{} {}".format(ut.STR_LOG2_INTENSITY, group) for group in self.list_groups]
+        df_lfq_mean = pd.DataFrame(mean, columns=cols, index=self._index)
+        if remove_nan:
+            df_lfq_mean = df_lfq_mean[~df_lfq_mean.isna().any(axis=1)]
+        return df_lfq_mean
+
+    def run(self, contrasts=None, method=None, test="ttest"):
+        """Get df_ratio_pval (as PerseusPipeline.run) for all added samples
+
+        Parameters
+        ----------
+        contrasts: Group comparisons (see PerseusBase.get_contrasts). By default, all pairs of groups are compared.
+        method: {str} default None. Correction method for p values
+            {None, "bonferroni", "sidak", "holm", "hommel", "fdr_bh", "fdr_by"}
+        test: {str} default "ttest". Statistical test {"ttest", "moderated"}
+        """
+        _check_test(test=test)
+        df_ratio = self.get_df_ratio(df_lfq_mean=self.get_df_lfq_mean(), contrasts=contrasts)
+        f_test = self.ttest if test == "ttest" else self.moderated_ttest
+        df_pval = f_test(method=method, contrasts=contrasts)
+        df_ratio_pval = self.add_acc_gene(df_ratio.join(df_pval))
+        return df_ratio_pval
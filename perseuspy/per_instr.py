@@ -0,0 +1,90 @@
+"""
+This is a script for instrumentation (timing, memory, shapes) of Perseus pipeline stages
+"""
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+
+# Settings
+LIST_COL_REPORT = ["stage", "cached", "time", "peak_mem_mb", "shape_in", "shape_out", "n_nan_in", "n_nan_out"]
+
+
+# I Helper Functions
+def _shape(data=None):
+    """Shape of array or data frame (None for other data)"""
+    return tuple(data.shape) if hasattr(data, "shape") else None
+
+
+def _n_nan(data=None):
+    """Number of NaN in numeric array or data frame (None for other data)"""
+    if isinstance(data, pd.DataFrame):
+        data = data.select_dtypes(include="number").to_numpy()
+    if isinstance(data, np.ndarray) and np.issubdtype(data.dtype, np.floating):
+        return int(np.isnan(data).sum())
+    return None
+
+
+# II Main Functions
+class PipelineReport:
+    """Report with one record for each executed stage of pipeline (see PerseusPipeline.set_instrumentation)
+
+    Each record is a dict with stage name, cached (result from stage cache), wall time (s), peak memory (MB,
+    traced memory allocations if memory tracing is enabled), shapes and NaN counts of stage input and output.
+    """
+    def __init__(self, callback=None, memory=True):
+        self.callback = callback
+        self.memory = memory
+        self.records = []
+
+    def measure(self, stage=None, func=None, data_in=None):
+        """Run stage func(), record it, and return its output"""
+        if self.memory:
+            started = not tracemalloc.is_tracing()
+            if started:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            mem_start = tracemalloc.get_traced_memory()[0]
+        t0 = time.perf_counter()
+        data_out = func()
+        t = time.perf_counter() - t0
+        peak_mem_mb = None
+        if self.memory:
+            peak_mem_mb = (tracemalloc.get_traced_memory()[1] - mem_start) / 1024 ** 2
+            if started:
+                tracemalloc.stop()
+        self.add(stage=stage, cached=False, time=t, peak_mem_mb=peak_mem_mb, data_in=data_in, data_out=data_out)
+        return data_out
+
+    def add(self, stage=None, cached=False, time=0.0, peak_mem_mb=None, data_in=None, data_out=None):
+        """Add record for stage and pass it to callback"""
+        record = dict(stage=stage, cached=cached, time=time, peak_mem_mb=peak_mem_mb,
+                      shape_in=_shape(data_in), shape_out=_shape(data_out),
+                      n_nan_in=_n_nan(data_in), n_nan_out=_n_nan(data_out))
+        self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    def clear(self):
+        """Remove all records"""
+        self.records = []
+
+    def to_df(self):
+        """Get df with one row for each record"""
+        return pd.DataFrame(self.records, columns=LIST_COL_REPORT)
+
+    def summary(self):
+        """Get df with number of calls, cache hits, total time and maximum peak memory for each stage"""
+        df = self.to_df()
+        df_summary = df.groupby("stage", sort=False).agg(n_calls=("stage", "size"),
+                                                         n_cached=("cached", "sum"),
+                                                         time=("time", "sum"),
+                                                         peak_mem_mb=("peak_mem_mb", "max"))
+        df_summary["time_fraction"] = df_summary["time"] / df_summary["time"].sum()
+        return df_summary
+
+    def __repr__(self):
+        if not self.records:
+            return "PipelineReport (no records)"
+        return "PipelineReport\n{}".format(self.summary())
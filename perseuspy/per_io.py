@@ -0,0 +1,145 @@
+"""
+This is a script for fast reading of protein quantification exports (MaxQuant, DIA-NN, Spectronaut)
+"""
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from perseuspy.per_base import get_dict_groups, _pre_filter
+from perseuspy.per_cache import LFQCache
+
+
+# Settings
+LIST_FILTER_COL = ["Only identified by site", "Reverse", "Potential contaminant", "Contaminant"]
+DICT_FORMATS = {"maxquant": dict(col_acc="Protein IDs", col_genes="Gene names", lfq_str="LFQ intensity",
+                                 list_filter_col=LIST_FILTER_COL, list_annotation_col=[]),
+                "diann": dict(col_acc="Protein.Group", col_genes="Genes", lfq_str="", list_filter_col=[],
+                              list_annotation_col=["Protein.Ids", "Protein.Names", "First.Protein.Description"]),
+                "spectronaut": dict(col_acc="PG.ProteinGroups", col_genes="PG.Genes", lfq_str="PG.Quantity",
+                                    list_filter_col=[], list_annotation_col=[])}
+
+
+# I Helper Functions
+def _check_fmt(fmt=None):
+    """Check format of export"""
+    if fmt not in DICT_FORMATS:
+        raise ValueError("'fmt' ({}) should be one of following: {}".format(fmt, list(DICT_FORMATS)))
+
+
+def _get_sep(file=None, sep=None):
+    """Get separator by file extension (tab separated if not '.csv')"""
+    if sep is None:
+        sep = "," if str(file).endswith(".csv") else "\t"
+    return sep
+
+
+def read_header(file=None, sep=None):
+    """Get column names of file by reading just its header"""
+    return list(pd.read_csv(file, sep=_get_sep(file=file, sep=sep), nrows=0))
+
+
+def _read_chunks(reader=None, dict_col_group=None, cols=None, list_filter_col=None, log2=False):
+    """Filter and (optionally) log2 transform chunks of reader"""
+    for df_chunk in reader:
+        df_chunk = _pre_filter(df=df_chunk, list_filter_col=list_filter_col)
+        if log2:
+            values = df_chunk[list(dict_col_group)].to_numpy()
+            with np.errstate(divide="ignore"):
+                df_chunk[list(dict_col_group)] = np.log2(np.where(values == 0, np.nan, values))
+        yield df_chunk[cols + list(dict_col_group)]
+
+
+# II Main Functions
+def read_lfq(file=None, groups=None, fmt="maxquant", lfq_str=None, col_acc=None, col_genes=None, sep=None,
+             dtype=np.float32, pre_filtered=False, list_filter_col=None, chunksize=100000, log2=False,
+             cache_dir=None, cache_max_size=2 * 1024 ** 3):
+    """Read just required columns of protein quantification export with compact data types
+
+    Parameters
+    ----------
+    file: {str} path to export file (e.g., proteinGroups.txt, report.pg_matrix.tsv, Spectronaut report)
+    groups: {list} list with group names {strings} contained in names of intensity columns
+    fmt: {str} default "maxquant". Format of export {"maxquant", "diann", "spectronaut"}, which
+        defines default column names (col_acc, col_genes, lfq_str) and filter columns
+    lfq_str: {str} default None. String contained in intensity columns (by default from fmt)
+    col_acc: {str} default None. Column name for unique protein identifier (by default from fmt)
+    col_genes: {str} default None. Column name for gene names (by default from fmt)
+    sep: {str} default None. Separator ("," for .csv files, otherwise tab)
+    dtype: {np.dtype} default np.float32. Data type of intensity columns
+    pre_filtered: {bool} default False. If False, rows are filtered for filter columns while reading
+        (e.g., "Only identified by site", "Reverse", "Potential contaminant")
+    list_filter_col: {list} default None. Filter columns (by default from fmt)
+    chunksize: {int} default 100000. Number of rows read and filtered at once
+    log2: {bool} default False. Whether intensities should be log2 transformed (0 set to NaN) while reading.
+        If True, the pipeline should be run with log2_in=True
+    cache_dir: {str} default None. Folder of on-disk cache (see LFQCache). If given, the parsed data is
+        stored keyed by content hash of file and all reading parameters and loaded memory-mapped if cached
+    cache_max_size: {int} default 2 GB. Maximum size of cache in bytes
+
+    Returns
+    -------
+    df: pd.DataFrame with col_acc, col_genes (categorical), and intensity columns
+    dict_col_group: dict with intensity column to group names (see get_dict_groups)
+    """
+    _check_fmt(fmt=fmt)
+    if cache_dir is not None:
+        cache = LFQCache(folder=cache_dir, max_size=cache_max_size)
+        key = cache.get_key(file=file, groups=groups, fmt=fmt, lfq_str=lfq_str, col_acc=col_acc,
+                            col_genes=col_genes, sep=sep, dtype=np.dtype(dtype).name, pre_filtered=pre_filtered,
+                            list_filter_col=list_filter_col, log2=log2)
+        cached = cache.load(key=key)
+        if cached is not None:
+            return cached
+        df, dict_col_group = read_lfq(file=file, groups=groups, fmt=fmt, lfq_str=lfq_str, col_acc=col_acc,
+                                      col_genes=col_genes, sep=sep, dtype=dtype, pre_filtered=pre_filtered,
+                                      list_filter_col=list_filter_col, chunksize=chunksize, log2=log2)
+        cache.save(key=key, df=df, dict_col_group=dict_col_group, col_acc=list(df)[0], col_genes=list(df)[1])
+        return df, dict_col_group
+    chunks, dict_col_group = iter_lfq_chunks(file=file, groups=groups, fmt=fmt, lfq_str=lfq_str, col_acc=col_acc,
+                                             col_genes=col_genes, sep=sep, dtype=dtype, pre_filtered=pre_filtered,
+                                             list_filter_col=list_filter_col, chunksize=chunksize, log2=log2)
+    list_df = list(chunks)
+    col_acc, col_genes = list(list_df[0])[0:2]
+    genes = union_categoricals([df_chunk[col_genes] for df_chunk in list_df], ignore_order=True)
+    df = pd.concat([df_chunk.drop(columns=[col_genes]) for df_chunk in list_df], ignore_index=True)
+    df.insert(1, col_genes, genes)
+    df = df[[col_acc, col_genes] + list(dict_col_group)]
+    return df, dict_col_group
+
+
+def iter_lfq_chunks(file=None, groups=None, fmt="maxquant", lfq_str=None, col_acc=None, col_genes=None, sep=None,
+                    dtype=np.float32, pre_filtered=False, list_filter_col=None, chunksize=100000, log2=False):
+    """Read export in filtered row chunks (arguments see read_lfq) without holding whole table in memory
+
+    Returns
+    -------
+    chunks: generator of pd.DataFrame with col_acc, col_genes (categorical), and intensity columns, where
+        index gives row position in file
+    dict_col_group: dict with intensity column to group names (see get_dict_groups)
+    """
+    _check_fmt(fmt=fmt)
+    dict_fmt = DICT_FORMATS[fmt]
+    lfq_str = dict_fmt["lfq_str"] if lfq_str is None else lfq_str
+    col_acc = dict_fmt["col_acc"] if col_acc is None else col_acc
+    col_genes = dict_fmt["col_genes"] if col_genes is None else col_genes
+    list_filter_col = dict_fmt["list_filter_col"] if list_filter_col is None else list_filter_col
+    sep = _get_sep(file=file, sep=sep)
+    # Header scan to get sample columns
+    cols = read_header(file=file, sep=sep)
+    for col in [col_acc, col_genes]:
+        if col not in cols:
+            raise ValueError("'{}' not in columns of '{}'".format(col, file))
+    list_filter_col = [col for col in list_filter_col if col in cols] if not pre_filtered else []
+    cols_annotation = [col_acc, col_genes] + list_filter_col + dict_fmt["list_annotation_col"]
+    cols_sample = [col for col in cols if col not in cols_annotation]
+    dict_col_group = get_dict_groups(lfq_str=lfq_str, groups=groups, cols=cols_sample)
+    # Read just required columns with compact data types
+    dict_dtype = {col: dtype for col in dict_col_group}
+    dict_dtype.update({col_genes: "category"})
+    dict_dtype.update({col: "category" for col in list_filter_col})
+    usecols = [col_acc, col_genes] + list_filter_col + list(dict_col_group)
+    reader = pd.read_csv(file, sep=sep, usecols=usecols, dtype=dict_dtype, chunksize=chunksize)
+    chunks = _read_chunks(reader=reader, dict_col_group=dict_col_group, cols=[col_acc, col_genes],
+                          list_filter_col=list_filter_col, log2=log2)
+    return chunks, dict_col_group
+
@@ -0,0 +1,131 @@
+"""
+This is a script for normalization methods in Perseus pipeline
+
+References
+----------
+[1] Tyanova S., et al. The Perseus computational platform for comprehensive analysis of (prote)omics data.
+    Nature Methods (2016)
+[2] Bolstad B. M., et al. A comparison of normalization methods for high density oligonucleotide array data
+    based on variance and bias. Bioinformatics (2003)
+"""
+import numpy as np
+import pandas as pd
+
+from perseuspy.per_base import PerseusBase
+from perseuspy.per_imput import _get_writeable_values
+
+
+# I Helper Functions
+def _check_norm_method(method=None):
+    """Check normalization method"""
+    norm_methods = ["median", "mean", "width", "quantile"]
+    if method not in norm_methods:
+        raise ValueError("'method' ({}) should be one of following: {}".format(method, norm_methods))
+
+
+def _valid_sorted(col=None):
+    """Sorted valid values of column (NaN are sorted to the end)"""
+    col_sorted = np.sort(col)
+    return col_sorted[:len(col_sorted) - np.isnan(col_sorted).sum()]
+
+
+def _quantiles(col_sorted=None, q=None):
+    """Quantiles of sorted values (linear interpolation)"""
+    return np.interp(q, np.linspace(0, 1, len(col_sorted)), col_sorted)
+
+
+def _norm_center(values=None, method="median"):
+    """Shift each column in place to common median (or mean) given by mean of column medians (or means)"""
+    centers = np.empty(values.shape[1])
+    for j in range(values.shape[1]):
+        col = values[:, j]
+        centers[j] = np.nanmedian(col) if method == "median" else np.nanmean(col)
+    level = centers.mean()
+    for j in range(values.shape[1]):
+        values[:, j] -= values.dtype.type(centers[j] - level)
+    return values
+
+
+def _norm_width(values=None):
+    """Width adjustment as in Perseus: subtract median and divide values above (below) median by distance of
+    third (first) quartile to median. Columns are rescaled in place to mean median and mean quartile distances.
+    Sides of columns with zero quartile distance (e.g., many tied values) are just shifted, not scaled"""
+    quartiles = np.empty((values.shape[1], 3))
+    for j in range(values.shape[1]):
+        quartiles[j] = _quantiles(col_sorted=_valid_sorted(values[:, j]), q=[0.25, 0.5, 0.75])
+    q1, q2, q3 = quartiles.T
+    level, width_low, width_up = q2.mean(), (q2 - q1).mean(), (q3 - q2).mean()
+    for j in range(values.shape[1]):
+        col = values[:, j]
+        col -= col.dtype.type(q2[j])
+        upper = col > 0
+        dist_up, dist_low = q3[j] - q2[j], q2[j] - q1[j]
+        col[upper] *= col.dtype.type(width_up / dist_up if dist_up > 0 else 1)
+        col[~upper] *= col.dtype.type(width_low / dist_low if dist_low > 0 else 1)
+        col += col.dtype.type(level)
+    return values
+
+
+def _norm_quantile(values=None):
+    """NaN aware quantile normalization in place: valid values of each column are replaced (by rank) by reference
+    distribution, which is mean of column distributions interpolated to common number of quantiles"""
+    n_valid = np.array([len(col) - np.isnan(col).sum() for col in values.T])
+    grid = np.linspace(0, 1, n_valid.max())
+    ref = np.zeros(len(grid))
+    for j in range(values.shape[1]):
+        ref += _quantiles(col_sorted=_valid_sorted(values[:, j]), q=grid)
+    ref /= values.shape[1]
+    for j in range(values.shape[1]):
+        col = values[:, j]
+        order = np.argsort(col)[:n_valid[j]]
+        col[order] = np.interp(np.linspace(0, 1, n_valid[j]), grid, ref)
+    return values
+
+
+# II Main Functions
+class PerseusNormalization(PerseusBase):
+    """Class for Perseus analysis"""
+    def __init__(self, **kwargs):
+        PerseusBase.__init__(self, **kwargs)
+
+    def normalize(self, df_lfq=None, method="median", dtype=None, inplace=False):
+        """Normalize sample columns (NaN aware) of lfq values in log2 scale
+
+        Normalization is performed column wise in place on one writeable matrix, so that no further copies
+        of whole matrix are created (e.g., for large cohorts). Use dtype=np.float32 to halve memory.
+
+        Parameters
+        ----------
+        df_lfq: pd.DataFrame with lfq values (in log2 scale). If None, core matrix (log2 input) is used
+        method: {str} default "median". Normalization method
+            "median": shift columns to common median (mean of column medians)
+            "mean": shift columns to common mean (mean of column means)
+            "width": width adjustment as in Perseus (separate scaling of values above and below median by
+                quartile distances), rescaled to mean median and mean quartile distances of columns
+            "quantile": quantile normalization to mean distribution of columns (NaN kept)
+        dtype: {np.dtype} default None. Data type of values (e.g., np.float32), by default dtype of df_lfq
+        inplace: {bool} default False. Whether df_lfq should be modified in place (if possible without copy)
+
+        Returns
+        -------
+        df_lfq: pd.DataFrame with normalized lfq values
+        """
+        _check_norm_method(method=method)
+        if df_lfq is None:
+            df_lfq = self._get_df_lfq()
+            inplace = False
+        if dtype is None:
+            dtype = np.result_type(*df_lfq.dtypes)
+        values = _get_writeable_values(df=df_lfq, dtype=dtype, inplace=inplace)
+        if method in ["median", "mean"]:
+            values = _norm_center(values=values, method=method)
+        elif method == "width":
+            values = _norm_width(values=values)
+        else:
+            values = _norm_quantile(values=values)
+        if inplace:
+            if not np.shares_memory(values, df_lfq.to_numpy(copy=False)):
+                df_lfq[list(df_lfq)] = values
+            return df_lfq
+        df_norm = pd.DataFrame(values, columns=df_lfq.columns, index=df_lfq.index, copy=False)
+        return df_norm
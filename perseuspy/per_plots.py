@@ -2,6 +2,7 @@
 This is a script for plotting class of Perseus pipeline
 """
 import os
+import re
 import time
 import pandas as pd
 import numpy as np
@@ -12,6 +13,10 @@ import seaborn as sns
 import math
 import plotly.express as px
 from adjustText import adjust_text
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.collections import LineCollection
+from scipy.cluster.hierarchy import linkage, leaves_list
+from scipy.spatial.distance import pdist
 
 import perseuspy._utils as ut
 
@@ -23,6 +28,13 @@ COLOR_UP = "firebrick"
 COLOR_DOWN = "dodgerblue"
 COLOR_NOT_SIG = "gray"
 COLOR_TH = "black"
+LIST_CLASSES = ["Up", "Down", "Not Sig"]
+DICT_CLASS_COLOR = dict(zip(LIST_CLASSES, [COLOR_UP, COLOR_DOWN, COLOR_NOT_SIG]))
+LIST_FIG_FORMATS = ["png", "pdf", "svg"]
+STR_LOG10_PVAL = "-log10 p value"
+
+# df_ratio_pval of volcano worker process (set once by initializer instead of pickling it for each task)
+_worker_df = None
 
 
 # I Helper Functions
@@ -55,27 +67,32 @@ def _check_log_scales(x_min=None, x_max=None):
 
 
 # Filter functions
-def _color_filter(df=None, th_p=2.0, th_ratio=0.5, col_ratio=None, col_pval=None, gene_list=None):
+def _mask_genes(df=None, gene_list=None):
+    """Boolean mask for genes in gene_list (set based membership)"""
+    if gene_list is None:
+        return np.zeros(len(df), dtype=bool)
+    return df["Gene_Name"].isin(set(gene_list)).to_numpy()
+
+
+def _classify(df=None, th_p=2.0, th_ratio=0.5, col_ratio=None, col_pval=None, gene_list=None):
+    """Classify values in 'Up', 'Down', and 'Not Sig' (genes from gene_list by sign of ratio)"""
+    ratio = df[col_ratio].to_numpy()
+    p_val = df[col_pval].to_numpy()
+    mask_gene = _mask_genes(df=df, gene_list=gene_list)
+    mask_p = p_val >= th_p
+    mask_up = (mask_gene & (ratio > 0)) | (~mask_gene & mask_p & (ratio >= th_ratio))
+    mask_down = (mask_gene & ~(ratio > 0)) | (~mask_gene & mask_p & (ratio <= -th_ratio))
+    codes = np.select([mask_up, mask_down], [0, 1], default=2)
+    classes = pd.Categorical.from_codes(codes, categories=LIST_CLASSES)
+    return classes
+
+
+def _color_filter(df=None, th_p=2.0, th_ratio=0.5, col_ratio=None, col_pval=None, gene_list=None, classes=None):
     """Classify significant values by color"""
-    colors = []
-    for i, row in df.iterrows():
-        gene = row["Gene_Name"]
-        ratio = row[col_ratio]
-        p_val = row[col_pval]
-        if gene_list is not None and gene in gene_list:
-            if ratio > 0:
-                colors.append(COLOR_UP)
-            else:
-                colors.append(COLOR_DOWN)
-        elif p_val >= th_p:
-            if ratio >= th_ratio:
-                colors.append(COLOR_UP)
-            elif ratio <= -th_ratio:
-                colors.append(COLOR_DOWN)
-            else:
-                colors.append(COLOR_NOT_SIG)
-        else:
-            colors.append(COLOR_NOT_SIG)
+    if classes is None:
+        classes = _classify(df=df, th_p=th_p, th_ratio=th_ratio, col_ratio=col_ratio, col_pval=col_pval,
+                            gene_list=gene_list)
+    colors = np.asarray(pd.Categorical(classes, categories=LIST_CLASSES).rename_categories(DICT_CLASS_COLOR))
     return colors
 
 
@@ -87,25 +104,187 @@ def _label_filter(df=None, gene_list=None, th_p_text=2.0, th_neg_ratio=-0.5, th_
         avoid_conflict = avoid_conflict/100
     ac = 1 - avoid_conflict
     # Filter labels
-    labels = []
-    for i, row in df.iterrows():
-        gene = row["Gene_Name"]
-        ratio = row[col_ratio]
-        p_val = row[col_pval]
-        x, y = ratio, p_val
-        if (gene_list is not None and gene in gene_list) or (p_val > th_p_text and (ratio < th_neg_ratio or ratio > th_pos_ratio)):
-            label = (gene, x, y)
-            labels.append(label)
-        # Save significant but not to be shown genes to avoid overlapping conflict
-        elif p_val > th_p_text*0.75 and (ratio < th_neg_ratio * ac or ratio > th_pos_ratio * ac):
-            label = ("", x, y)
-            labels.append(label)
+    genes = df["Gene_Name"].to_numpy()
+    ratio = df[col_ratio].to_numpy()
+    p_val = df[col_pval].to_numpy()
+    mask_gene = _mask_genes(df=df, gene_list=gene_list)
+    mask_label = mask_gene | ((p_val > th_p_text) & ((ratio < th_neg_ratio) | (ratio > th_pos_ratio)))
+    # Save significant but not to be shown genes to avoid overlapping conflict
+    mask_avoid = ~mask_label & (p_val > th_p_text * 0.75) & ((ratio < th_neg_ratio * ac) | (ratio > th_pos_ratio * ac))
+    mask = mask_label | mask_avoid
+    # Flag for genes from gene_list (always shown, see _cull_labels)
+    labels = list(zip(np.where(mask_label, genes, "")[mask], ratio[mask], p_val[mask], mask_gene[mask]))
     return labels
 
 
+def _label_cells(x=None, y=None, cell_size=None):
+    """Get grid cell (spatial index) for each point"""
+    cell_x = np.floor(np.asarray(x, dtype=float) / cell_size[0]).astype(int)
+    cell_y = np.floor(np.asarray(y, dtype=float) / cell_size[1]).astype(int)
+    return list(zip(cell_x, cell_y))
+
+
+def _cull_labels(labels=None, cell_size=None, max_labels=None):
+    """Cull overlapping labels using a grid based spatial index
+    In: a) labels: list of label tuples (label, x, y) or (label, x, y, keep), where label '' marks points to avoid
+            and keep marks labels always shown (e.g., genes from gene_list), which are not culled and not counted
+            for label budget
+        b) cell_size: tuple with width and height of grid cells in data units (approx. label size)
+        c) max_labels: maximum number of labels to show (label budget)
+    Out:a) labels_fixed: labels without neighbours (no repulsion needed)
+        b) labels_repel: labels with neighbouring labels or points (local neighbourhoods for repulsion)
+        c) labels_avoid: points to avoid adjacent to labels_repel"""
+    labels = [label for label in labels if not np.isnan(label[1]) and not np.isnan(label[2])]
+    labels_text = [label for label in labels if label[0] != ""]
+    labels_avoid = [label for label in labels if label[0] == ""]
+    if len(labels_text) == 0:
+        return [], [], []
+    # Rank by significance and effect size (normalized to maximum)
+    x = np.abs(np.array([label[1] for label in labels_text]))
+    y = np.array([label[2] for label in labels_text])
+    score = y / max(y.max(), 1e-12) + x / max(x.max(), 1e-12)
+    order = np.argsort(-score, kind="stable")
+    # Keep labels to be always shown and best further label per cell (up to label budget)
+    cells = _label_cells(x=[label[1] for label in labels_text], y=y, cell_size=cell_size)
+    keep = [len(label) > 3 and bool(label[3]) for label in labels_text]
+    dict_cell_label = {}
+    for i in order:
+        if keep[i]:
+            dict_cell_label.setdefault(cells[i], []).append(labels_text[i])
+    n_labels = 0
+    for i in order:
+        if max_labels is not None and n_labels >= max_labels:
+            break
+        if not keep[i] and cells[i] not in dict_cell_label:
+            dict_cell_label[cells[i]] = [labels_text[i]]
+            n_labels += 1
+    # Points to avoid only kept if adjacent to shown label
+    neighbours = [(i, j) for i in (-1, 0, 1) for j in (-1, 0, 1)]
+    cells_avoid = _label_cells(x=[label[1] for label in labels_avoid], y=[label[2] for label in labels_avoid],
+                               cell_size=cell_size)
+    set_cells_repel = set()
+    list_avoid = []
+    for (cx, cy), label in zip(cells_avoid, labels_avoid):
+        cells_near = [(cx + dx, cy + dy) for dx, dy in neighbours if (cx + dx, cy + dy) in dict_cell_label]
+        if cells_near:
+            set_cells_repel.update(cells_near)
+            list_avoid.append(label)
+    # Labels with neighbouring labels (or further labels in same cell) need repulsion
+    for (cx, cy), list_labels in dict_cell_label.items():
+        if len(list_labels) > 1 or any((cx + dx, cy + dy) in dict_cell_label for dx, dy in neighbours
+                                       if (dx, dy) != (0, 0)):
+            set_cells_repel.add((cx, cy))
+    labels_fixed = [label for cell, list_labels in dict_cell_label.items() if cell not in set_cells_repel
+                    for label in list_labels]
+    labels_repel = [label for cell, list_labels in dict_cell_label.items() if cell in set_cells_repel
+                    for label in list_labels]
+    return labels_fixed, labels_repel, list_avoid
+
+
+def _label_groups(labels=None, points=None, cell_size=None):
+    """Group labels into local neighbourhoods given by connected grid cells (including diagonal neighbours)
+    In: a) labels: list of label tuples (label, x, y) to be placed
+        b) points: list of point tuples (label, x, y) to avoid, assigned to each neighbourhood adjacent to them
+        c) cell_size: tuple with width and height of grid cells in data units
+    Out:a) list_groups: list of tuples with indices of labels and indices of points for each neighbourhood"""
+    neighbours = [(i, j) for i in (-1, 0, 1) for j in (-1, 0, 1)]
+    cells = _label_cells(x=[label[1] for label in labels], y=[label[2] for label in labels], cell_size=cell_size)
+    dict_cell_idx = {}
+    for i, cell in enumerate(cells):
+        dict_cell_idx.setdefault(cell, []).append(i)
+    # Connected components of occupied cells (breadth first search)
+    dict_cell_group = {}
+    list_groups = []
+    for cell in dict_cell_idx:
+        if cell in dict_cell_group:
+            continue
+        dict_cell_group[cell] = len(list_groups)
+        queue, idx_labels = [cell], []
+        while queue:
+            cx, cy = queue.pop()
+            idx_labels.extend(dict_cell_idx[(cx, cy)])
+            for dx, dy in neighbours:
+                cell_near = (cx + dx, cy + dy)
+                if cell_near in dict_cell_idx and cell_near not in dict_cell_group:
+                    dict_cell_group[cell_near] = len(list_groups)
+                    queue.append(cell_near)
+        list_groups.append((sorted(idx_labels), []))
+    cells_points = _label_cells(x=[point[1] for point in points], y=[point[2] for point in points],
+                                cell_size=cell_size)
+    for j, (cx, cy) in enumerate(cells_points):
+        groups = {dict_cell_group[(cx + dx, cy + dy)] for dx, dy in neighbours if (cx + dx, cy + dy) in dict_cell_group}
+        for group in groups:
+            list_groups[group][1].append(j)
+    return list_groups
+
+
+# Heatmap functions
+def _significant_rows(df=None, cols_ratio=None, th_p=2.0, th_ratio=0.5):
+    """Boolean mask for rows significant ('Up' or 'Down') in any group comparison given by ratio columns"""
+    mask = np.zeros(len(df), dtype=bool)
+    for col_ratio in cols_ratio:
+        col_pval = col_ratio.replace(ut.STR_LOG2_RATIO, "-log10 p value")
+        _check_col(df, col=col_pval)
+        classes = _classify(df=df, th_p=th_p, th_ratio=th_ratio, col_ratio=col_ratio, col_pval=col_pval)
+        mask |= classes.codes != 2
+    return mask
+
+
+def _zscore_rows(values=None):
+    """NaN aware z-score of each row"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = (values - np.nanmean(values, axis=1, keepdims=True)) / np.nanstd(values, axis=1, keepdims=True)
+    return z
+
+
+def _linkage_order(values=None, method="average"):
+    """Linkage and leaf order of rows, with distances computed as condensed matrix (NaN set to 0)"""
+    values = np.nan_to_num(values, nan=0.0)
+    if method in ["ward", "centroid", "median"]:
+        z_link = linkage(values, method=method)
+    else:
+        z_link = linkage(pdist(values, metric="euclidean"), method=method)
+    return z_link, leaves_list(z_link)
+
+
+def _dendrogram_segments(z_link=None, order=None):
+    """Line segments (height, position) of dendrogram without recursion (leaves at position 0.5, 1.5, ...)"""
+    n = len(order)
+    pos = np.empty(2 * n - 1)
+    pos[order] = np.arange(n) + 0.5
+    height = np.zeros(2 * n - 1)
+    segments = []
+    for i, (a, b, h, _) in enumerate(z_link):
+        a, b = int(a), int(b)
+        pos[n + i], height[n + i] = (pos[a] + pos[b]) / 2, h
+        segments.extend([[(height[a], pos[a]), (h, pos[a])], [(h, pos[a]), (h, pos[b])],
+                         [(h, pos[b]), (height[b], pos[b])]])
+    return segments
+
+
+def _scatter_large_data(df=None, col_ratio=None, col_pval=None, colors=None, filled_circle=True,
+                        large_data="raster", gridsize=100):
+    """Scatter plot with rasterized (large_data='raster') or density binned (large_data='density')
+    not significant points, while significant points are drawn as vector graphics"""
+    _, ax = plt.subplots(figsize=(5, 5))
+    x = df[col_ratio].to_numpy()
+    y = df[col_pval].to_numpy()
+    mask_not_sig = colors == COLOR_NOT_SIG
+    if large_data == "density":
+        mask_valid = mask_not_sig & ~np.isnan(x) & ~np.isnan(y)
+        ax.hexbin(x[mask_valid], y[mask_valid], gridsize=gridsize, bins="log", mincnt=1, cmap="Greys",
+                  linewidths=0, rasterized=True)
+    else:
+        kwargs_color = dict(c=COLOR_NOT_SIG) if filled_circle else dict(c="none", edgecolors=COLOR_NOT_SIG)
+        ax.scatter(x[mask_not_sig], y[mask_not_sig], rasterized=True, **kwargs_color)
+    kwargs_color = dict(c=colors[~mask_not_sig]) if filled_circle else dict(c="none", edgecolors=colors[~mask_not_sig])
+    ax.scatter(x[~mask_not_sig], y[~mask_not_sig], **kwargs_color)
+    return ax
+
+
 def _set_labels(labels=None, objects=None, fig_format="png", label_size=8, precision=0.01, label_bold=False,
                 force_points=0.75, force_text=0.75, force_objects=0.25, box=False, alpha=0.85, verbose=True,
-                th_filter=None):
+                th_filter=None, cull=True, max_labels=None, cell_size=None):
     """Set labels of genes automatically
     In: a) labels: list of label tuples (label, x, y)
         b) objects: list of objects that should be considered for placement
@@ -116,14 +295,33 @@ def _set_labels(labels=None, objects=None, fig_format="png", label_size=8, preci
             value; default (0.2, 0.5)
         d3) force_objects (float): same as other forces, but for repelling
             additional objects; default (0.1, 0.25)
+        e1) cull: boolean to decide whether overlapping labels are culled by a spatial grid, where only labels
+            with neighbouring labels or points are iteratively placed (separately for each neighbourhood)
+        e2) max_labels: maximum number of labels (ranked by significance and effect size) if cull
+        e3) cell_size: tuple with grid cell size in data units if cull (by default approx. label size)
+    Out:a) time_placement: time in seconds for placement of labels
     """
+    t0 = time.time()
     fontdict = dict(size=label_size)
     if label_bold:
         fontdict.update(weight="bold")
     # Helvetica, Arial
     props = dict(boxstyle='round', alpha=alpha, edgecolor="white")
+    if cull:
+        if cell_size is None:
+            ax = plt.gca()
+            (x_min, x_max), (y_min, y_max) = ax.get_xlim(), ax.get_ylim()
+            width, height = ax.get_figure().get_size_inches()
+            # Approximate label size (in points) as fraction of axis
+            n_char = np.median([len(str(label[0])) for label in labels if label[0] != ""] or [1])
+            cell_size = ((x_max - x_min) * label_size * 0.6 * n_char / 72 / width,
+                         (y_max - y_min) * label_size * 1.5 / 72 / height)
+        labels_fixed, labels_repel, labels_avoid = _cull_labels(labels=labels, cell_size=cell_size,
+                                                                max_labels=max_labels)
+    else:
+        labels_fixed, labels_repel, labels_avoid = [], labels, []
     texts = []
-    for label, x, y in labels:
+    for i, (label, x, y) in enumerate(label[:3] for label in labels_fixed + labels_repel):
         if abs(x) < th_filter[1] or y < th_filter[0]:
             color = COLOR_NOT_SIG
         elif x < 0:
@@ -135,20 +333,77 @@ def _set_labels(labels=None, objects=None, fig_format="png", label_size=8, preci
             _check_gene_values(gene=label, x=x, y=y)
             if box:
                 fontdict.update(dict(color="white"))
-                texts.append(plt.text(x, y, label, fontdict=fontdict, bbox=props))
+                text = plt.text(x, y, label, fontdict=fontdict, bbox=props)
             else:
                 fontdict.update(dict(color="black"))
-                texts.append(plt.text(x, y, label, fontdict=fontdict))
+                text = plt.text(x, y, label, fontdict=fontdict)
+            if i >= len(labels_fixed):
+                texts.append(text)
     if verbose:
         print("{} elements have to be iteratively placed".format(len(texts)))
-    adjust_text(texts,
-                add_objects=objects,
-                precision=precision,
-                force_points=force_points,
-                force_text=force_text,
-                force_objects=force_objects,
-                arrowprops=dict(arrowstyle="-", color='gray', lw=0.5),
-                save_format=fig_format)
+    kwargs_adjust = dict(add_objects=objects, precision=precision, force_points=force_points, force_text=force_text,
+                         force_objects=force_objects, arrowprops=dict(arrowstyle="-", color='gray', lw=0.5),
+                         save_format=fig_format)
+    if cull:
+        # Labels are placed separately for each local neighbourhood (with adjacent points to avoid)
+        for idx_labels, idx_points in _label_groups(labels=labels_repel, points=labels_avoid, cell_size=cell_size):
+            points = [labels_repel[i] for i in idx_labels] + [labels_avoid[j] for j in idx_points]
+            adjust_text([texts[i] for i in idx_labels], x=[label[1] for label in points],
+                        y=[label[2] for label in points], **kwargs_adjust)
+    elif len(texts) > 0:
+        adjust_text(texts, **kwargs_adjust)
+    time_placement = time.time() - t0
+    if verbose:
+        print("Label placement took {:.2f} s".format(time_placement))
+    return time_placement
+
+
+def _volcano_contrasts(df=None, contrasts=None):
+    """Get (contrast, col_ratio, col_pval) for each '-log10 p value (a/b)' column with matching ratio column
+    (all or just given contrasts, either as 'a/b' or pairs (a, b))"""
+    list_contrasts = [re.match(r"^{} \((.+)\)$".format(re.escape(STR_LOG10_PVAL)), col) for col in list(df)]
+    list_contrasts = [match.group(1) for match in list_contrasts if match is not None]
+    if contrasts is not None:
+        contrasts = [c if isinstance(c, str) else "{}/{}".format(*c) for c in contrasts]
+        missing = [c for c in contrasts if c not in list_contrasts]
+        if missing:
+            raise ValueError("Contrasts {} not in 'df_ratio_pval' (available: {})".format(missing, list_contrasts))
+        list_contrasts = contrasts
+    list_cols = []
+    for contrast in list_contrasts:
+        col_ratio = "{} ({})".format(ut.STR_LOG2_RATIO, contrast)
+        _check_col(df, col=col_ratio)
+        list_cols.append((contrast, col_ratio, "{} ({})".format(STR_LOG10_PVAL, contrast)))
+    return list_cols
+
+
+def _volcano_file(out_dir=None, contrast=None, fig_format="png"):
+    """File of volcano plot for contrast (characters not allowed in file names are replaced by '_')"""
+    return os.path.join(out_dir, "volcano_{}.{}".format(re.sub(r"[^\w.-]+", "_", contrast), fig_format))
+
+
+def _init_volcano_worker(df=None):
+    """Initialize volcano worker process with non-interactive backend and df_ratio_pval"""
+    global _worker_df
+    mpl.use("Agg")
+    _worker_df = df
+
+
+def _render_volcano(df=None, col_ratio=None, col_pval=None, file=None, dpi=300, kwargs_volcano=None):
+    """Render volcano plot with isolated rcParams, save it, and free figure directly"""
+    with plt.rc_context():
+        ax = PerseusPlots.volcano_plot(df_ratio_pval=df, col_ratio=col_ratio, col_pval=col_pval, **kwargs_volcano)
+        fig = ax.get_figure()
+        try:
+            fig.savefig(file, dpi=dpi)
+        finally:
+            plt.close(fig)
+    return file
+
+
+def _render_volcano_worker(**kwargs):
+    """Render volcano plot for df_ratio_pval of worker process"""
+    return _render_volcano(df=_worker_df, **kwargs)
 
 
 # II Main Functions
@@ -157,11 +412,30 @@ class PerseusPlots:
     def __init__(self, **kwargs):
         pass
 
+    @staticmethod
+    def volcano_classes(df_ratio_pval=None, col_ratio=None, col_pval=None, th_filter=(0.05, 0.5), gene_list=None):
+        """Classify proteins in 'Up', 'Down', and 'Not Sig' to share classification between plots and export
+        In: a) df_ratio_pval: df with p values and ratio
+            b1) col_ratio: column from df_ratio_pval with (log2) ratio
+            b2) col_pval: column from df_ratio_pval with -log10 p value
+            c) th_filter: tuple for filtering thresholds of p_val and ratio (p_val can be given in normal scaled)
+            d) gene_list: list of genes classified just by sign of ratio
+        Out:a) classes: categorical pd.Series with class for each protein"""
+        for col in [col_ratio, col_pval]:
+            _check_col(df_ratio_pval, col=col)
+        th_p, th_ratio = th_filter
+        if th_p < 0.5:
+            th_p = -np.log10(th_p)
+        classes = _classify(df=df_ratio_pval, th_p=th_p, th_ratio=th_ratio, col_ratio=col_ratio, col_pval=col_pval,
+                            gene_list=gene_list)
+        return pd.Series(classes, index=df_ratio_pval.index, name="status")
+
     @staticmethod
     def volcano_plot(df_ratio_pval=None, col_ratio=None, col_pval=None, gene_list=None, title=None,
                      th_filter=(0.05, 0.5), th_text=None, precision=0.01, force=(0.5, 0.5, 0.25), avoid_conflict=0.25,
                      fig_format="png", verbose=True, loc_legnd=2,
-                     filled_circle=True, box=True, label_bold=False, label_size=8, minor_ticks=True):
+                     filled_circle=True, box=True, label_bold=False, label_size=8, minor_ticks=True, classes=None,
+                     cull_labels=True, max_labels=20, large_data=None):
         """Calculate p value by a two sample ttest via FDR by Benjamini Hochberg and show volcano plot
         In: a) df_ratio_pval: df with p values and ratio
             b1) col_ratio: column from df_ratio_pval to show on x-axis
@@ -175,7 +449,15 @@ class PerseusPlots:
             e) title: title of plot
             f1) fig_format: format of plot if saved
             f2) show: boolean to decide whether plot should be shown or saved
-        Out:a) Volcano plot saved in df_results or shown
+            g) classes: classes from PerseusPlots.volcano_classes (computed if None)
+            h1) cull_labels: boolean to decide whether overlapping labels are culled using a spatial grid and
+                placed for each local neighbourhood (connected grid cells) separately
+            h2) max_labels: maximum number of labels, ranked by significance and effect size (if cull_labels).
+                Genes from gene_list are always labeled. Dense neighbourhoods are placed at once, which takes
+                seconds for ~20 labels but much longer for more (None for no limit)
+            i) large_data: rendering mode for large data {None, "raster", "density"}. Not significant points
+                are rasterized ("raster") or shown as binned density ("density"), significant points stay vectors
+        Out:a) ax: axis of volcano plot with time for label placement in seconds (ax.time_placement)
         Notes
         -----
 
@@ -213,23 +495,30 @@ class PerseusPlots:
         kwargs_filter = dict(df=df_ratio_pval, col_ratio=col_ratio, col_pval=col_pval, gene_list=gene_list)
         colors = _color_filter(**kwargs_filter,
                                th_p=th_p,
-                               th_ratio=th_ratio)
+                               th_ratio=th_ratio,
+                               classes=classes)
         labels = _label_filter(**kwargs_filter,
                                th_p_text=th_p_text,
                                th_neg_ratio=th_neg_ratio,
                                th_pos_ratio=th_pos_ratio,
                                avoid_conflict=avoid_conflict)
         x_min, x_max = math.floor(df_ratio_pval[col_ratio].min()) - 1, math.ceil(df_ratio_pval[col_ratio].max()) + 1
-        print(x_min, x_max)
         _check_log_scales(x_min=x_min, x_max=x_max)
         y_max = 1.1 * df_ratio_pval[col_pval].max()
         # Plotting
-        dict_scatter = dict(y=col_pval, x=col_ratio, kind="scatter", figsize=(5, 5))
-        if filled_circle:
-            dict_scatter.update(dict(color=colors))
+        if large_data is not None:
+            if large_data not in ["raster", "density"]:
+                raise ValueError("'large_data' ({}) should be one of following: "
+                                 "[None, 'raster', 'density']".format(large_data))
+            _scatter_large_data(df=df_ratio_pval, col_ratio=col_ratio, col_pval=col_pval, colors=colors,
+                                filled_circle=filled_circle, large_data=large_data)
         else:
-            dict_scatter.update(dict(color="none", edgecolor=colors))
-        df_ratio_pval.plot(**dict_scatter)
+            dict_scatter = dict(y=col_pval, x=col_ratio, kind="scatter", figsize=(5, 5))
+            if filled_circle:
+                dict_scatter.update(dict(color=colors))
+            else:
+                dict_scatter.update(dict(color="none", edgecolor=colors))
+            df_ratio_pval.plot(**dict_scatter)
         if minor_ticks:
             plt.xticks(ticks=range(x_min, x_max + 1), labels=range(x_min, x_max + 1))
             plt.minorticks_on()
@@ -244,18 +533,20 @@ class PerseusPlots:
         plt.title(title, fontweight="bold")
         # Set labels using iterative optimization to avoid overlaps
         objects = [ax_p, ax_ra, ax_rb]
-        _set_labels(labels,
-                    objects=objects,
-                    th_filter=th_filter,
-                    fig_format=fig_format,
-                    force_points=force[0],
-                    force_text=force[1],
-                    force_objects=force[2],
-                    box=box,
-                    verbose=verbose,
-                    precision=precision,
-                    label_size=label_size,
-                    label_bold=label_bold)
+        time_placement = _set_labels(labels,
+                                     objects=objects,
+                                     th_filter=th_filter,
+                                     fig_format=fig_format,
+                                     force_points=force[0],
+                                     force_text=force[1],
+                                     force_objects=force[2],
+                                     box=box,
+                                     verbose=verbose,
+                                     precision=precision,
+                                     label_size=label_size,
+                                     label_bold=label_bold,
+                                     cull=cull_labels,
+                                     max_labels=max_labels)
         # Add legend
         list_col = [COLOR_UP, COLOR_DOWN, COLOR_NOT_SIG]
         list_legend = ["Up", "Down", "Not Sig"]
@@ -268,30 +559,174 @@ class PerseusPlots:
         plt.xlabel(col_ratio, weight="bold")
         plt.ylabel(col_pval, weight="bold")
         ax = plt.gca()
+        ax.time_placement = time_placement
         return ax
 
+    @staticmethod
+    def volcano_plots(df_ratio_pval=None, out_dir=None, contrasts=None, fig_format="png", dpi=300, n_jobs=1,
+                      **kwargs):
+        """Render volcano plots of all (or selected) contrasts headless to files
+
+        Each plot is rendered with isolated rcParams (settings of volcano_plot do not leak to further plots),
+        saved directly, and its figure closed, so memory does not grow with the number of plots.
+
+        Parameters
+        ----------
+        df_ratio_pval: pd.DataFrame with 'log2 ratio (a/b)' and '-log10 p value (a/b)' columns (PerseusPipeline.run)
+        out_dir: {str} output folder, plots are saved as 'volcano_{a}_{b}.{fig_format}'
+        contrasts: {list} default None. Contrasts given as 'a/b' or pairs (a, b). By default, all contrasts
+        fig_format: {str} default "png". Format of plots {"png", "pdf", "svg"}
+        dpi: {int} default 300. Resolution of (rasterized parts of) plots
+        n_jobs: {int} default 1. Number of processes rendering plots in parallel with non-interactive
+            backend (Agg). For n_jobs=1 plots are rendered in current process (with its backend)
+        kwargs: further arguments for volcano_plot (e.g., th_filter, gene_list, large_data). By default, title
+            is given by contrast
+
+        Returns
+        -------
+        list_files: list with files of saved plots (in order of contrasts)
+        """
+        if fig_format not in LIST_FIG_FORMATS:
+            raise ValueError("'fig_format' ({}) should be one of following: {}".format(fig_format, LIST_FIG_FORMATS))
+        list_cols = _volcano_contrasts(df=df_ratio_pval, contrasts=contrasts)
+        os.makedirs(out_dir, exist_ok=True)
+        # Just columns needed for plotting are passed to workers
+        cols = ["Gene_Name"] + list(dict.fromkeys(col for _, col_ratio, col_pval in list_cols
+                                                 for col in [col_ratio, col_pval]))
+        df = df_ratio_pval[cols]
+        list_args = []
+        for contrast, col_ratio, col_pval in list_cols:
+            kwargs_volcano = dict(title=contrast.replace("/", " vs "), fig_format=fig_format, verbose=False)
+            kwargs_volcano.update(kwargs)
+            list_args.append(dict(col_ratio=col_ratio, col_pval=col_pval, dpi=dpi, kwargs_volcano=kwargs_volcano,
+                                  file=_volcano_file(out_dir=out_dir, contrast=contrast, fig_format=fig_format)))
+        if n_jobs == 1 or len(list_args) <= 1:
+            return [_render_volcano(df=df, **args) for args in list_args]
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(list_args)), initializer=_init_volcano_worker,
+                                 initargs=(df,)) as executor:
+            futures = [executor.submit(_render_volcano_worker, **args) for args in list_args]
+            list_files = [future.result() for future in futures]
+        return list_files
+
     @staticmethod
     def volcano_plot_ia(df_ratio_pval=None, th_filter=(0.05, 0.5), title=None,
-                        col_ratio=None, col_pval=None):
-        """Interactive volcano plot"""
+                        col_ratio=None, col_pval=None, classes=None, webgl=False, max_points=None, seed=0):
+        """Interactive volcano plot
+        In: a) df_ratio_pval: df with p values and ratio
+            b1) col_ratio: column from df_ratio_pval to show on x-axis
+            b2) col_pval: column from df_ratio_pval to show on y-axis
+            c) th_filter: tuple for filtering thresholds of p_val and ratio (p_val can be given in normal scaled)
+            d) title: title of plot
+            e) classes: classes from PerseusPlots.volcano_classes (computed if None)
+            f1) webgl: boolean to decide whether WebGL (scattergl) is used without violin marginal (for large data)
+            f2) max_points: maximum number of points shown. Not significant points are randomly downsampled
+            f3) seed: seed for downsampling
+        Out:a) fig: plotly figure"""
         if title is None:
             title = "Volcano Plot for KO vs WT"
-        # Adjust threshold
-        th_p, th_ratio = th_filter
-        if th_p < 0.5:
-            th_p = -np.log10(th_p)
-        colors = _color_filter(df=df_ratio_pval,
-                               col_ratio=col_ratio,
-                               col_pval=col_pval,
-                               th_p=th_p,
-                               th_ratio=th_ratio)
-        dict_color_label = {COLOR_UP: "Up", COLOR_DOWN: "Down", COLOR_NOT_SIG: "Not Sig"}
-        colors = [dict_color_label[color] for color in colors]
+        if classes is None:
+            classes = PerseusPlots.volcano_classes(df_ratio_pval=df_ratio_pval, col_ratio=col_ratio,
+                                                   col_pval=col_pval, th_filter=th_filter)
+        classes = np.asarray(classes)
+        if max_points is not None and len(df_ratio_pval) > max_points:
+            mask_not_sig = classes == "Not Sig"
+            n_keep = max(max_points - int((~mask_not_sig).sum()), 0)
+            rng = np.random.default_rng(seed)
+            idx_keep = rng.choice(np.flatnonzero(mask_not_sig), size=min(n_keep, int(mask_not_sig.sum())),
+                                  replace=False)
+            mask_keep = ~mask_not_sig
+            mask_keep[idx_keep] = True
+            df_ratio_pval, classes = df_ratio_pval[mask_keep], classes[mask_keep]
+        kwargs_mode = dict(render_mode="webgl") if webgl else dict(marginal_y="violin")
         fig = px.scatter(df_ratio_pval, hover_name="Gene_Name",
                          labels={col_ratio: col_ratio,
                                  col_pval: col_pval,
                                  "color": "status"},
                          x=col_ratio, y=col_pval,
-                         color=colors, template="plotly_white", marginal_y="violin")
+                         color=classes, template="plotly_white", **kwargs_mode)
         fig.update_layout(title_text=title, title_x=0.5)
         fig.show()
+        return fig
+
+    @staticmethod
+    def heatmap(df_lfq=None, df_ratio_pval=None, dict_col_group=None, th_filter=(0.05, 0.5), cols_ratio=None,
+                cluster_on="samples", method="average", cluster_cols=False, v_lim=2.5, cmap="RdBu_r",
+                figsize=(6, 8), title=None, row_labels=None):
+        """Hierarchically clustered heatmap of z-scored lfq values of significant proteins (as in Perseus)
+        In: a) df_lfq: df with lfq values (log2 scale), index matching with df_ratio_pval
+            b) df_ratio_pval: df with ratio and p value columns from PerseusPipeline.run
+            c) dict_col_group: dict with intensity column to group names (columns are ordered by groups)
+            d1) th_filter: tuple for filtering thresholds of p_val and ratio (p_val can be given in normal scaled)
+            d2) cols_ratio: ratio columns for selection of significant proteins (significant in any), all if None
+            e1) cluster_on: {'samples', 'groups'} cluster proteins on z-scores of samples or on averaged group
+                profiles (faster for many samples)
+            e2) method: linkage method (e.g., 'average', 'complete', 'ward'). Distances are computed as condensed
+                matrix (n * (n - 1) / 2), NaN set to 0 (mean of row)
+            e3) cluster_cols: boolean to decide whether samples are clustered (otherwise ordered by groups)
+            f1) v_lim: limit of color scale for z-scores (-v_lim, v_lim)
+            f2) cmap, figsize, title: settings of plot
+            f3) row_labels: boolean to decide whether gene names are shown (default if less than 100 rows)
+        Out:a) ax: axis of heatmap (cells are rasterized)
+            b) df_zscore: df with z-scores of significant proteins in order of heatmap"""
+        if cluster_on not in ["samples", "groups"]:
+            raise ValueError("'cluster_on' ({}) should be one of following: ['samples', 'groups']".format(cluster_on))
+        th_p, th_ratio = th_filter
+        if th_p < 0.5:
+            th_p = -np.log10(th_p)
+        if cols_ratio is None:
+            cols_ratio = [col for col in list(df_ratio_pval) if col.startswith(ut.STR_LOG2_RATIO)]
+        mask = _significant_rows(df=df_ratio_pval, cols_ratio=cols_ratio, th_p=th_p, th_ratio=th_ratio)
+        if mask.sum() < 2:
+            raise ValueError("At least two significant proteins are required for clustering ({})".format(mask.sum()))
+        index = df_ratio_pval.index[mask]
+        groups = list(dict.fromkeys(dict_col_group.values()))
+        cols = [col for group in groups for col in dict_col_group if dict_col_group[col] == group]
+        z = _zscore_rows(values=df_lfq.loc[index, cols].to_numpy(dtype=np.float64))
+        # Cluster proteins (and samples)
+        if cluster_on == "groups":
+            group_codes = np.array([groups.index(dict_col_group[col]) for col in cols])
+            valid = ~np.isnan(z)
+            member = (group_codes[:, np.newaxis] == np.arange(len(groups))).astype(float)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                profiles = (np.where(valid, z, 0) @ member) / (valid @ member)
+            z_link, order = _linkage_order(values=profiles, method=method)
+        else:
+            z_link, order = _linkage_order(values=z, method=method)
+        order_cols = _linkage_order(values=z.T, method=method)[1] if cluster_cols else np.arange(len(cols))
+        z = z[order][:, order_cols]
+        cols = [cols[i] for i in order_cols]
+        df_zscore = pd.DataFrame(z, index=index[order], columns=cols)
+        # Plot dendrogram, group bar, and heatmap
+        fig = plt.figure(figsize=figsize)
+        grid = fig.add_gridspec(2, 3, width_ratios=[1, 5, 0.2], height_ratios=[0.3, 10], wspace=0.02, hspace=0.02)
+        ax_dend = fig.add_subplot(grid[1, 0])
+        ax_dend.add_collection(LineCollection(_dendrogram_segments(z_link=z_link, order=order), colors="black",
+                                              linewidths=0.5))
+        ax_dend.set_xlim(z_link[:, 2].max() * 1.05, 0)
+        ax_dend.set_ylim(len(order), 0)
+        ax_dend.axis("off")
+        ax_group = fig.add_subplot(grid[0, 1])
+        group_codes = np.array([[groups.index(dict_col_group[col]) for col in cols]])
+        cmap_group = mpl.colors.ListedColormap(sns.color_palette(n_colors=len(groups)))
+        ax_group.imshow(group_codes, aspect="auto", cmap=cmap_group, interpolation="nearest", vmin=-0.5,
+                        vmax=len(groups) - 0.5)
+        ax_group.set_xticks([])
+        ax_group.set_yticks([])
+        if title is not None:
+            ax_group.set_title(title, fontweight="bold")
+        ax = fig.add_subplot(grid[1, 1])
+        cmap = plt.get_cmap(cmap).with_extremes(bad="lightgray")
+        im = ax.imshow(z, aspect="auto", cmap=cmap, vmin=-v_lim, vmax=v_lim, interpolation="nearest",
+                       rasterized=True)
+        ax.set_xticks(range(len(cols)))
+        ax.set_xticklabels(cols, rotation=90)
+        if row_labels is None:
+            row_labels = len(index) < 100
+        if row_labels and "Gene_Name" in list(df_ratio_pval):
+            ax.set_yticks(range(len(index)))
+            ax.set_yticklabels(df_ratio_pval.loc[df_zscore.index, "Gene_Name"].tolist(), fontsize=6)
+            ax.yaxis.tick_right()
+        else:
+            ax.set_yticks([])
+        fig.colorbar(im, cax=fig.add_subplot(grid[1, 2]), label="z-score")
+        return ax, df_zscore
@@ -0,0 +1,136 @@
+"""
+This is a script for sample level quality control (PCA) in Perseus pipeline
+
+References
+----------
+[1] Halko N., Martinsson P. G., and Tropp J. A., Finding structure with randomness: Probabilistic algorithms
+    for constructing approximate matrix decompositions. SIAM Review (2011)
+"""
+import numpy as np
+import pandas as pd
+from matplotlib import pyplot as plt
+import seaborn as sns
+
+from perseuspy.per_base import _freeze
+from perseuspy.per_imput import PerseusImputation
+
+
+# I Helper Functions
+def _check_nan_policy(nan_policy=None):
+    """Check NaN handling for PCA"""
+    nan_policies = ["drop", "impute"]
+    if nan_policy not in nan_policies:
+        raise ValueError("'nan_policy' ({}) should be one of following: {}".format(nan_policy, nan_policies))
+
+
+def _randomized_svd(x=None, n_components=2, n_oversamples=10, n_iter=4, rng=None):
+    """Truncated SVD by randomized range finder with power iterations (Halko et al., 2011)
+    In: a) x: array (samples x proteins)
+        b) n_components: number of singular values/vectors
+        c) n_oversamples: additional random vectors for range finder
+        d) n_iter: number of power iterations (with QR re-orthonormalization)
+        e) rng: np.random.Generator
+    Out:a) u, s, vt: truncated SVD with signs flipped to positive largest loading"""
+    n_random = min(n_components + n_oversamples, min(x.shape))
+    q = x @ rng.standard_normal((x.shape[1], n_random))
+    q, _ = np.linalg.qr(q)
+    for _ in range(n_iter):
+        q, _ = np.linalg.qr(x.T @ q)
+        q, _ = np.linalg.qr(x @ q)
+    u_b, s, vt = np.linalg.svd(q.T @ x, full_matrices=False)
+    u = q @ u_b
+    u, s, vt = u[:, :n_components], s[:n_components], vt[:n_components]
+    signs = np.sign(vt[np.arange(len(vt)), np.argmax(np.abs(vt), axis=1)])
+    return u * signs, s, vt * signs[:, np.newaxis]
+
+
+# II Main Functions
+class PerseusQC(PerseusImputation):
+    """Class for Perseus analysis"""
+    def __init__(self, **kwargs):
+        PerseusImputation.__init__(self, **kwargs)
+        self._pca_cache = {}
+
+    def pca(self, df_lfq=None, n_components=2, nan_policy="drop", kwargs_impute=None, scale=False,
+            n_oversamples=10, n_iter=4, seed=0):
+        """Principal component analysis of samples by randomized truncated SVD
+
+        Results for the (read-only) core matrix (df_lfq is None) are cached by parameters, so that repeated
+        plotting does not repeat decomposition. Results for given df_lfq are not cached, since it can be modified
+        in place.
+
+        Parameters
+        ----------
+        df_lfq: pd.DataFrame with lfq values (in log2 scale). If None, core matrix (log2 input) is used
+        n_components: {int} default 2. Number of principal components
+        nan_policy: {str} default "drop". NaN handling: drop proteins with missing values ("drop") or impute
+            missing values by imputation of pipeline ("impute", see PerseusImputation.impute)
+        kwargs_impute: {dict} default None. Arguments for imputation (e.g., method, seed)
+        scale: {bool} default False. Whether proteins are scaled to unit variance (besides centering)
+        n_oversamples: {int} default 10. Additional random vectors of randomized SVD
+        n_iter: {int} default 4. Number of power iterations of randomized SVD
+        seed: {int} default 0. Seed of randomized SVD
+
+        Returns
+        -------
+        dict with
+            scores: pd.DataFrame (samples x components) with PCA scores and group of samples
+            loadings: pd.DataFrame (proteins x components) with loadings of proteins
+            explained_variance: pd.Series with explained variance ratio of components
+        """
+        _check_nan_policy(nan_policy=nan_policy)
+        key = None
+        if df_lfq is None:
+            key = (n_components, nan_policy, _freeze(kwargs_impute), scale, n_oversamples, n_iter, seed)
+            try:
+                if key in self._pca_cache:
+                    return self._pca_cache[key]
+            except TypeError:
+                # Unhashable arguments (e.g., objects in kwargs_impute) are not cached
+                key = None
+        df = self._get_df_lfq() if df_lfq is None else df_lfq
+        if nan_policy == "drop":
+            df = df[df.notna().all(axis=1)]
+        else:
+            kwargs_impute = dict(kwargs_impute or {})
+            df = self.impute(df_lfq=df, method=kwargs_impute.pop("method", "normal"), **kwargs_impute)
+        # Samples x proteins, proteins centered (and scaled)
+        x = df.to_numpy(dtype=np.float64).T
+        x = x - x.mean(axis=0)
+        if scale:
+            std = x.std(axis=0, ddof=1)
+            x = x / np.where(std > 0, std, 1)
+        if n_components > min(x.shape):
+            raise ValueError("'n_components' ({}) should be <= {}".format(n_components, min(x.shape)))
+        u, s, vt = _randomized_svd(x=x, n_components=n_components, n_oversamples=n_oversamples, n_iter=n_iter,
+                                   rng=np.random.default_rng(seed))
+        cols = ["PC{}".format(i + 1) for i in range(n_components)]
+        df_scores = pd.DataFrame(u * s, columns=cols, index=list(df))
+        df_scores["group"] = [self.dict_col_group[self.list_col_lfq[self._dict_col_pos[col]]]
+                              if col in self._dict_col_pos else None for col in df_scores.index]
+        df_loadings = pd.DataFrame(vt.T, columns=cols, index=df.index)
+        explained_variance = pd.Series(s ** 2 / np.sum(x ** 2), index=cols, name="explained variance ratio")
+        result = dict(scores=df_scores, loadings=df_loadings, explained_variance=explained_variance)
+        if key is not None:
+            self._pca_cache[key] = result
+        return result
+
+    def pca_plot(self, df_lfq=None, pcs=(1, 2), title=None, figsize=(5, 5), ax=None, **kwargs):
+        """Score plot of samples for two principal components colored by group (kwargs see pca)
+        In: a) df_lfq: df with lfq values (core matrix if None)
+            b) pcs: tuple with numbers of principal components to show
+            c) title, figsize, ax: settings of plot
+        Out:a) ax: axis of score plot"""
+        kwargs["n_components"] = max(max(pcs), kwargs.get("n_components", 2))
+        result = self.pca(df_lfq=df_lfq, **kwargs)
+        df_scores, explained_variance = result["scores"], result["explained_variance"]
+        col_x, col_y = ["PC{}".format(i) for i in pcs]
+        if ax is None:
+            _, ax = plt.subplots(figsize=figsize)
+        sns.scatterplot(data=df_scores, x=col_x, y=col_y, hue="group", ax=ax, s=60)
+        ax.set_xlabel("{} ({:.1f}%)".format(col_x, 100 * explained_variance[col_x]), weight="bold")
+        ax.set_ylabel("{} ({:.1f}%)".format(col_y, 100 * explained_variance[col_y]), weight="bold")
+        if title is not None:
+            ax.set_title(title, fontweight="bold")
+        sns.despine(ax=ax)
+        return ax
@@ -0,0 +1,83 @@
+"""
+This is a script for simulation of label free quantification (LFQ) data with known differential proteins
+
+References
+----------
+[1] Lazar C., et al. Accounting for the Multiple Natures of Missing Values in Label-Free Quantitative
+    Proteomics Data Sets to Compare Imputation Strategies. Journal of Proteome Research (2016)
+"""
+import numpy as np
+import pandas as pd
+
+import perseuspy._utils as ut
+
+
+# I Helper Functions
+def _check_fraction(name=None, val=None):
+    """Check if value is fraction in [0, 1)"""
+    if not 0 <= val < 1:
+        raise ValueError("'{}' ({}) should be in [0, 1)".format(name, val))
+
+
+def _mnar_mask(values=None, frac_mnar=0.1, sd_threshold=0.3, rng=None):
+    """Left censoring: values below noisy intensity threshold (at 'frac_mnar' quantile) are missing"""
+    if frac_mnar == 0:
+        return np.zeros(values.shape, dtype=bool)
+    threshold = np.quantile(values, frac_mnar)
+    thresholds = rng.normal(threshold, sd_threshold, size=values.shape).astype(values.dtype)
+    return values < thresholds
+
+
+# II Main Functions
+def simulate_lfq(n_proteins=1000, n_samples=3, groups=None, frac_de=0.1, effect_size=1.0, mean=25, sd_protein=2.0,
+                 sd_noise=0.3, frac_mcar=0.02, frac_mnar=0.1, sd_threshold=0.3, seed=None, dtype=np.float32):
+    """Simulate LFQ data (log2 scale) with differential proteins and missing values
+
+    Parameters
+    ----------
+    n_proteins: {int} default 1000. Number of proteins (rows)
+    n_samples: {int} default 3. Number of samples (replicates) per group
+    groups: {list} default None. Group names (default ["A", "B"]). Differential proteins are shifted in all
+        groups except the last one (reference)
+    frac_de: {float} default 0.1. Fraction of differential proteins (first rows)
+    effect_size: {float} default 1.0. Absolute log2 ratio of differential proteins (random sign)
+    mean: {float} default 25. Mean log2 intensity of proteins
+    sd_protein: {float} default 2.0. Standard deviation of log2 intensity between proteins
+    sd_noise: {float} default 0.3. Standard deviation of log2 intensity between samples (technical + biological)
+    frac_mcar: {float} default 0.02. Fraction of values missing completely at random
+    frac_mnar: {float} default 0.1. Approximate fraction of values missing not at random (left censored by
+        noisy detection threshold)
+    sd_threshold: {float} default 0.3. Standard deviation of detection threshold for MNAR values
+    seed: {int} default None. Seed for simulation
+    dtype: {np.dtype} default np.float32. Data type of intensity columns
+
+    Returns
+    -------
+    df: pd.DataFrame with ut.COL_ACC, ut.COL_GENE, "is_de" (ground truth), and intensity columns
+        named "log2 LFQ {group}_{replicate}"
+    dict_col_group: dict with intensity column to group names (see get_dict_groups)
+    """
+    for name, val in [("frac_de", frac_de), ("frac_mcar", frac_mcar), ("frac_mnar", frac_mnar)]:
+        _check_fraction(name=name, val=val)
+    groups = ["A", "B"] if groups is None else groups
+    rng = np.random.default_rng(seed)
+    n_groups = len(groups)
+    n_de = int(round(n_proteins * frac_de))
+    # Protein abundance + group effect + sample noise
+    values = rng.normal(mean, sd_protein, size=(n_proteins, 1)).astype(dtype)
+    effects = np.zeros((n_proteins, n_groups), dtype=dtype)
+    effects[:n_de, :-1] = effect_size * rng.choice([-1, 1], size=(n_de, n_groups - 1))
+    values = values + np.repeat(effects, n_samples, axis=1)
+    values += rng.normal(0, sd_noise, size=values.shape).astype(dtype)
+    # Missing values
+    mask = _mnar_mask(values=values, frac_mnar=frac_mnar, sd_threshold=sd_threshold, rng=rng)
+    mask |= rng.random(values.shape) < frac_mcar
+    values[mask] = np.nan
+    dict_col_group = {"{} {}_{}".format(ut.STR_LOG2_INTENSITY, group, i): group
+                      for group in groups for i in range(1, n_samples + 1)}
+    cols = list(dict_col_group)
+    df = pd.DataFrame(values, columns=cols)
+    df.insert(0, "is_de", np.arange(n_proteins) < n_de)
+    df.insert(0, ut.COL_GENE, ["G{}".format(i) for i in range(n_proteins)])
+    df.insert(0, ut.COL_ACC, ["P{}".format(i) for i in range(n_proteins)])
+    return df, dict_col_group
@@ -4,8 +4,10 @@ This is a script for statistical tests in Perseus pipeline
 import time
 import numpy as np
 import pandas as pd
-from scipy.stats import ttest_ind
+from scipy.stats import t as t_dist, f as f_dist
+from scipy.special import digamma, polygamma
 from statsmodels.stats.multitest import multipletests
+from concurrent.futures import ProcessPoolExecutor
 import functools
 import warnings
 
@@ -38,26 +40,276 @@ def ignore_warning(simplefilter=True, category=RuntimeWarning):
 
 def _check_p_correction(method=None):
     """Check p value correction methods"""
-    p_corrections = ["bonferroni", "sidak", "holm", "hommel", "fdr_bh"]
+    p_corrections = ["bonferroni", "sidak", "holm", "hommel", "fdr_bh", "fdr_by"]
     if method is not None and method not in p_corrections:
         raise ValueError("P value correction should be one of following: " + str(p_corrections))
 
 
-def _correct_p_val(p_vals=None, method=None):
-    """Correct p values with given methods"""
+def _correct_p_val(p_vals=None, method=None, exclude_nan=False):
+    """Correct p values with given methods for each column of p value array (proteins x contrasts)
+    In: a) p_vals: array (1D or 2D) with p values, NaN for untestable proteins
+        b) method: correction method {None, "bonferroni", "sidak", "holm", "hommel", "fdr_bh", "fdr_by"}
+        c) exclude_nan: boolean to decide whether NaN p values are excluded from number of tests.
+            If False, NaN p values are counted as p=1
+    Out:a) cor_p_vals: array with corrected p values (NaN for NaN p values)"""
     _check_p_correction(method=method)
-    if method is not None:
-        p_vals = [p if str(p) != "nan" else 1 for p in p_vals]
-        cor_p_vals = multipletests(p_vals, method=method)[1]
-        p_vals = [p if str(p_vals[i]) != "nan" else np.nan for i, p in enumerate(cor_p_vals)]
-    return p_vals
+    p_vals = np.asarray(p_vals, dtype=np.float64)
+    if method is None:
+        return p_vals
+    p_2d = p_vals.reshape(len(p_vals), -1)
+    mask_nan = np.isnan(p_2d)
+    n = np.full(p_2d.shape[1], len(p_2d)) if not exclude_nan else (~mask_nan).sum(axis=0)
+    if method == "hommel":
+        cor_p_2d = np.full(p_2d.shape, np.nan)
+        for j in range(p_2d.shape[1]):
+            mask = ~mask_nan[:, j] if exclude_nan else np.ones(len(p_2d), dtype=bool)
+            if mask.any():
+                cor_p_2d[mask, j] = multipletests(np.nan_to_num(p_2d[mask, j], nan=1), method=method)[1]
+    elif method == "bonferroni":
+        cor_p_2d = np.minimum(p_2d * n, 1)
+    elif method == "sidak":
+        with np.errstate(divide="ignore"):
+            cor_p_2d = -np.expm1(n * np.log1p(-p_2d))
+    else:
+        # NaN sorted at the end either as p=1 or excluded (inf) from family of tests
+        p_filled = np.where(mask_nan, 1 if not exclude_nan else np.inf, p_2d)
+        order = np.argsort(p_filled, axis=0, kind="stable")
+        p_sorted = np.take_along_axis(p_filled, order, axis=0)
+        rank = np.arange(1, len(p_2d) + 1)[:, np.newaxis]
+        with np.errstate(invalid="ignore"):
+            if method == "holm":
+                cor_sorted = np.maximum.accumulate((n - rank + 1) * p_sorted, axis=0)
+            else:
+                cor_sorted = p_sorted * n / rank
+                if method == "fdr_by":
+                    cor_sorted = cor_sorted * np.array([np.sum(1 / np.arange(1, n_j + 1)) for n_j in n])
+                cor_sorted = np.minimum.accumulate(cor_sorted[::-1], axis=0)[::-1]
+        cor_p_2d = np.empty(p_2d.shape)
+        np.put_along_axis(cor_p_2d, order, np.minimum(cor_sorted, 1), axis=0)
+    cor_p_2d[mask_nan] = np.nan
+    return cor_p_2d.reshape(p_vals.shape)
+
+
+def _ttest_stats(n=None, mean=None, var=None, idx_a=None, idx_b=None, equal_var=True):
+    """Two sample t test for all group pairs from group statistics by broadcasting
+    In: a) n, mean, var: arrays (proteins x groups) with valid count, mean, and variance of groups
+        b) idx_a, idx_b: arrays with group indices of pairs (a, b)
+        c) equal_var: boolean to decide between Student (True) and Welch (False) t test
+    Out:a) t_vals: array (proteins x pairs) with t statistic
+        b) p_vals: array (proteins x pairs) with two-sided p value"""
+    n_a, n_b = n[:, idx_a], n[:, idx_b]
+    diff = mean[:, idx_a] - mean[:, idx_b]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if equal_var:
+            # Sum of squares is 0 for groups with one valid value
+            ss_a = np.where(n_a > 1, (n_a - 1) * var[:, idx_a], 0)
+            ss_b = np.where(n_b > 1, (n_b - 1) * var[:, idx_b], 0)
+            df = n_a + n_b - 2
+            se = np.sqrt((ss_a + ss_b) / df * (1 / n_a + 1 / n_b))
+            invalid = (n_a < 1) | (n_b < 1) | (df < 1)
+        else:
+            se_a, se_b = var[:, idx_a] / n_a, var[:, idx_b] / n_b
+            se = np.sqrt(se_a + se_b)
+            df = (se_a + se_b) ** 2 / (se_a ** 2 / (n_a - 1) + se_b ** 2 / (n_b - 1))
+            invalid = (n_a < 2) | (n_b < 2)
+        t_vals = diff / se
+    t_vals[invalid] = np.nan
+    p_vals = 2 * t_dist.sf(np.abs(t_vals), np.where(invalid, 1, df))
+    return t_vals, p_vals
+
+
+def _trigamma_inverse(x=None, tol=1e-8, max_iter=50):
+    """Inverse of trigamma function by Newton iteration (Smyth, 2004)"""
+    if x > 1e7:
+        return 1 / np.sqrt(x)
+    if x < 1e-6:
+        return 1 / x
+    y = 0.5 + 1 / x
+    for _ in range(max_iter):
+        tri = polygamma(1, y)
+        dif = tri * (1 - tri / x) / polygamma(2, y)
+        y += dif
+        if -dif / y < tol:
+            break
+    return y
+
+
+def _fit_f_dist(s2=None, df=None):
+    """Fit scaled F distribution to residual variances by moments of log variances (Smyth, 2004)
+    In: a) s2: array with residual variance of proteins
+        b) df: array with residual degrees of freedom of proteins
+    Out:a) d0: prior degrees of freedom (inf if no variation of variances beyond sampling)
+        b) s2_prior: prior variance"""
+    valid = (df > 0) & (s2 > 0) & np.isfinite(s2)
+    s2, df = s2[valid], df[valid]
+    if len(s2) < 2:
+        raise ValueError("At least two proteins with residual variance are required to estimate prior")
+    e = np.log(s2) - digamma(df / 2) + np.log(df / 2)
+    e_mean = e.mean()
+    e_var = e.var(ddof=1) - polygamma(1, df / 2).mean()
+    if e_var > 0:
+        d0 = 2 * _trigamma_inverse(e_var)
+        s2_prior = np.exp(e_mean + digamma(d0 / 2) - np.log(d0 / 2))
+    else:
+        d0 = np.inf
+        s2_prior = np.exp(e_mean)
+    return d0, s2_prior
+
+
+def _moderated_ttest_stats(n=None, mean=None, var=None, idx_a=None, idx_b=None):
+    """Empirical Bayes moderated t test (limma) for all group pairs from group statistics
+    In: a) n, mean, var: arrays (proteins x groups) with valid count, mean, and variance of groups
+        b) idx_a, idx_b: arrays with group indices of pairs (a, b)
+    Out:a) t_vals: array (proteins x pairs) with moderated t statistic
+        b) p_vals: array (proteins x pairs) with two-sided p value
+        c) d0, s2_prior: prior degrees of freedom and variance"""
+    # Residual variance pooled over all groups with NaN aware degrees of freedom
+    df_res = np.maximum(n - 1, 0).sum(axis=1)
+    ss = np.where(n > 1, (n - 1) * var, 0).sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        s2 = ss / df_res
+    d0, s2_prior = _fit_f_dist(s2=s2, df=df_res)
+    # Posterior variance shrunken towards prior (prior for proteins without residual degrees of freedom)
+    if np.isinf(d0):
+        s2_post = np.full(len(s2), s2_prior)
+    else:
+        s2_post = (d0 * s2_prior + np.where(df_res > 0, df_res * s2, 0)) / (d0 + df_res)
+    df_total = np.minimum(df_res + d0, df_res.sum())
+    n_a, n_b = n[:, idx_a], n[:, idx_b]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t_vals = (mean[:, idx_a] - mean[:, idx_b]) / np.sqrt(s2_post[:, np.newaxis] * (1 / n_a + 1 / n_b))
+    t_vals[(n_a < 1) | (n_b < 1)] = np.nan
+    p_vals = 2 * t_dist.sf(np.abs(t_vals), df_total[:, np.newaxis])
+    return t_vals, p_vals, d0, s2_prior
+
+
+def _anova_f(n=None, mean=None, var=None):
+    """NaN aware one-way ANOVA for each protein from group statistics
+    In: a) n, mean, var: arrays (proteins x groups) with valid count, mean, and variance of groups
+    Out:a) f_vals: F statistic for each protein
+        b) p_vals: p value for each protein"""
+    ss_group = np.where(n > 1, (n - 1) * var, 0)
+    n_total = n.sum(axis=1)
+    n_valid_groups = (n > 0).sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        grand_mean = np.nansum(n * mean, axis=1) / n_total
+        ss_between = np.nansum(n * (mean - grand_mean[:, np.newaxis]) ** 2, axis=1)
+        ss_within = ss_group.sum(axis=1)
+        df_between = n_valid_groups - 1
+        df_within = n_total - n_valid_groups
+        f_vals = (ss_between / df_between) / (ss_within / df_within)
+    invalid = (df_between < 1) | (df_within < 1)
+    f_vals[invalid] = np.nan
+    p_vals = f_dist.sf(f_vals, np.where(invalid, 1, df_between), np.where(invalid, 1, df_within))
+    return f_vals, p_vals
+
+
+def _pool_rubin(q=None, u=None, df_com=None):
+    """Pool estimates of multiple imputations by Rubin's rules with Barnard-Rubin degrees of freedom
+    In: a) q: array (imputations x proteins x contrasts) with estimates (e.g., log2 ratio)
+        b) u: array (imputations x proteins x contrasts) with variance of estimates
+        c) df_com: array (proteins x contrasts) with degrees of freedom of complete data
+    Out:a) q_mean: pooled estimate
+        b) p_vals: two-sided p value of pooled t statistic"""
+    m = len(q)
+    if m < 2:
+        raise ValueError("At least two imputations are required for pooling ({})".format(m))
+    q_mean = q.mean(axis=0)
+    u_mean = u.mean(axis=0)
+    b = q.var(axis=0, ddof=1)
+    total = u_mean + (1 + 1 / m) * b
+    with np.errstate(divide="ignore", invalid="ignore"):
+        gamma = (1 + 1 / m) * b / total
+        df_m = (m - 1) / gamma ** 2
+        df_obs = (df_com + 1) / (df_com + 3) * df_com * (1 - gamma)
+        df = 1 / (1 / df_m + 1 / df_obs)
+        t_vals = q_mean / np.sqrt(total)
+    invalid = np.isnan(t_vals) | ~(df > 0)
+    p_vals = 2 * t_dist.sf(np.abs(t_vals), np.where(invalid, 1, df))
+    p_vals[invalid] = np.nan
+    return q_mean, p_vals
+
+
+# Permutation based FDR
+_PERM_DATA = {}
+
+
+def _init_perm_worker(values_lfq=None, dict_pair_idx=None):
+    """Set LFQ matrix and sample columns (idx_a, idx_b) of each group pair as module data for (worker) process"""
+    _PERM_DATA.clear()
+    _PERM_DATA.update(dict(values_lfq=values_lfq, dict_pair_idx=dict_pair_idx))
+
+
+def _perm_data(pair=None):
+    """Get centered values (NaN set to 0), valid mask, squared values, and sample labels of group pair.
+    Just data of the last pair is kept in each process"""
+    if _PERM_DATA.get("pair") != pair:
+        idx_a, idx_b = _PERM_DATA["dict_pair_idx"][pair]
+        values = _PERM_DATA["values_lfq"][:, np.concatenate([idx_a, idx_b])].astype(np.float64)
+        valid = ~np.isnan(values)
+        # Center rows to avoid cancellation in sum of squares
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            values = values - np.nanmean(values, axis=1, keepdims=True)
+        values[~valid] = 0
+        labels = np.array([1.0] * len(idx_a) + [0.0] * len(idx_b))
+        _PERM_DATA.update(dict(pair=pair, values=values, valid=valid.astype(np.float64), values_sq=values ** 2,
+                               labels=labels))
+    return _PERM_DATA
+
+
+def _sam_statistic(member=None, s0=0.1, data=None):
+    """Compute SAM statistic (Tusher et al., 2001) for all proteins and label assignments at once
+    In: a) member: array (permutations x samples) with 1 for samples of group a and 0 for group b
+        b) s0: fudge factor added to standard error (s0=0 results in t statistic)
+        c) data: dict with centered values, valid mask and squared values of group pair (see _perm_data)
+    Out:a) d: array (permutations x proteins) with SAM statistic"""
+    values, valid, values_sq = data["values"], data["valid"], data["values_sq"]
+    # Group sums via matrix product (NaN set to 0 in values)
+    n_a = member @ valid.T
+    sum_a = member @ values.T
+    sq_a = member @ values_sq.T
+    n_b = valid.sum(axis=1) - n_a
+    sum_b = values.sum(axis=1) - sum_a
+    sq_b = values_sq.sum(axis=1) - sq_a
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_a, mean_b = sum_a / n_a, sum_b / n_b
+        ss = (sq_a - sum_a * mean_a) + (sq_b - sum_b * mean_b)
+        se = np.sqrt(np.maximum(ss, 0) / (n_a + n_b - 2) * (1 / n_a + 1 / n_b))
+        d = (mean_a - mean_b) / (se + s0)
+    d[(n_a < 1) | (n_b < 1) | (n_a + n_b < 3)] = np.nan
+    return d
+
+
+def _perm_null_counts(args):
+    """Count permuted |d| values above each observed (sorted) |d| for one batch of permutations of group pair"""
+    pair, seed_seq, n_perm, d_obs_sorted, s0 = args
+    data = _perm_data(pair=pair)
+    rng = np.random.default_rng(seed_seq)
+    labels = np.tile(data["labels"], (n_perm, 1))
+    member = rng.permuted(labels, axis=1)
+    d_null = np.abs(_sam_statistic(member=member, s0=s0, data=data)).ravel()
+    d_null = np.sort(d_null[~np.isnan(d_null)])
+    counts = len(d_null) - np.searchsorted(d_null, d_obs_sorted, side="left")
+    return counts
+
+
+def _pair_seed(entropy=None, all_pairs=None, pair=None):
+    """Random stream of group pair given just by seed entropy and position of pair in all pairs (reversed pairs
+    follow), so that q values do not depend on further requested contrasts"""
+    if pair in all_pairs:
+        i = all_pairs.index(pair)
+    else:
+        i = len(all_pairs) + all_pairs.index(pair[::-1])
+    return np.random.SeedSequence(entropy, spawn_key=(i, ))
 
 
-@ignore_warning(simplefilter=False, category=RuntimeWarning)
-def _ttest_no_warning(df_group_a, df_group_b):
-    """Call ttest ignoring RuneTime Warning"""
-    p_vals = ttest_ind(df_group_a, df_group_b, axis=1, nan_policy="omit")[1]
-    return p_vals
+def _q_values(d_obs=None, null_counts=None, n_perm=None):
+    """Get q values from observed |d| values (sorted descending) and counts of permuted |d|"""
+    n_obs = len(d_obs) - np.searchsorted(d_obs[::-1], d_obs, side="left")
+    fdr = (null_counts / n_perm) / n_obs
+    q_vals = np.minimum.accumulate(fdr[::-1])[::-1]
+    return np.minimum(q_vals, 1)
 
 
 # II Main Functions
@@ -66,43 +318,115 @@ class PerseusTests(PerseusBase):
     def __init__(self, **kwargs):
         PerseusBase.__init__(self, **kwargs)
 
-    def ttest(self, df_lfq=None, method=None, nan_policy="omit", log10_out=True):
+    def ttest(self, df_lfq=None, method=None, nan_policy="omit", log10_out=True, equal_var=True, contrasts=None,
+              exclude_nan=False):
         """Pairwise t test for groups of data frame
         In: a) df_lfq: df with lfq values (in log2 scale with values for each sample)
-            b) method: Correction method for ttest {None, "bonferroni", "sidak", "holm", "hommel", "fdr_bh"}
+            b) method: Correction method for ttest
+                {None, "bonferroni", "sidak", "holm", "hommel", "fdr_bh", "fdr_by"}
             c) nan_policy: NaN handling {'propagate', 'raise', 'omit'}
                 'propagate': returns nan if any value NaN
                 'raise': throws an error
                 'omit': performs the calculations ignoring nan values
             d) log10_out: Boolean to decide whether p value should be in -log10 or normal scale
+            e) equal_var: Boolean to decide between Student (True) and Welch (False) t test
+            f) contrasts: group comparisons (see PerseusBase.get_contrasts), by default all pairs
+            g) exclude_nan: Boolean to decide whether untestable proteins (NaN) are excluded from number of tests
         Out:a) df_pval: df with p value for each group comparison
         """
         _check_p_correction(method=method)
+        if nan_policy not in ["propagate", "raise", "omit"]:
+            raise ValueError("'nan_policy' ({}) should be one of following: "
+                             "['propagate', 'raise', 'omit']".format(nan_policy))
         pval_str = "p value "
-        dict_p_vals = {}
-        ratio_pairs = []
-        for a in self.list_groups:
-            for b in self.list_groups:
-                if a != b and {a, b} not in ratio_pairs:
-                    df_group_a = df_lfq[self.dict_group_cols[a]]
-                    df_group_b = df_lfq[self.dict_group_cols[b]]
-                    if nan_policy == "omit":
-                        p_vals = _ttest_no_warning(df_group_a, df_group_b)
-                    else:
-                        p_vals = ttest_ind(df_group_a, df_group_b, axis=1, nan_policy=nan_policy)[1]
-                    p_vals = _correct_p_val(p_vals=p_vals, method=method)
-                    ratio_pairs.append({a, b})
-                    dict_p_vals[pval_str + "({}/{})".format(a, b)] = p_vals
-        df_pval = pd.DataFrame(dict_p_vals)
+        pairs = self.get_contrasts(contrasts=contrasts)
+        dict_group_i = {group: i for i, group in enumerate(self.list_groups)}
+        idx_a = np.array([dict_group_i[a] for a, b in pairs], dtype=int)
+        idx_b = np.array([dict_group_i[b] for a, b in pairs], dtype=int)
+        # Group statistics computed once for all pairs
+        n, mean, var = self.get_group_stats(df_lfq=df_lfq)
+        cols_lfq = None if df_lfq is None else list(df_lfq)
+        index = self._index if df_lfq is None else df_lfq.index
+        t_vals, p_vals = _ttest_stats(n=n, mean=mean, var=var, idx_a=idx_a, idx_b=idx_b, equal_var=equal_var)
+        if nan_policy != "omit":
+            n_cols = np.array([len(group_idx) for group_idx in self.get_list_group_idx(cols=cols_lfq)])
+            has_nan = (n < n_cols)[:, idx_a] | (n < n_cols)[:, idx_b]
+            if nan_policy == "raise" and has_nan.any():
+                raise ValueError("The input contains nan values")
+            p_vals[has_nan] = np.nan
+        p_vals = _correct_p_val(p_vals=p_vals, method=method, exclude_nan=exclude_nan)
+        cols = [pval_str + "({}/{})".format(a, b) for a, b in pairs]
+        df_pval = pd.DataFrame(p_vals, columns=cols, index=index)
         if log10_out:
             cols = ["-log10 {}".format(x) for x in list(df_pval)]
             df_pval = -np.log10(df_pval)
             df_pval.columns = cols
         return df_pval
 
-    def fdr_permutation(self):
+    def moderated_ttest(self, df_lfq=None, method=None, log10_out=True, contrasts=None, exclude_nan=False):
+        """Empirical Bayes moderated t test as in limma (closed form alternative to permutation based FDR for
+        small number of replicates)
+
+        Residual variances (pooled over all groups, NaN aware degrees of freedom) are shrunken towards a
+        prior variance estimated across all proteins, which adds prior degrees of freedom to each test.
+
+        Parameters
+        ----------
+        df_lfq: pd.DataFrame with lfq values (in log2 scale with values for each sample)
+        method: {str} default None. Correction method for p values
+            {None, "bonferroni", "sidak", "holm", "hommel", "fdr_bh", "fdr_by"}
+        log10_out: {bool} default True. Whether p value should be in -log10 or normal scale
+        contrasts: Group comparisons (see PerseusBase.get_contrasts). By default, all pairs of groups are compared.
+        exclude_nan: {bool} default False. Whether untestable proteins (NaN) are excluded from number of tests
+
+        Returns
+        -------
+        df_pval: pd.DataFrame with p value for each group comparison (same columns as ttest)
+
+        References
+        ----------
+        [1] Smyth, G. K. Linear models and empirical Bayes methods for assessing differential expression in
+            microarray experiments. Statistical Applications in Genetics and Molecular Biology (2004)
+        """
+        _check_p_correction(method=method)
+        pairs = self.get_contrasts(contrasts=contrasts)
+        dict_group_i = {group: i for i, group in enumerate(self.list_groups)}
+        idx_a = np.array([dict_group_i[a] for a, b in pairs], dtype=int)
+        idx_b = np.array([dict_group_i[b] for a, b in pairs], dtype=int)
+        n, mean, var = self.get_group_stats(df_lfq=df_lfq)
+        index = self._index if df_lfq is None else df_lfq.index
+        t_vals, p_vals, d0, s2_prior = _moderated_ttest_stats(n=n, mean=mean, var=var, idx_a=idx_a, idx_b=idx_b)
+        p_vals = _correct_p_val(p_vals=p_vals, method=method, exclude_nan=exclude_nan)
+        df_pval = pd.DataFrame(p_vals, columns=["p value ({}/{})".format(a, b) for a, b in pairs], index=index)
+        if log10_out:
+            df_pval = -np.log10(df_pval)
+            df_pval.columns = ["-log10 p value ({}/{})".format(a, b) for a, b in pairs]
+        return df_pval
+
+    def fdr_permutation(self, df_lfq=None, n_perm=250, s0=0.1, seed=None, batch_size=50, n_jobs=1,
+                        log10_out=False, contrasts=None):
         """Permutation based FDR correction
 
+        Sample labels of each group pair are permuted in batches and the SAM statistic is computed for all
+        proteins and permutations of a batch at once (array of permutations x proteins). Batches can be
+        distributed over a process pool, each batch using its own random stream spawned from 'seed' and the group
+        pair. Results are thereby reproducible and independent of 'n_jobs' and of further requested contrasts.
+
+        Parameters
+        ----------
+        df_lfq: pd.DataFrame with lfq values (in log2 scale with values for each sample)
+        n_perm: {int} default 250. Number of permutations
+        s0: {float} default 0.1. Artificial within groups variance (fudge factor). If 0, t statistic is used
+        seed: {int} default None. Seed for random generator of permutations
+        batch_size: {int} default 50. Number of permutations computed at once
+        n_jobs: {int} default 1. Number of processes to compute batches of permutations
+        log10_out: {bool} default False. Whether q values should be in -log10 or normal scale
+        contrasts: group comparisons (see PerseusBase.get_contrasts), by default all pairs
+
+        Returns
+        -------
+        df_qval: pd.DataFrame with q value for each group comparison
+
         References
         ----------
         [1] Tusher, G. V., Tibshirani, R. & Gilbert C. Significance analysis of microarrays applied to
@@ -111,10 +435,90 @@ class PerseusTests(PerseusBase):
         [2] Tyanova, S. & Cox, J. Perseus: A Bioinformatics Platform for Integrative Analysis of Proteomics
         Data in Cancer Research. Springer Protocols - Cancer Systems Biology (2010)
         """
-        # TODO implement
+        qval_str = "q value "
+        dict_q_vals = {}
+        entropy = np.random.SeedSequence(seed).entropy
+        values_lfq, list_group_idx, index = self.get_lfq_values(df_lfq=df_lfq)
+        dict_group_i = {group: i for i, group in enumerate(self.list_groups)}
+        all_pairs = self.get_contrasts()
+        pairs = self.get_contrasts(contrasts=contrasts)
+        dict_pair_idx = {(a, b): (list_group_idx[dict_group_i[a]], list_group_idx[dict_group_i[b]])
+                         for a, b in pairs}
+        # One process pool for all group pairs (LFQ matrix passed once to each worker)
+        executor = None
+        if n_jobs != 1:
+            executor = ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_perm_worker,
+                                           initargs=(values_lfq, dict_pair_idx))
+        try:
+            _init_perm_worker(values_lfq=values_lfq, dict_pair_idx=dict_pair_idx)
+            for a, b in pairs:
+                # Observed statistic
+                data = _perm_data(pair=(a, b))
+                d_obs = np.abs(_sam_statistic(member=data["labels"][np.newaxis, :], s0=s0, data=data)[0])
+                mask = ~np.isnan(d_obs)
+                order = np.argsort(-d_obs[mask], kind="stable")
+                d_obs_sorted = d_obs[mask][order]
+                # Null distribution in batches
+                list_n = [batch_size] * (n_perm // batch_size) + ([n_perm % batch_size] if n_perm % batch_size
+                                                                  else [])
+                seed_seq = _pair_seed(entropy=entropy, all_pairs=all_pairs, pair=(a, b))
+                list_args = [((a, b), ss, n, d_obs_sorted, s0) for ss, n in zip(seed_seq.spawn(len(list_n)), list_n)]
+                if executor is None:
+                    list_counts = [_perm_null_counts(args) for args in list_args]
+                else:
+                    list_counts = list(executor.map(_perm_null_counts, list_args))
+                null_counts = np.sum(list_counts, axis=0)
+                q_vals = np.full(len(d_obs), np.nan)
+                q_vals[np.flatnonzero(mask)[order]] = _q_values(d_obs=d_obs_sorted, null_counts=null_counts,
+                                                                n_perm=n_perm)
+                dict_q_vals[qval_str + "({}/{})".format(a, b)] = q_vals
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            # Matrices are not kept alive by module data
+            _PERM_DATA.clear()
+        df_qval = pd.DataFrame(dict_q_vals, index=index)
+        if log10_out:
+            cols = ["-log10 {}".format(x) for x in list(df_qval)]
+            df_qval = -np.log10(df_qval)
+            df_qval.columns = cols
+        return df_qval
 
+    def anova(self, df_lfq=None, method=None, log10_out=True, post_hoc=False, alpha=0.05, contrasts=None,
+              exclude_nan=False):
+        """One-way ANOVA over all groups for each protein
 
-    def anova(self):
-        """"""
-        # TODO implement
-        pass
+        Parameters
+        ----------
+        df_lfq: pd.DataFrame with lfq values (in log2 scale with values for each sample)
+        method: {str} default None. Correction method for ANOVA p values
+            {None, "bonferroni", "sidak", "holm", "hommel", "fdr_bh", "fdr_by"}
+        log10_out: {bool} default True. Whether p value should be in -log10 or normal scale
+        post_hoc: {bool} default False. Whether pairwise t tests should be performed for proteins with
+            significant ANOVA p value (other proteins get NaN)
+        alpha: {float} default 0.05. Significance level of (corrected) ANOVA p value for post hoc tests
+        contrasts: group comparisons for post hoc tests (see PerseusBase.get_contrasts), by default all pairs
+        exclude_nan: {bool} default False. Whether untestable proteins (NaN) are excluded from number of tests
+
+        Returns
+        -------
+        df_pval: pd.DataFrame with F statistic and p value of ANOVA (and pairwise p values if post_hoc)
+        """
+        _check_p_correction(method=method)
+        n, mean, var = self.get_group_stats(df_lfq=df_lfq)
+        f_vals, p_vals = _anova_f(n=n, mean=mean, var=var)
+        index = self._index if df_lfq is None else df_lfq.index
+        p_vals = _correct_p_val(p_vals=p_vals, method=method, exclude_nan=exclude_nan)
+        df_pval = pd.DataFrame({"F ANOVA": f_vals, "p value ANOVA": p_vals}, index=index)
+        if post_hoc:
+            if df_lfq is None:
+                df_lfq = self._get_df_lfq()
+            mask_sig = p_vals <= alpha
+            df_post_hoc = self.ttest(df_lfq=df_lfq[mask_sig], method=method, log10_out=False, contrasts=contrasts,
+                                     exclude_nan=exclude_nan)
+            df_pval = df_pval.join(df_post_hoc)
+        if log10_out:
+            cols_p = [col for col in list(df_pval) if col.startswith("p value")]
+            df_pval[cols_p] = -np.log10(df_pval[cols_p])
+            df_pval.rename({col: "-log10 {}".format(col) for col in cols_p}, axis=1, inplace=True)
+        return df_pval
@@ -5,29 +5,99 @@ Ref.: Tyanova et al., 2016 (The Perseus computational platform for comprehensive
 import time
 import pandas as pd
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
+from perseuspy.per_base import PerseusBase, _freeze, _group_stats
 from perseuspy.per_comput import PerseusComputations
+from perseuspy.per_imput import PerseusImputation, _impute_normal
+from perseuspy.per_instr import PipelineReport
+from perseuspy.per_norm import PerseusNormalization
 from perseuspy.per_plots import PerseusPlots
-from perseuspy.per_test import PerseusTests
+from perseuspy.per_qc import PerseusQC
+from perseuspy.per_test import PerseusTests, _correct_p_val, _pool_rubin
 import perseuspy._utils as ut
 
 
 # I Helper Functions
 def check_log2_scale_of_lfq(df_lfq=None, th_max_log2=100):
     """"""
-    max_intensity = np.round(max(df_lfq.values.flatten()), 2)
+    max_intensity = np.round(np.nanmax(df_lfq.to_numpy()), 2)
     if max_intensity > th_max_log2:
         error = f"Maximum intensity in df ({max_intensity}) is exceeding 'th_max_log2' ({th_max_log2})." \
                 f"\nValues are probably not in log2 scale. If yes, increase 'th_max_log2' to continue."
         raise ValueError(error)
 
 
+def _check_test(test=None):
+    """Check statistical test"""
+    tests = ["ttest", "moderated"]
+    if test not in tests:
+        raise ValueError("'test' ({}) should be one of following: {}".format(test, tests))
+
+
+def _drop_inplace(kwargs=None):
+    """Get copy of stage arguments without 'inplace', since cached stage results must not be modified"""
+    if kwargs is None:
+        return None
+    return {key: value for key, value in kwargs.items() if key != "inplace"}
+
+
+def _check_kwargs_mi(kwargs_impute=None):
+    """Check arguments of normal distribution imputation for multiple imputation (seeds are spawned from 'seed')"""
+    list_args = ["width", "shift", "mode"]
+    wrong_args = [arg for arg in (kwargs_impute or {}) if arg not in list_args]
+    if wrong_args:
+        raise ValueError("'kwargs_impute' ({}) should only contain following arguments: {}. Use 'seed' of "
+                         "run_multiple_imputation for random streams of imputations".format(wrong_args, list_args))
+
+
+# Stage graph of run (stage: dependent stages)
+DICT_STAGE_DEPS = {"lfq": ["norm"],
+                   "norm": ["filter"],
+                   "filter": ["impute"],
+                   "impute": ["mean", "pval", "qval"],
+                   "mean": ["ratio"],
+                   "ratio": [],
+                   "pval": ["correction"],
+                   "correction": [],
+                   "qval": []}
+
+
+# Multiple imputation
+_MI_DATA = {}
+
+
+def _init_mi_worker(shm_name=None, shape=None, dtype=None, list_group_idx=None, idx_a=None, idx_b=None):
+    """Attach (worker) process to LFQ matrix in shared memory"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    values = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _MI_DATA.update(dict(shm=shm, values=values, list_group_idx=list_group_idx, idx_a=idx_a, idx_b=idx_b))
+
+
+def _mi_run(args):
+    """Impute copy of LFQ matrix and get log2 ratio, its variance and degrees of freedom for all contrasts"""
+    seed_seq, kwargs_impute = args
+    values = _MI_DATA["values"].copy()
+    values = _impute_normal(values=values, rng=np.random.default_rng(seed_seq), **kwargs_impute)
+    n, mean, var = _group_stats(values=values, list_group_idx=_MI_DATA["list_group_idx"])
+    idx_a, idx_b = _MI_DATA["idx_a"], _MI_DATA["idx_b"]
+    n_a, n_b = n[:, idx_a], n[:, idx_b]
+    ss = np.where(n_a > 1, (n_a - 1) * var[:, idx_a], 0) + np.where(n_b > 1, (n_b - 1) * var[:, idx_b], 0)
+    df_com = n_a + n_b - 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        u = ss / df_com * (1 / n_a + 1 / n_b)
+    q = mean[:, idx_a] - mean[:, idx_b]
+    return q, u, df_com
+
+
 # TODO heavy check input df
 # II Main Functions
-class PerseusPipeline(PerseusComputations, PerseusTests, PerseusPlots):    # PerseusNormalization, PerseusImputation,
+class PerseusPipeline(PerseusComputations, PerseusNormalization, PerseusQC, PerseusImputation, PerseusTests,
+                      PerseusPlots):
     """Class for Perseus analysis"""
     def __init__(self, df=None, dict_col_group=None, col_acc=ut.COL_ACC, col_genes=ut.COL_GENE,
-                 pre_filtered=False, groups=None):
+                 pre_filtered=False, groups=None, dtype=np.float64):
         """
         Class for proteomic analysis pipeline as performed in Perseus.
 
@@ -43,36 +113,250 @@ class PerseusPipeline(PerseusComputations, PerseusTests, PerseusPlots):    # Per
         pre_filtered: {bool} default False. Specify whether values in df are already filtered for
             "Only identified by site", "Reverse", "Contaminant". If False, df will be filtered.
         groups: {list} list with group names {strings}
+        dtype: {np.dtype} default np.float64. Data type of intensity matrix (e.g., np.float32 to save memory)
         """
         kwargs = dict(df=df,
                       dict_col_group=dict_col_group,
                       col_acc=col_acc,
                       col_genes=col_genes,
                       pre_filtered=pre_filtered,
-                      groups=groups)
-        PerseusComputations.__init__(self, **kwargs)
-        PerseusTests.__init__(self, **kwargs)
+                      groups=groups,
+                      dtype=dtype)
+        # Core data is shared by all modules and therefore created just once
+        PerseusBase.__init__(self, **kwargs)
         PerseusPlots.__init__(self, **kwargs)
+        self._stage_cache = {stage: {} for stage in DICT_STAGE_DEPS}
+        self._pca_cache = {}
+        self.report = None
+
+    def set_instrumentation(self, enabled=True, callback=None, memory=True):
+        """Enable (or disable) recording of wall time, peak memory, shapes and NaN counts for each stage of run
+        and run_multiple_imputation
+
+        Parameters
+        ----------
+        enabled: {bool} default True. Whether stages should be recorded. If False, stages run without overhead
+        callback: {callable} default None. Function called with record (dict) of each stage (e.g., logger.info)
+        memory: {bool} default True. Whether peak memory should be traced (tracemalloc, slows down stages)
+
+        Returns
+        -------
+        report: PipelineReport collecting records of all following stages (also set as attribute 'report')
+        """
+        self.report = PipelineReport(callback=callback, memory=memory) if enabled else None
+        return self.report
+
+    def _stage(self, stage=None, func=None, data_in=None):
+        """Run stage func() (recorded if instrumentation is enabled)"""
+        if self.report is None:
+            return func()
+        return self.report.measure(stage=stage, func=func, data_in=data_in)
 
-    def run(self, log2_in=True, log2_max=100):
+    def _memo(self, stage=None, key=None, func=None, data_in=None):
+        """Get result of stage for key (parameters including keys of upstream stages), computed if not cached"""
+        dict_stage = self._stage_cache[stage]
+        if key not in dict_stage:
+            dict_stage[key] = self._stage(stage=stage, func=func, data_in=data_in)
+        elif self.report is not None:
+            self.report.add(stage=stage, cached=True, data_in=data_in, data_out=dict_stage[key])
+        return dict_stage[key]
+
+    def _memo_contrasts(self, stage=None, key=None, pairs=None, func=None, data_in=None):
+        """Get dict with result for each contrast of stage, where just missing contrasts are computed at once
+        by func(missing_pairs) returning one column per pair"""
+        dict_stage = self._stage_cache[stage]
+        missing = [pair for pair in pairs if (key, pair) not in dict_stage]
+        if missing:
+            values = self._stage(stage=stage, func=lambda: func(missing), data_in=data_in)
+            for i, pair in enumerate(missing):
+                dict_stage[(key, pair)] = values[:, i]
+        elif self.report is not None:
+            self.report.add(stage=stage, cached=True, data_in=data_in)
+        return {pair: dict_stage[(key, pair)] for pair in pairs}
+
+    def clear_cache(self, stage=None):
+        """Clear cached results of given stage and all dependent stages of run (all stages and PCA results if None)"""
+        if stage is None:
+            self._pca_cache.clear()
+        stages = list(DICT_STAGE_DEPS) if stage is None else [stage]
+        while stages:
+            stage = stages.pop()
+            self._stage_cache[stage].clear()
+            stages.extend(DICT_STAGE_DEPS[stage])
+
+    def run(self, log2_in=True, log2_max=100, contrasts=None, method=None, impute=None, kwargs_impute=None,
+            fdr_perm=False, n_perm=250, s0=0.1, seed=None, n_jobs=1, test="ttest", normalize=None,
+            kwargs_normalize=None, min_valid=None, valid_mode="any"):
         """Run perseuspy pipeline to get df_ratio_pval:
-            df_lfq -> df_lfq_mean -> df_ratio + df_pval
+            df_lfq -> df_lfq_mean -> df_ratio + df_pval (+ df_qval)
 
         Parameters
         ----------
         log2_in: {bool} True. Specify whether intensity values in df are log2 transformed or not.
         log2_max: {int} default 100. Maximum value to decide if values are log scaled or normal scaled
+        contrasts: Group comparisons (a/b) given as list of pairs [(a, b), ...], reference group (str),
+            or contrast matrix (contrasts x groups). By default, all pairs of groups are compared.
+        method: {str} default None. Correction method for p values
+            {None, "bonferroni", "sidak", "holm", "hommel", "fdr_bh", "fdr_by"}
+        impute: {str} default None. Imputation method for missing values {None, "normal", "knn"}
+        kwargs_impute: {dict} default None. Arguments for imputation method (e.g., width, shift, seed).
+            'inplace' is ignored, since cached results of previous stages must not be modified
+        fdr_perm: {bool} default False. Whether q values of permutation based FDR should be added
+        n_perm: {int} default 250. Number of permutations for permutation based FDR
+        s0: {float} default 0.1. Artificial within groups variance for permutation based FDR
+        seed: {int} default None. Seed for permutations
+        n_jobs: {int} default 1. Number of processes for permutations
+        test: {str} default "ttest". Statistical test {"ttest", "moderated"} (see PerseusTests.moderated_ttest)
+        normalize: {str} default None. Normalization method before imputation
+            {None, "median", "mean", "width", "quantile"} (see PerseusNormalization.normalize)
+        kwargs_normalize: {dict} default None. Arguments for normalization (e.g., dtype). 'inplace' is ignored
+        min_valid: {float, int} default None. If given, rows are filtered before imputation and statistics for
+            minimum number of valid values given as fraction of samples (< 1) or absolute number
+        valid_mode: {str} default "any". Valid values required in "each" group, in "any" group, or in "total"
+
+        Notes
+        -----
+        Results of each stage are cached, so that e.g. changing just 'method' recomputes only the correction
+        and requesting further contrasts computes just these. Random stages (imputation, permutations) are
+        thereby also reused; use clear_cache to recompute them. The cache is not bounded and keeps results for each
+        distinct set of parameters, so call clear_cache() to release memory when exploring many parameters.
         """
+        # Stages are memoized by their parameters (including parameters of upstream stages), so that just stages
+        # with changed parameters or new contrasts are recomputed (see clear_cache)
         # 1.1 LFQ Processing (df_lfq -> df_ratio)
-
-        df_lfq = self.get_df_lfq(log2_in=log2_in)
-        check_log2_scale_of_lfq(df_lfq=df_lfq, th_max_log2=log2_max)
-        df_lfq_mean = self.get_df_lfq_mean(df_lfq=df_lfq, remove_nan=False)
-        df_ratio = self.get_df_ratio(df_lfq_mean=df_lfq_mean)
+        kwargs_normalize, kwargs_impute = _drop_inplace(kwargs_normalize), _drop_inplace(kwargs_impute)
+        key_lfq = (log2_in, log2_max)
+        df_lfq = self._memo(stage="lfq", key=key_lfq,
+                            func=lambda: self._stage_lfq(log2_in=log2_in, log2_max=log2_max))
+        _check_test(test=test)
+        key_norm = key_lfq + (normalize, _freeze(kwargs_normalize))
+        if normalize is not None:
+            df_lfq = self._memo(stage="norm", key=key_norm, data_in=df_lfq,
+                                func=lambda: self.normalize(df_lfq=df_lfq, method=normalize,
+                                                            **(kwargs_normalize or {})))
+        key_filter = key_norm + (min_valid, valid_mode)
+        if min_valid is not None:
+            df_lfq = self._memo(stage="filter", key=key_filter, data_in=df_lfq,
+                                func=lambda: self.filter_valid_values(df_lfq=df_lfq, min_valid=min_valid,
+                                                                      mode=valid_mode))
+        key_impute = key_filter + (impute, _freeze(kwargs_impute))
+        if impute is not None:
+            df_lfq = self._memo(stage="impute", key=key_impute, data_in=df_lfq,
+                                func=lambda: self.impute(df_lfq=df_lfq, method=impute, **(kwargs_impute or {})))
+        df_lfq_mean = self._memo(stage="mean", key=key_impute, data_in=df_lfq,
+                                 func=lambda: self.get_df_lfq_mean(df_lfq=df_lfq, remove_nan=False))
+        pairs = self.get_contrasts(contrasts=contrasts)
+        dict_ratio = self._memo_contrasts(stage="ratio", key=key_impute, pairs=pairs, data_in=df_lfq_mean,
+                                          func=lambda missing: self.get_df_ratio(df_lfq_mean=df_lfq_mean,
+                                                                                 contrasts=missing).to_numpy())
         # 1.2 Statistical tests (df_lfq -> df_pval)
-        df_pval = self.ttest(df_lfq=df_lfq)
+        f_test = self.ttest if test == "ttest" else self.moderated_ttest
+        key_test = key_impute + (test, )
+        dict_pval = self._memo_contrasts(stage="pval", key=key_test, pairs=pairs, data_in=df_lfq,
+                                         func=lambda missing: f_test(df_lfq=df_lfq, contrasts=missing,
+                                                                     log10_out=False).to_numpy())
+        key_correction = key_test + (method, )
+        dict_pval = self._memo_contrasts(stage="correction", key=key_correction, pairs=pairs,
+                                         func=lambda missing: _correct_p_val(
+                                             p_vals=np.stack([dict_pval[pair] for pair in missing], axis=1),
+                                             method=method))
+        df_ratio = pd.DataFrame({"{} ({}/{})".format(ut.STR_LOG2_RATIO, a, b): dict_ratio[(a, b)] for a, b in pairs},
+                                index=df_lfq.index)
+        df_pval = pd.DataFrame({"-log10 p value ({}/{})".format(a, b): -np.log10(dict_pval[(a, b)])
+                                for a, b in pairs}, index=df_lfq.index)
+        if fdr_perm:
+            key_qval = key_impute + (n_perm, s0, seed)
+            dict_qval = self._memo_contrasts(stage="qval", key=key_qval, pairs=pairs, data_in=df_lfq,
+                                             func=lambda missing: self.fdr_permutation(
+                                                 df_lfq=df_lfq, n_perm=n_perm, s0=s0, seed=seed, n_jobs=n_jobs,
+                                                 contrasts=missing).to_numpy())
+            df_qval = pd.DataFrame({"q value ({}/{})".format(a, b): dict_qval[(a, b)] for a, b in pairs},
+                                   index=df_lfq.index)
+            df_pval = df_pval.join(df_qval)
         # 1.3 Join ratio and statistical analysis
-        df_ratio_pval = df_ratio.join(df_pval)
-        df_ratio_pval = self.add_acc_gene(df_ratio_pval)
+        df_ratio_pval = self._stage(stage="join", func=lambda: self.add_acc_gene(df_ratio.join(df_pval)),
+                                    data_in=df_ratio)
+        return df_ratio_pval
+
+    def _stage_lfq(self, log2_in=True, log2_max=100):
+        """Get df_lfq in log2 scale and check scale"""
+        df_lfq = self._get_df_lfq(log2_in=log2_in)
+        check_log2_scale_of_lfq(df_lfq=df_lfq, th_max_log2=log2_max)
+        return df_lfq
+
+    def run_multiple_imputation(self, m=20, log2_in=True, log2_max=100, contrasts=None, method=None,
+                                kwargs_impute=None, seed=None, n_jobs=1):
+        """Run perseuspy pipeline with multiple imputation to get df_ratio_pval:
+            df_lfq -> m x (imputation -> log2 ratio + variance) -> pooling by Rubin's rules
+
+        Each imputation run uses its own random stream spawned from 'seed'. For n_jobs > 1, runs are distributed
+        over a process pool, where the LFQ matrix is shared with the processes via shared memory.
+
+        Parameters
+        ----------
+        m: {int} default 20. Number of imputations (>= 2)
+        log2_in: {bool} True. Specify whether intensity values in df are log2 transformed or not.
+        log2_max: {int} default 100. Maximum value to decide if values are log scaled or normal scaled
+        contrasts: Group comparisons (see PerseusPipeline.run). By default, all pairs of groups are compared.
+        method: {str} default None. Correction method for pooled p values
+            {None, "bonferroni", "sidak", "holm", "hommel", "fdr_bh", "fdr_by"}
+        kwargs_impute: {dict} default None. Arguments for normal distribution imputation (width, shift, mode)
+        seed: {int} default None. Seed for imputations
+        n_jobs: {int} default 1. Number of processes
+
+        Returns
+        -------
+        df_ratio_pval: pd.DataFrame with pooled log2 ratio and -log10 p value for each group comparison
+
+        References
+        ----------
+        [1] Rubin, D. B. Multiple Imputation for Nonresponse in Surveys. Wiley (1987)
+        [2] Barnard, J. & Rubin, D. B. Small-sample degrees of freedom with multiple imputation. Biometrika (1999)
+        """
+        if m < 2:
+            raise ValueError("'m' ({}) should be >= 2 to pool imputations by Rubin's rules".format(m))
+        _check_kwargs_mi(kwargs_impute=kwargs_impute)
+        df_lfq = self._stage(stage="lfq", func=lambda: self._stage_lfq(log2_in=log2_in, log2_max=log2_max))
+        values = np.ascontiguousarray(df_lfq.to_numpy(dtype=np.float64))
+        pairs = self.get_contrasts(contrasts=contrasts)
+        dict_group_i = {group: i for i, group in enumerate(self.list_groups)}
+        kwargs_data = dict(list_group_idx=self.get_list_group_idx(cols=list(df_lfq)),
+                           idx_a=np.array([dict_group_i[a] for a, b in pairs], dtype=int),
+                           idx_b=np.array([dict_group_i[b] for a, b in pairs], dtype=int))
+        list_args = [(seed_seq, kwargs_impute or {}) for seed_seq in np.random.SeedSequence(seed).spawn(m)]
+        results = self._stage(stage="imputations", data_in=values,
+                              func=lambda: self._mi_runs(values=values, list_args=list_args, n_jobs=n_jobs,
+                                                         **kwargs_data))
+        q = np.stack([r[0] for r in results])
+        u = np.stack([r[1] for r in results])
+        q_mean, p_vals = self._stage(stage="pooling", data_in=q,
+                                     func=lambda: _pool_rubin(q=q, u=u, df_com=results[0][2]))
+        p_vals = self._stage(stage="correction", data_in=p_vals,
+                             func=lambda: _correct_p_val(p_vals=p_vals, method=method))
+        cols_ratio = ["{} ({}/{})".format(ut.STR_LOG2_RATIO, a, b) for a, b in pairs]
+        cols_pval = ["-log10 p value ({}/{})".format(a, b) for a, b in pairs]
+        df_ratio = pd.DataFrame(q_mean, columns=cols_ratio, index=df_lfq.index)
+        df_pval = pd.DataFrame(-np.log10(p_vals), columns=cols_pval, index=df_lfq.index)
+        df_ratio_pval = self._stage(stage="join", func=lambda: self.add_acc_gene(df_ratio.join(df_pval)),
+                                    data_in=df_ratio)
         return df_ratio_pval
 
+    @staticmethod
+    def _mi_runs(values=None, list_args=None, n_jobs=1, list_group_idx=None, idx_a=None, idx_b=None):
+        """Get results of all imputation runs (distributed over process pool with shared LFQ matrix if n_jobs > 1)"""
+        if n_jobs == 1:
+            _MI_DATA.update(dict(values=values, list_group_idx=list_group_idx, idx_a=idx_a, idx_b=idx_b))
+            try:
+                return [_mi_run(args) for args in list_args]
+            finally:
+                _MI_DATA.clear()
+        shm = shared_memory.SharedMemory(create=True, size=values.nbytes)
+        try:
+            np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf)[:] = values
+            initargs = (shm.name, values.shape, values.dtype, list_group_idx, idx_a, idx_b)
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_mi_worker, initargs=initargs) as executor:
+                results = list(executor.map(_mi_run, list_args))
+        finally:
+            shm.close()
+            shm.unlink()
+        return results
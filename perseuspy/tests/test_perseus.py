@@ -1,12 +1,21 @@
 """
 This is a script for testing PerseusPipeline
 """
+import os
 import pandas as pd
 import numpy as np
 import pytest
+import plotly.graph_objects as go
+from matplotlib import pyplot as plt
+from scipy.stats import ttest_ind
+from statsmodels.stats.multitest import multipletests
 
 import perseuspy._utils as ut
-from perseuspy import PerseusPipeline, get_dict_groups
+from perseuspy import PerseusPipeline, get_dict_groups, read_lfq, run_batch, run_chunked, simulate_lfq
+from perseuspy.per_incr import PerseusIncremental
+from perseuspy.perseus_pipe import _MI_DATA
+from perseuspy.per_test import _correct_p_val
+from perseuspy.per_plots import _cull_labels, _label_groups, _scatter_large_data, COLOR_NOT_SIG
 
 FOLDER_IN = ut.FOLDER_DATA + "test_data" + ut.SEP
 
@@ -22,6 +31,21 @@ def df_log2_lfq():
     return pd.read_csv(FOLDER_IN + "df_log2_lfq.csv")
 
 
+@pytest.fixture
+def pp_synthetic():
+    rng = np.random.default_rng(42)
+    groups = ["A", "B", "C"]
+    cols = ["log2 LFQ {}_{}".format(group, i) for group in groups for i in range(1, 4)]
+    values = rng.normal(25, 1, size=(300, len(cols)))
+    values[:30, :3] += 3
+    values[rng.random(values.shape) < 0.1] = np.nan
+    df = pd.DataFrame(values, columns=cols)
+    df.insert(0, "Gene Names", ["G{}".format(i) for i in range(len(df))])
+    df.insert(0, "Protein ID", ["P{}".format(i) for i in range(len(df))])
+    dict_col_group = get_dict_groups(df=df, lfq_str="log2 LFQ", groups=groups)
+    return PerseusPipeline(df=df, dict_col_group=dict_col_group)
+
+
 # Corrupted input
 
 
@@ -38,3 +62,465 @@ def test_perseus_log_input(df_log2_lfq):
     pp = PerseusPipeline(dict_col_group=dict_col_group, df=df_log2_lfq,
                          col_acc="Protein ID", col_genes="Gene Names")
     df_ratio_pval = pp.run(log2_in=False)
+
+
+def test_fdr_permutation(pp_synthetic):
+    df_lfq = pp_synthetic.get_df_lfq()
+    df_qval = pp_synthetic.fdr_permutation(df_lfq=df_lfq, n_perm=40, batch_size=15, seed=1)
+    df_qval_parallel = pp_synthetic.fdr_permutation(df_lfq=df_lfq, n_perm=40, batch_size=15, seed=1, n_jobs=2)
+    assert list(df_qval) == ["q value (A/B)", "q value (A/C)", "q value (B/C)"]
+    assert np.allclose(df_qval, df_qval_parallel, equal_nan=True)
+    assert df_qval.min().min() >= 0 and df_qval.max().max() <= 1
+    assert df_qval["q value (A/B)"][:30].median() < df_qval["q value (A/B)"][30:].median()
+    # q values of contrast independent of further requested contrasts
+    df_qval_ac = pp_synthetic.fdr_permutation(df_lfq=df_lfq, n_perm=40, batch_size=15, seed=1, contrasts=[("A", "C")])
+    assert np.allclose(df_qval_ac["q value (A/C)"], df_qval["q value (A/C)"], equal_nan=True)
+
+
+def test_anova_post_hoc(pp_synthetic):
+    df_lfq = pp_synthetic.get_df_lfq()
+    df_pval = pp_synthetic.anova(df_lfq=df_lfq, method="fdr_bh", post_hoc=True, log10_out=False)
+    assert list(df_pval)[:2] == ["F ANOVA", "p value ANOVA"]
+    mask_sig = df_pval["p value ANOVA"] <= 0.05
+    assert df_pval.loc[~mask_sig, "p value (A/B)"].isna().all()
+    assert df_pval.loc[mask_sig, "p value (A/B)"].notna().any()
+
+
+@pytest.mark.parametrize("equal_var", [True, False])
+def test_ttest_group_stats(pp_synthetic, equal_var):
+    df_lfq = pp_synthetic.get_df_lfq()
+    df_pval = pp_synthetic.ttest(df_lfq=df_lfq, log10_out=False, equal_var=equal_var)
+    for a, b in [("A", "B"), ("A", "C"), ("B", "C")]:
+        df_a, df_b = df_lfq[pp_synthetic.dict_group_cols[a]], df_lfq[pp_synthetic.dict_group_cols[b]]
+        p_vals = ttest_ind(df_a, df_b, axis=1, nan_policy="omit", equal_var=equal_var)[1]
+        assert np.allclose(df_pval["p value ({}/{})".format(a, b)], p_vals, equal_nan=True)
+
+
+def test_group_stats_inplace(pp_synthetic):
+    df_lfq = pp_synthetic.get_df_lfq().copy()
+    df_pval = pp_synthetic.ttest(df_lfq=df_lfq, log10_out=False)
+    pp_synthetic.impute_normal(df_lfq=df_lfq, seed=42, inplace=True)
+    df_pval_imputed = pp_synthetic.ttest(df_lfq=df_lfq, log10_out=False)
+    assert not df_pval.equals(df_pval_imputed)
+    assert df_pval_imputed.equals(pp_synthetic.ttest(df_lfq=df_lfq.copy(), log10_out=False))
+
+
+def test_contrasts(pp_synthetic):
+    contrast_matrix = pd.DataFrame([[1, 0, -1], [0, 1, -1]], columns=["A", "B", "C"])
+    for contrasts in ["C", [("A", "C"), ("B", "C")], contrast_matrix]:
+        assert pp_synthetic.get_contrasts(contrasts=contrasts) == [("A", "C"), ("B", "C")]
+    df_ratio_pval = pp_synthetic.run(contrasts="C")
+    assert list(df_ratio_pval)[2:] == ["log2 ratio (A/C)", "log2 ratio (B/C)",
+                                       "-log10 p value (A/C)", "-log10 p value (B/C)"]
+    with pytest.raises(ValueError):
+        pp_synthetic.get_contrasts(contrasts=[("A", "D")])
+
+
+@pytest.mark.parametrize("method", ["bonferroni", "sidak", "holm", "hommel", "fdr_bh", "fdr_by"])
+def test_correct_p_val(method):
+    rng = np.random.default_rng(1)
+    p_vals = rng.random((200, 2)) ** 3
+    p_vals[rng.random(p_vals.shape) < 0.2] = np.nan
+    cor_p_vals = _correct_p_val(p_vals=p_vals, method=method, exclude_nan=True)
+    for j in range(p_vals.shape[1]):
+        mask = ~np.isnan(p_vals[:, j])
+        assert np.allclose(cor_p_vals[mask, j], multipletests(p_vals[mask, j], method=method)[1])
+        assert np.isnan(cor_p_vals[~mask, j]).all()
+
+
+def test_volcano_classes():
+    df = pd.DataFrame({"Gene_Name": ["G1", "G2", "G3", "G4", "G5"],
+                       "log2 ratio (A/B)": [1.0, -1.0, 0.1, -0.1, 2.0],
+                       "-log10 p value (A/B)": [3.0, 3.0, 3.0, 0.5, np.nan]})
+    classes = PerseusPipeline.volcano_classes(df_ratio_pval=df, col_ratio="log2 ratio (A/B)",
+                                              col_pval="-log10 p value (A/B)", th_filter=(0.05, 0.5),
+                                              gene_list=["G4"])
+    assert list(classes) == ["Up", "Down", "Not Sig", "Down", "Not Sig"]
+
+
+def test_cull_labels():
+    labels = [("G1", 2.0, 5.0), ("G2", 2.1, 5.1), ("G3", -3.0, 2.0), ("G4", 4.0, 9.0), ("", 4.2, 9.1), ("", 0.1, 0.1)]
+    labels_fixed, labels_repel, labels_avoid = _cull_labels(labels=labels, cell_size=(1, 1))
+    assert sorted(label[0] for label in labels_fixed + labels_repel) == ["G2", "G3", "G4"]
+    assert [label[0] for label in labels_repel] == ["G4"] and labels_avoid == [("", 4.2, 9.1)]
+    labels_fixed, labels_repel, labels_avoid = _cull_labels(labels=labels, cell_size=(1, 1), max_labels=1)
+    assert [label[0] for label in labels_fixed + labels_repel] == ["G4"]
+    # Labels of genes from gene_list are neither culled nor counted for label budget
+    labels = [("STRONG", 2.1, 5.1, False), ("MYGENE", 2.0, 5.0, True), ("G4", 4.0, 9.0, False)]
+    labels_fixed, labels_repel, _ = _cull_labels(labels=labels, cell_size=(1, 1), max_labels=1)
+    assert sorted(label[0] for label in labels_fixed + labels_repel) == ["G4", "MYGENE"]
+    labels_fixed, labels_repel, _ = _cull_labels(labels=labels, cell_size=(1, 1))
+    assert sorted(label[0] for label in labels_fixed + labels_repel) == ["G4", "MYGENE"]
+    # Labels are placed per neighbourhood of connected grid cells
+    labels = [("G1", 0.5, 0.5), ("G2", 1.5, 1.5), ("G3", 5.5, 5.5)]
+    points = [("", 2.5, 2.5), ("", 9.5, 9.5)]
+    assert _label_groups(labels=labels, points=points, cell_size=(1, 1)) == [([0, 1], [0]), ([2], [])]
+
+
+def test_impute_normal(pp_synthetic):
+    df_lfq = pp_synthetic.get_df_lfq()
+    df_imputed = pp_synthetic.impute_normal(df_lfq=df_lfq, seed=1, dtype=np.float32)
+    mask_nan = df_lfq.isna().to_numpy()
+    assert df_imputed.notna().all().all() and (df_imputed.dtypes == np.float32).all()
+    assert np.allclose(df_imputed.to_numpy()[~mask_nan], df_lfq.to_numpy()[~mask_nan])
+    assert df_imputed.to_numpy()[mask_nan].mean() < np.nanmean(df_lfq.to_numpy()) - 1
+    assert np.array_equal(df_imputed, pp_synthetic.impute_normal(df_lfq=df_lfq, seed=1, dtype=np.float32))
+    df_inplace = df_lfq.copy()
+    pp_synthetic.impute_normal(df_lfq=df_inplace, seed=1, inplace=True)
+    assert df_inplace.notna().all().all()
+    df_ratio_pval = pp_synthetic.run(impute="normal", kwargs_impute=dict(seed=1))
+    assert df_ratio_pval.notna().all().all()
+
+
+def test_impute_knn(pp_synthetic):
+    df_lfq = pp_synthetic.get_df_lfq()
+    knn_index = pp_synthetic.get_knn_index(df_lfq=df_lfq, n_neighbors=10, block_size=64, n_jobs=2)
+    assert knn_index["neighbors"].shape == (len(knn_index["rows"]), 10)
+    df_imputed = pp_synthetic.impute_knn(df_lfq=df_lfq, k=3, knn_index=knn_index)
+    df_imputed_block = pp_synthetic.impute(df_lfq=df_lfq, method="knn", k=3, n_neighbors=10, block_size=1000)
+    assert df_imputed.notna().all().all()
+    assert np.allclose(df_imputed, df_imputed_block)
+
+
+def test_run_multiple_imputation(pp_synthetic):
+    kwargs = dict(m=4, seed=1, contrasts="C")
+    df_ratio_pval = pp_synthetic.run_multiple_imputation(**kwargs)
+    df_ratio_pval_parallel = pp_synthetic.run_multiple_imputation(n_jobs=2, **kwargs)
+    assert list(df_ratio_pval) == ["ACC", "Gene_Name", "log2 ratio (A/C)", "log2 ratio (B/C)",
+                                   "-log10 p value (A/C)", "-log10 p value (B/C)"]
+    assert np.allclose(df_ratio_pval.iloc[:, 2:], df_ratio_pval_parallel.iloc[:, 2:], equal_nan=True)
+    assert df_ratio_pval.iloc[:, 2:].notna().all().all()
+    assert _MI_DATA == {}
+    with pytest.raises(ValueError):
+        pp_synthetic.run_multiple_imputation(m=1, seed=1)
+    with pytest.raises(ValueError):
+        pp_synthetic.run_multiple_imputation(m=2, kwargs_impute=dict(seed=1))
+
+
+@pytest.fixture
+def file_protein_groups(tmp_path):
+    df = pd.DataFrame({"Protein IDs": ["P1", "P2", "P3", "P4"],
+                       "Gene names": ["G1", "G2", "G3", "G1"],
+                       "Reverse": [np.nan, "+", np.nan, np.nan],
+                       "Potential contaminant": [np.nan, np.nan, "+", np.nan],
+                       "Intensity WT_1": [1.0, 2.0, 3.0, 4.0],
+                       "LFQ intensity WT_1": [1.0, 2.0, 3.0, 4.0],
+                       "LFQ intensity WT_2": [1.0, 2.0, 3.0, 4.0],
+                       "LFQ intensity KO_1": [1.0, 2.0, 3.0, 4.0]})
+    file = str(tmp_path / "proteinGroups.txt")
+    df.to_csv(file, sep="\t", index=False)
+    return file
+
+
+def test_read_lfq(file_protein_groups):
+    df_lfq, dict_col_group = read_lfq(file=file_protein_groups, groups=["WT", "KO"], chunksize=2)
+    assert dict_col_group == {"LFQ intensity WT_1": "WT", "LFQ intensity WT_2": "WT", "LFQ intensity KO_1": "KO"}
+    assert list(df_lfq) == ["Protein IDs", "Gene names"] + list(dict_col_group)
+    assert df_lfq["Protein IDs"].tolist() == ["P1", "P4"]
+    assert df_lfq["Gene names"].dtype == "category" and (df_lfq[list(dict_col_group)].dtypes == np.float32).all()
+
+
+def test_read_lfq_cache(file_protein_groups, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    df_lfq, dict_col_group = read_lfq(file=file_protein_groups, groups=["WT", "KO"], log2=True)
+    for _ in range(2):
+        df_cached, dict_cached = read_lfq(file=file_protein_groups, groups=["WT", "KO"], log2=True,
+                                          cache_dir=cache_dir)
+        assert dict_cached == dict_col_group
+        assert np.allclose(df_cached[list(dict_col_group)], df_lfq[list(dict_col_group)], equal_nan=True)
+        assert df_cached["Protein IDs"].tolist() == df_lfq["Protein IDs"].tolist()
+    assert len([folder for folder in os.listdir(cache_dir) if folder != "hash_index.json"]) == 1
+    read_lfq(file=file_protein_groups, groups=["WT", "KO"], cache_dir=cache_dir, cache_max_size=0)
+    assert os.listdir(cache_dir) == ["hash_index.json"]
+    # Unreadable (e.g., partially written) hash index is treated as empty
+    with open(os.path.join(cache_dir, "hash_index.json"), "w") as f:
+        f.write('{"partial')
+    df_cached, _ = read_lfq(file=file_protein_groups, groups=["WT", "KO"], log2=True, cache_dir=cache_dir)
+    assert df_cached["Protein IDs"].tolist() == df_lfq["Protein IDs"].tolist()
+
+
+def test_core_idempotent(pp_synthetic):
+    df_lfq = pp_synthetic.get_df_lfq(log2_in=False, log2_out=True)
+    assert list(df_lfq) == list(pp_synthetic.get_df_lfq(log2_in=False, log2_out=True))
+    assert list(df_lfq)[0] == "log2 log2 LFQ A_1" and list(pp_synthetic.get_df_lfq())[0] == "log2 LFQ A_1"
+    assert pp_synthetic.get_values(log2_in=False) is pp_synthetic.get_values(log2_in=False)
+    df_pval = pp_synthetic.ttest(df_lfq=pp_synthetic.get_df_lfq())
+    assert np.allclose(df_pval, pp_synthetic.ttest(), equal_nan=True)
+    df_ratio_pval = pp_synthetic.run()
+    assert np.allclose(df_ratio_pval.iloc[:, 2:], pp_synthetic.run().iloc[:, 2:], equal_nan=True)
+    # Returned df is writeable copy, core matrix is unchanged
+    df_lfq = pp_synthetic.get_df_lfq()
+    df_lfq.iloc[0, 0] = 1
+    df_lfq.fillna(0, inplace=True)
+    assert pp_synthetic.get_values()[0, 0] != 1 and np.isnan(pp_synthetic.get_values()).any()
+
+
+def test_run_stage_cache(pp_synthetic, monkeypatch):
+    df_ratio_pval = pp_synthetic.run(contrasts=[("A", "B")])
+    calls = []
+    ttest = pp_synthetic.ttest
+    monkeypatch.setattr(pp_synthetic, "ttest", lambda **kwargs: calls.append(kwargs["contrasts"]) or ttest(**kwargs))
+    df_bh = pp_synthetic.run(method="fdr_bh")
+    assert calls == [[("A", "C"), ("B", "C")]]
+    assert np.allclose(df_bh.iloc[:, 2], df_ratio_pval.iloc[:, 2], equal_nan=True)
+    pp_synthetic.run(method="holm")
+    assert len(calls) == 1
+    pp_synthetic.clear_cache(stage="impute")
+    pp_synthetic.run()
+    assert len(calls) == 2 and pp_synthetic._stage_cache["lfq"]
+
+
+def test_run_cache_not_modified(pp_synthetic):
+    n_rows = len(pp_synthetic.run(min_valid=3))
+    pp_synthetic.clear_cache()
+    # Cached stage results are not modified by in place imputation or normalization
+    pp_synthetic.run(impute="normal", kwargs_impute=dict(inplace=True, seed=0), normalize="median",
+                     kwargs_normalize=dict(inplace=True))
+    assert len(pp_synthetic.run(min_valid=3)) == n_rows
+    # Cached q values of a contrast match q values of a run for all contrasts
+    kwargs = dict(impute="normal", kwargs_impute=dict(seed=0), fdr_perm=True, n_perm=20, seed=1)
+    df_a_c = pp_synthetic.run(contrasts=[("A", "C")], **kwargs)
+    pp_synthetic.clear_cache()
+    df_all = pp_synthetic.run(**kwargs)
+    assert np.allclose(df_a_c["q value (A/C)"], df_all["q value (A/C)"])
+
+
+def test_run_batch(file_protein_groups, tmp_path, capsys):
+    out_dir = str(tmp_path / "out")
+    list_specs = [dict(file=file_protein_groups, groups=["WT", "KO"], name="pg"),
+                  dict(file=str(tmp_path / "missing.txt"), groups=["WT", "KO"], name="pg_failed")]
+    df_timings = run_batch(list_specs=list_specs, out_dir=out_dir, verbose=False)
+    assert df_timings["status"].tolist() == ["done", "failed"]
+    assert "Traceback" in df_timings["traceback"].iloc[1] and capsys.readouterr().err == ""
+    assert sorted(os.listdir(out_dir)) == ["pg.tsv", "timings.tsv"]
+    df_timings = run_batch(list_specs=list_specs, out_dir=out_dir, verbose=False)
+    assert df_timings["name"].tolist() == ["pg_failed"]
+    assert len(pd.read_csv(os.path.join(out_dir, "timings.tsv"), sep="\t")) == 3
+    # Process pool (workers replaced after each dataset)
+    out_dir_parallel = str(tmp_path / "out_parallel")
+    list_specs.append(dict(file=file_protein_groups, groups=["WT", "KO"], name="pg_2"))
+    df_timings = run_batch(list_specs=list_specs, out_dir=out_dir_parallel, n_jobs=2, max_tasks_per_child=1,
+                           verbose=False)
+    assert dict(zip(df_timings["name"], df_timings["status"])) == {"pg": "done", "pg_failed": "failed", "pg_2": "done"}
+    df_pg = pd.read_csv(os.path.join(out_dir, "pg.tsv"), sep="\t")
+    for name in ["pg", "pg_2"]:
+        assert pd.read_csv(os.path.join(out_dir_parallel, name + ".tsv"), sep="\t").equals(df_pg)
+
+
+def test_simulate_lfq():
+    df, dict_col_group = simulate_lfq(n_proteins=2000, groups=["A", "B", "C"], effect_size=3, frac_mcar=0,
+                                      frac_mnar=0.1, seed=1)
+    values = df[list(dict_col_group)]
+    assert values.shape == (2000, 9) and df["is_de"].sum() == 200
+    assert 0.05 < values.isna().to_numpy().mean() < 0.15
+    # MNAR: missing values in low abundant proteins
+    frac_nan = values.isna().any(axis=1).groupby(values.median(axis=1) < values.median(axis=1).median()).mean()
+    assert frac_nan[True] > 1.5 * frac_nan[False]
+    pp = PerseusPipeline(df=df, dict_col_group=dict_col_group)
+    df_pval = pp.ttest(contrasts=[("A", "C")], method="fdr_bh")
+    assert (df_pval.iloc[:, 0][df["is_de"]] > -np.log10(0.05)).mean() > 0.5
+
+
+def test_instrumentation(pp_synthetic):
+    records = []
+    report = pp_synthetic.set_instrumentation(callback=records.append)
+    pp_synthetic.run(impute="normal", kwargs_impute=dict(seed=0))
+    pp_synthetic.run(impute="normal", kwargs_impute=dict(seed=0), method="fdr_bh")
+    assert records == report.records
+    df_report = report.to_df()
+    assert df_report["stage"].tolist()[:7] == ["lfq", "impute", "mean", "ratio", "pval", "correction", "join"]
+    assert df_report["cached"].sum() == 5
+    assert df_report.iloc[1]["n_nan_in"] > 0 and df_report.iloc[1]["n_nan_out"] == 0
+    assert df_report.iloc[4]["shape_out"] == (300, 3)
+    assert report.summary().loc["correction", "n_calls"] == 2
+    pp_synthetic.set_instrumentation(enabled=False)
+    pp_synthetic.run()
+    assert pp_synthetic.report is None and len(records) == 14
+
+
+def test_moderated_ttest(pp_synthetic):
+    df_mod = pp_synthetic.moderated_ttest(method="fdr_bh")
+    df_pval = pp_synthetic.ttest(method="fdr_bh")
+    assert list(df_mod) == list(df_pval)
+    assert (df_mod.iloc[:30, 0] > -np.log10(0.05)).mean() > (df_pval.iloc[:30, 0] > -np.log10(0.05)).mean()
+    df_ratio_pval = pp_synthetic.run(test="moderated", method="fdr_bh")
+    assert np.allclose(df_ratio_pval[list(df_mod)], df_mod, equal_nan=True)
+
+
+@pytest.mark.parametrize("method", ["median", "mean", "width", "quantile"])
+def test_normalize(pp_synthetic, method):
+    df_lfq = pp_synthetic.get_df_lfq() + np.arange(9) * 0.5
+    df_norm = pp_synthetic.normalize(df_lfq=df_lfq, method=method, dtype=np.float32)
+    assert (df_norm.dtypes == np.float32).all() and df_norm.isna().equals(df_lfq.isna())
+    # Median of width adjusted columns with even number of values is just close to common median
+    assert np.ptp(df_norm.mean() if method == "mean" else df_norm.median()) < (0.05 if method == "width" else 1e-3)
+    if method == "quantile":
+        values = df_lfq.iloc[:, :2].dropna().to_numpy()
+        values_norm = pp_synthetic.normalize(df_lfq=pd.DataFrame(values), method=method).to_numpy()
+        ranks = values.argsort(axis=0).argsort(axis=0)
+        assert np.allclose(values_norm, np.sort(values, axis=0).mean(axis=1)[ranks])
+    if method == "width":
+        # Columns with zero quartile distance are not scaled (no division by zero)
+        df_tied = pd.DataFrame({"a": [1.0, 2.0, 2.0, 2.0, 2.0, 3.0], "b": [1.0, 2.0, 3.0, 4.0, 5.0, 6.0]})
+        df_norm = pp_synthetic.normalize(df_lfq=df_tied, method=method)
+        assert np.isfinite(df_norm.to_numpy()).all()
+
+
+@pytest.mark.parametrize("mode", ["each", "any", "total"])
+def test_filter_valid_values(pp_synthetic, mode):
+    df_lfq = pp_synthetic.get_df_lfq()
+    counts = pd.concat([df_lfq.filter(like=" {}_".format(group)).notna().sum(axis=1) for group in "ABC"], axis=1)
+    mask = {"each": (counts >= 3).all(axis=1), "any": (counts >= 3).any(axis=1),
+            "total": counts.sum(axis=1) >= 7}[mode]
+    df_filtered = pp_synthetic.filter_valid_values(min_valid=0.7, mode=mode)
+    assert df_filtered.index.equals(df_lfq.index[mask])
+    assert np.array_equal(pp_synthetic.get_valid_rows(min_valid=3 if mode != "total" else 7, mode=mode),
+                          np.flatnonzero(mask))
+    df_ratio_pval = pp_synthetic.run(min_valid=0.7, valid_mode=mode)
+    assert df_ratio_pval.index.equals(df_filtered.index)
+    assert df_ratio_pval["ACC"].tolist() == ["P{}".format(i) for i in df_filtered.index]
+
+
+def test_run_chunked(tmp_path):
+    df, dict_col_group = simulate_lfq(n_proteins=500, groups=["WT", "KO"], seed=0)
+    df = df.drop(columns="is_de").rename(columns={"Protein ID": "Protein IDs", "Gene Names": "Gene names"})
+    df[list(dict_col_group)] = np.power(2, df[list(dict_col_group)])
+    df.columns = [col.replace("log2 LFQ", "LFQ intensity") for col in df.columns]
+    df["Gene names"] = ["{:04d}".format(i) for i in range(len(df))]
+    file, file_out = str(tmp_path / "proteinGroups.txt"), str(tmp_path / "out.tsv")
+    df.to_csv(file, sep="\t", index=False)
+    kwargs = dict(method="fdr_bh", min_valid=2, valid_mode="each")
+    n_rows = run_chunked(file=file, groups=["WT", "KO"], file_out=file_out, chunksize=70, **kwargs)
+    df_lfq, dict_col_group = read_lfq(file=file, groups=["WT", "KO"], log2=True)
+    pp = PerseusPipeline(df=df_lfq, dict_col_group=dict_col_group, col_acc="Protein IDs", col_genes="Gene names",
+                         groups=["WT", "KO"], dtype=np.float32)
+    df_ratio_pval = pp.run(**kwargs)
+    df_chunked = pd.read_csv(file_out, sep="\t")
+    assert n_rows == len(df_ratio_pval) == len(df_chunked) and list(df_chunked) == list(df_ratio_pval)
+    assert np.allclose(df_chunked.iloc[:, 2:], df_ratio_pval.iloc[:, 2:], equal_nan=True, atol=1e-5)
+    # Annotation is not changed by correction pass
+    assert pd.read_csv(file_out, sep="\t", dtype=str)["Gene_Name"].str.len().eq(4).all()
+    run_chunked(file=file, groups=["WT", "KO"], file_out=file_out, chunksize=70, impute="normal",
+                kwargs_impute=dict(seed=0))
+    assert pd.read_csv(file_out, sep="\t").iloc[:, 2:].notna().all().all()
+
+
+def test_incremental(pp_synthetic):
+    df_lfq = pp_synthetic.get_df_lfq().join(pp_synthetic.add_acc_gene(pd.DataFrame(index=pp_synthetic._index)))
+    cols = list(pp_synthetic.dict_col_group)
+    dict_initial = {col: pp_synthetic.dict_col_group[col] for col in cols[:2] + cols[3:5]}
+    pi = PerseusIncremental(df=df_lfq, dict_col_group=dict_initial, col_acc="ACC", col_genes="Gene_Name")
+    pi.add_samples(df=df_lfq, dict_col_group={cols[2]: "A"})
+    pi.add_samples(df=np.power(2, df_lfq[cols]), dict_col_group={col: pp_synthetic.dict_col_group[col]
+                                                                 for col in cols[5:]}, log2_in=False)
+    assert pi.list_groups == ["A", "B", "C"] and len(dict_initial) == 4
+    for test in ["ttest", "moderated"]:
+        df_ratio_pval = pp_synthetic.run(method="fdr_bh", test=test)
+        df_incr = pi.run(method="fdr_bh", test=test)
+        assert list(df_incr) == list(df_ratio_pval)
+        assert np.allclose(df_incr.iloc[:, 2:], df_ratio_pval.iloc[:, 2:], equal_nan=True)
+    assert np.allclose(pi.ttest(nan_policy="propagate"), pp_synthetic.ttest(nan_policy="propagate"), equal_nan=True)
+    assert np.allclose(pi.fdr_permutation(df_lfq=df_lfq[cols], n_perm=10, seed=1),
+                       pp_synthetic.fdr_permutation(df_lfq=df_lfq[cols], n_perm=10, seed=1), equal_nan=True)
+    # Sample values (initial and appended samples) are not kept
+    assert pi._values is None and pi._views == {}
+    for func in [pi.get_df_lfq, pi.get_valid_rows, lambda: pi.fdr_permutation(n_perm=10)]:
+        with pytest.raises(ValueError):
+            func()
+
+
+@pytest.mark.parametrize("cluster_on", ["samples", "groups"])
+def test_heatmap(pp_synthetic, cluster_on):
+    df_ratio_pval = pp_synthetic.run()
+    ax, df_zscore = pp_synthetic.heatmap(df_lfq=pp_synthetic.get_df_lfq(), df_ratio_pval=df_ratio_pval,
+                                         dict_col_group=pp_synthetic.dict_col_group, th_filter=(0.05, 1),
+                                         cluster_on=cluster_on, cluster_cols=True)
+    classes = [pp_synthetic.volcano_classes(df_ratio_pval=df_ratio_pval, col_ratio=col,
+                                            col_pval=col.replace("log2 ratio", "-log10 p value"), th_filter=(0.05, 1))
+               for col in df_ratio_pval.filter(like="log2 ratio")]
+    mask = np.any([c != "Not Sig" for c in classes], axis=0)
+    assert sorted(df_zscore.index) == sorted(df_ratio_pval.index[mask])
+    assert np.allclose(np.nanmean(df_zscore, axis=1), 0)
+    assert ax.get_images()[0].get_rasterized()
+    plt.close("all")
+
+
+@pytest.mark.parametrize("nan_policy", ["drop", "impute"])
+def test_pca(pp_synthetic, nan_policy):
+    kwargs_impute = dict(seed=42) if nan_policy == "impute" else None
+    result = pp_synthetic.pca(n_components=3, nan_policy=nan_policy, kwargs_impute=kwargs_impute)
+    df_lfq = pp_synthetic.get_df_lfq()
+    df = df_lfq.dropna() if nan_policy == "drop" else pp_synthetic.impute(df_lfq=df_lfq, seed=42)
+    x = df.to_numpy().T - df.to_numpy().T.mean(axis=0)
+    s = np.linalg.svd(x, compute_uv=False)
+    assert np.allclose(result["explained_variance"], s[:3] ** 2 / np.sum(s ** 2))
+    assert np.allclose(np.abs(result["scores"].filter(like="PC").to_numpy()),
+                       np.abs(x @ result["loadings"].to_numpy()))
+    assert list(result["scores"]["group"]) == [pp_synthetic.dict_col_group[col] for col in pp_synthetic.list_col_lfq]
+    assert pp_synthetic.pca(n_components=3, nan_policy=nan_policy, kwargs_impute=kwargs_impute) is result
+    ax = pp_synthetic.pca_plot(pcs=(1, 3), nan_policy=nan_policy, kwargs_impute=kwargs_impute)
+    assert len(ax.collections[0].get_offsets()) == len(pp_synthetic.list_col_lfq)
+    assert pp_synthetic.pca(n_components=3, nan_policy=nan_policy, kwargs_impute=kwargs_impute) is result
+    pp_synthetic.clear_cache()
+    assert pp_synthetic.pca(n_components=3, nan_policy=nan_policy, kwargs_impute=kwargs_impute) is not result
+    plt.close("all")
+
+
+def test_pca_cache(pp_synthetic):
+    knn_index = pp_synthetic.get_knn_index(df_lfq=pp_synthetic.get_df_lfq(), n_neighbors=5)
+    kwargs_impute = dict(method="knn", knn_index=knn_index)
+    result = pp_synthetic.pca(nan_policy="impute", kwargs_impute=kwargs_impute)
+    assert pp_synthetic.pca(nan_policy="impute", kwargs_impute=dict(kwargs_impute)) is result
+    # Results for given df_lfq are not cached (df_lfq can be modified in place)
+    df_lfq = pp_synthetic.get_df_lfq()
+    result = pp_synthetic.pca(df_lfq=df_lfq)
+    df_lfq.iloc[:, 0] += np.linspace(0, 5, len(df_lfq))
+    assert not np.allclose(pp_synthetic.pca(df_lfq=df_lfq)["explained_variance"], result["explained_variance"])
+
+
+def test_volcano_plots(pp_synthetic, tmp_path):
+    df_ratio_pval = pp_synthetic.run()
+    rc_params = dict(plt.rcParams)
+    files = pp_synthetic.volcano_plots(df_ratio_pval=df_ratio_pval, out_dir=str(tmp_path), n_jobs=2, max_labels=5,
+                                       fig_format="pdf")
+    assert [os.path.basename(file) for file in files] == ["volcano_A_B.pdf", "volcano_A_C.pdf", "volcano_B_C.pdf"]
+    assert all(os.path.getsize(file) > 0 for file in files)
+    files = pp_synthetic.volcano_plots(df_ratio_pval=df_ratio_pval, out_dir=str(tmp_path), contrasts=[("A", "C")],
+                                       max_labels=5, fig_format="svg")
+    assert [os.path.basename(file) for file in files] == ["volcano_A_C.svg"]
+    assert dict(plt.rcParams) == rc_params and plt.get_fignums() == []
+    ax = pp_synthetic.volcano_plot(df_ratio_pval=df_ratio_pval, col_ratio="log2 ratio (A/C)",
+                                   col_pval="-log10 p value (A/C)", max_labels=5)
+    assert ax.time_placement >= 0
+    plt.close("all")
+    with pytest.raises(ValueError):
+        pp_synthetic.volcano_plots(df_ratio_pval=df_ratio_pval, out_dir=str(tmp_path), contrasts=["C/A"])
+
+
+@pytest.mark.parametrize("large_data", ["raster", "density"])
+def test_scatter_large_data(large_data):
+    df = pd.DataFrame({"ratio": [-2.0, 0.1, 0.2, 2.0], "pval": [3.0, 0.5, 0.4, 3.0]})
+    colors = np.array(["blue", COLOR_NOT_SIG, COLOR_NOT_SIG, "red"])
+    ax = _scatter_large_data(df=df, col_ratio="ratio", col_pval="pval", colors=colors, large_data=large_data)
+    # Not significant points rasterized, significant points as vector graphics
+    rasterized, vector = ax.collections
+    assert rasterized.get_rasterized() and not vector.get_rasterized()
+    assert len(vector.get_offsets()) == 2
+    plt.close("all")
+
+
+def test_volcano_plot_ia(pp_synthetic, monkeypatch):
+    monkeypatch.setattr(go.Figure, "show", lambda self: None)
+    df_ratio_pval = pp_synthetic.run()
+    kwargs = dict(df_ratio_pval=df_ratio_pval, col_ratio="log2 ratio (A/B)", col_pval="-log10 p value (A/B)")
+    fig = pp_synthetic.volcano_plot_ia(**kwargs)
+    assert not any(isinstance(trace, go.Scattergl) for trace in fig.data)
+    fig = pp_synthetic.volcano_plot_ia(webgl=True, max_points=100, **kwargs)
+    assert all(isinstance(trace, go.Scattergl) for trace in fig.data)
+    classes = pp_synthetic.volcano_classes(df_ratio_pval=df_ratio_pval, col_ratio=kwargs["col_ratio"],
+                                           col_pval=kwargs["col_pval"])
+    n_sig = int((np.asarray(classes) != "Not Sig").sum())
+    # Significant points are kept, not significant points downsampled to max_points
+    assert sum(len(trace.x) for trace in fig.data) == max(100, n_sig)
+    assert sum(len(trace.x) for trace in fig.data if trace.name != "Not Sig") == n_sig
+